@@ -8,146 +8,248 @@ import traceback
 import asyncio
 import numpy as np
 from datetime import datetime, timezone, timedelta
+from frame_decoder import decode_adc_window
+from mcu_protocol import (CHECK_COMMAND, REPLY_OK, OUT_OF_BED_CODE, CHECK_REPLY_MIN, DATA_REPLY_MIN, FRAME_SIZE,
+                          DataCommand, autoscaling_command, read_frame, read_reply, parse_reply, reply_id)
+from poll_scheduler import PollScheduler
+from ring_buffer import RingBuffer
+from snapshot_store import format_epochs
+from snapshot_writer import SnapshotWriter, flush_minute, backfill_recent
+from realtime_shm import RealtimePublisher, clear_windows
+from metrics import Counter, Gauge, Histogram, FAST_BUCKETS, device_label
+
+FRAME_RTT = Histogram("ingest_frame_rtt_seconds", "Data command sent -> reply frame read", ("mcu_id",))
+DECODE_SECONDS = Histogram("ingest_decode_seconds", "Reply parse + ADC window decode", buckets=FAST_BUCKETS)
+CALLBACK_SECONDS = Histogram("ingest_callback_seconds", "Storage, realtime publish and board callback of one frame",
+                             buckets=FAST_BUCKETS)
+FRAMES = Counter("ingest_frames_total", "Reply frames received", ("mcu_id",))
+FRAME_BYTES = Counter("ingest_bytes_total", "Reply bytes received", ("mcu_id",))
+SAMPLES = Counter("ingest_samples_total", "Raw ADC samples stored", ("mcu_id",))
+LOST_SAMPLES = Counter("ingest_lost_samples_total", "ADC samples lost to ring overruns", ("mcu_id",))
+BAD_REPLIES = Counter("ingest_bad_replies_total", "Data replies without the OK status", ("mcu_id",))
+TIMEOUTS = Counter("ingest_timeouts_total", "Data commands without a reply within 10 s", ("mcu_id",))
+CONNECTIONS = Counter("ingest_connections_total", "Handshakes completed", ("mcu_id",))
+RECONNECTS = Counter("ingest_reconnects_total", "Handshakes of an MCU ID already seen by this process", ("mcu_id",))
+MINUTE_OVERFLOW = Counter("ingest_minute_overflow_total",
+                          "Values overwritten in the minute buffers before the flush, by kind (frames / samples)",
+                          ("mcu_id", "kind"))
+HANDSHAKE_FAILURES = Counter("ingest_handshake_failures_total", "Connections closed before the MCU ID was read")
+CONNECTED = Gauge("ingest_connected_clients", "Open MCU connections")
 
 class AsyncTCPServer:
-    def __init__(self, callback, host='0.0.0.0', port=5001):
+    def __init__(self, callback, host='0.0.0.0', port=5001, reuse_port=False, snapshot_suffix='', prepare=True):
         self.host = host
         self.port = port
+        self.reuse_port = reuse_port  # ingest_shard workers share the port
+        self.snapshot_suffix = snapshot_suffix  # e.g. '_w1': one minute snapshot file per worker
+        self.prepare = prepare  # 啟動時清掉上次留下的即時視窗檔、補齊裝置檔（sharded 時由 API 程序負責）
         self.callback = callback
         self.clients = {}  # addr_str -> (reader, writer)
         self.data_storage = {}  # mcu_id -> data dict
         self.data_frontend = {}  # addr_str -> display dict
         self.mcuid_ip = {}  # mcu_id -> addr_str
+        self.board_version = 0  # 每次 data_frontend 有變動就加一（payloads 的快取版本）
+        self.versions = {}  # addr_str -> board_version of its last change
         self.mcu_id_realTime_data = {} # mcu_id -> real time data(mininute)
+        self.realtime_publishers = {}  # mcu_id -> RealtimePublisher (shared with the download service)
+        self.connection_seq = 0  # 每次交握成功加一
+        self.realtime_connections = {}  # mcu_id -> connection_seq of the connection owning its realtime rings
+        self.poll_schedulers = {}  # mcu_id -> PollScheduler
         self.raw_per_minute = 60 * 100
         self.value_per_minute = 120
         self.snapshot_dir = "/app/snapshots"
         self.taiwan_tz = timezone(timedelta(hours=8))
-        self.data_array = self._create_data_array()
-        self.check_array = self._create_check_array()
         self.running = False
-        self.mcu_cpu_log = {}  # 新增 CPU 統計資料儲存
-        # self.mcu_cpu_fig = {}
-
-    def _create_check_array(self):
-        arr = bytearray(513)
-        arr[0:9] = bytes([0x13, 0x00, 0x01, 0x00, 0x09, 0x00, 0x01, 0x00, 0x1E])
-        return arr
-
-    def _create_data_array(self):
-        arr = bytearray(513)
-        arr[0:7] = bytes([0x13, 0x00, 0x28, 0x00, 0x15])
-        arr[17], arr[18] = 0x00, 0x01
-        # checksum = self._calculate_checksum(sum(arr[:7]))
-        # arr[7], arr[8] = checksum
-        return arr
-
-    def _calculate_checksum(self, total_sum):
-        total_sum &= 0xFFFF
-        return (total_sum >> 8) & 0xFF, total_sum & 0xFF
+        self.seen_ids = set()  # MCU IDs that connected before (ingest_reconnects_total)
+        self.frame_observer = None  # (mcu_id, wall_seconds) after every frame, e.g. ingest_benchmark
+        self.snapshot_writer = SnapshotWriter()
+
+    def _create_minute_storage(self, frames_per_minute=None):
+        # 每分鐘累積的資料，容量留兩倍空間避免輪詢抖動時溢出；每個 frame 一筆的欄位依最短輪詢間隔決定
+        per_frame = 2 * max(self.value_per_minute, frames_per_minute or 0)
+        return {
+            "raw": RingBuffer(2 * self.raw_per_minute, np.uint16),
+            "heart": RingBuffer(2 * self.raw_per_minute, np.uint16),
+            "heart_rate": RingBuffer(per_frame, np.uint8),
+            "resp_rate": RingBuffer(per_frame, np.uint8),
+            "movement": RingBuffer(per_frame, np.uint8),
+            "outofbed": RingBuffer(per_frame, np.uint8),
+            "timestamp": RingBuffer(per_frame, np.int64),
+            "RSSI": RingBuffer(per_frame, np.int8),
+        }
+
+    def _create_real_time_storage(self, mcu_id):
+        # 即時圖表放在共享記憶體檔案裡，下載服務可直接讀取，不必再透過 HTTP
+        try:
+            publisher = RealtimePublisher(mcu_id)
+        except OSError as e:
+            print(f"⚠️ realtime shared window unavailable for {mcu_id}: {e}")
+            self.realtime_publishers.pop(mcu_id, None)
+        else:
+            self.realtime_publishers[mcu_id] = publisher
+            return publisher.buffers
+        # 即時圖表：rate 保留 4 小時（每分鐘一筆），status 保留 4*60*100 筆
+        return {
+            'heart_rate': RingBuffer(4 * 60, np.float64),
+            'resp_rate': RingBuffer(4 * 60, np.float64),
+            'rate_timestamp': RingBuffer(4 * 60, np.int64),
+            'status': RingBuffer(4 * 60 * 100, np.int8),
+            'status_timestamp': RingBuffer(4 * 60 * 100, np.int64),
+        }
+
+    def _drop_real_time_storage(self, mcu_id, rings):
+        # 斷線後不再提供即時圖表：移除這條連線的共享視窗檔，重連時已換成新的就不動
+        if self.mcu_id_realTime_data.get(mcu_id) is not rings:
+            return
+        del self.mcu_id_realTime_data[mcu_id]
+        self.realtime_connections.pop(mcu_id, None)
+        publisher = self.realtime_publishers.pop(mcu_id, None)
+        if publisher is not None:
+            publisher.remove()
+
+    def realtime_rings(self, mcu_id):
+        return self.mcu_id_realTime_data.get(mcu_id)
+
+    def realtime_window_id(self, mcu_id):
+        """ identity of the rings realtime_rings() returns: the connection that owns them """
+        return self.realtime_connections.get(mcu_id)
+
+    def _touch(self, addr_str):
+        self.board_version += 1
+        self.versions[addr_str] = self.board_version
+
+    def realtime_version(self, mcu_id):
+        """ changes whenever get_real_time_data(mcu_id) would return something else; None if not connected """
+        rings = self.mcu_id_realTime_data.get(mcu_id)
+        if rings is None:
+            return None
+        # 連線序號而不是 id()：重連後的新 ring 可能拿到同一個位址，appended 也從頭數
+        return (self.realtime_connections[mcu_id], rings['status'].appended, rings['rate_timestamp'].appended)
+
+    def poll_stats(self):
+        return {mcu_id: scheduler.snapshot_stats() for mcu_id, scheduler in self.poll_schedulers.items()}
+
+    def snapshot_writer_stats(self):
+        return self.snapshot_writer.stats
+
+    def metric_families(self):
+        return []  # 同一個程序，metrics 已在 REGISTRY 裡
+
+    def get_real_time_data(self, mcu_id):
+        data = self.mcu_id_realTime_data.get(mcu_id)
+        if data is None:
+            return None
+        return {
+            'heart_rate': data['heart_rate'].tolist(),
+            'resp_rate': data['resp_rate'].tolist(),
+            'rate_timestamp': format_epochs(data['rate_timestamp'].view()),
+            'status': data['status'].tolist(),
+            'status_timestamp': format_epochs(data['status_timestamp'].view()),
+        }
 
     async def handle_client(self, reader, writer):
         addr = writer.get_extra_info('peername')
         addr_str = f"{addr[0]}:{addr[1]}"
         print(f"✅ New client: {addr_str}")
         self.clients[addr_str] = (reader, writer)
+        CONNECTED.inc()
+        mcu_id = None
+        rings = None  # 這條連線的即時圖表（斷線時一併移除）
 
         try:
-            writer.write(self.check_array)
+            writer.write(CHECK_COMMAND)
             await writer.drain()
-            data = await reader.read(1400)
-            if not (len(data) >= 13 and data[5] == 0x03):
+            # check 回覆長度不固定（舊版只要求 >= 13 bytes），讀到 MCU 安靜為止，不會留下殘餘 bytes 打亂後面的 frame
+            frame = await asyncio.wait_for(read_reply(reader, CHECK_REPLY_MIN), timeout=10.0)
+            if frame[5] != REPLY_OK:
                 print(f"❌ Verification failed for {addr_str}")
                 writer.close()
                 await writer.wait_closed()
                 return
-            # 取得目前時間，格式化為字串
-            now = datetime.now()
-            time_str = now.strftime("%Y%m%d%H%M")  # 例如 202507171132，共12碼
-            # 轉成 ASCII bytes（每個字元一個 byte）
-            time_bytes = time_str.encode("ascii")  # b'202507171132'
-            # 放到 arr 的 index 5 開始
-            self.data_array[5:5+12] = time_bytes
-            checksum = self._calculate_checksum(sum(self.data_array[:19]))
-            self.data_array[19], self.data_array[20] = checksum
+            # 每條連線自己的 data 指令 buffer：只有時間（YYYYmmddHHMM）會變，checksum 跟著增量更新
+            data_command = DataCommand()
             """ update MCU ID """
-            writer.write(self.data_array)
+            writer.write(data_command.set_time(datetime.now()))
             await writer.drain()
-            data = await reader.read(1400)
-            mcu_id = data[432:448].decode('ascii').rstrip('\x00')
+            # 第一個 data 回覆的長度就是這條連線之後每個 frame 的長度
+            frame = await asyncio.wait_for(read_reply(reader, DATA_REPLY_MIN), timeout=10.0)
+            frame_size = len(frame)
+            mcu_id = reply_id(frame)
+            if frame_size != FRAME_SIZE:
+                print(f"ℹ️ [{mcu_id}] replies are {frame_size} bytes (MCU_FRAME_SIZE {FRAME_SIZE})")
             self.mcuid_ip[mcu_id] = addr_str
             self.data_frontend[addr_str] = {
                 "heart_rate": 0, "resp_rate": 0, "movement": 0,
                 "outofbed": 0, "autoscaling": 0, "timestamp": '', "RSSI":0, "name": mcu_id, "addr": addr_str, "status":'connect'
             }
-            self.data_storage[mcu_id] = {
-                "raw": [], "heart_rate": [], "resp_rate": [],
-                "movement": [], "outofbed": [], "timestamp": [], "RSSI":[]
-            }
-            self.mcu_id_realTime_data[mcu_id] = {'heart_rate':[], 'resp_rate':[], 'rate_timestamp':[]
-                                                 , 'status':[], 'status_timestamp':[]}
+            self._touch(addr_str)
+            scheduler = self.poll_schedulers[mcu_id] = PollScheduler()
+            self.data_storage[mcu_id] = self._create_minute_storage(scheduler.frames_per_minute())
+            rings = self.mcu_id_realTime_data[mcu_id] = self._create_real_time_storage(mcu_id)
+            self.connection_seq += 1
+            self.realtime_connections[mcu_id] = self.connection_seq
+
+            # labels 先取好，每個 frame 只剩加法與 bisect
+            device = device_label(mcu_id)
+            CONNECTIONS.labels(device).inc()
+            if mcu_id in self.seen_ids:
+                RECONNECTS.labels(device).inc()
+            self.seen_ids.add(mcu_id)
+            frame_rtt = FRAME_RTT.labels(device)
+            decode_seconds = DECODE_SECONDS.labels()
+            callback_seconds = CALLBACK_SECONDS.labels()
+            frames = FRAMES.labels(device)
+            frame_bytes = FRAME_BYTES.labels(device)
+            samples = SAMPLES.labels(device)
 
             print(f'start getting data on {addr_str}, id name: {mcu_id}')
             lastAdccurrent = 0
 
             while True:
-                cpu_start = time.process_time()
-                wall_start = time.time()
-                """ add timestamp in data array """
-                # 取得目前時間，格式化為字串
-                now = datetime.now()
-                time_str = now.strftime("%Y%m%d%H%M")  # 例如 202507171132，共12碼
-                # 轉成 ASCII bytes（每個字元一個 byte）
-                time_bytes = time_str.encode("ascii")  # b'202507171132'
-                # 放到 arr 的 index 5 開始
-                self.data_array[5:5+12] = time_bytes
-                checksum = self._calculate_checksum(sum(self.data_array[:19]))
-                self.data_array[19], self.data_array[20] = checksum
-                # data cmd
-                writer.write(self.data_array)
+                # data cmd（buffer 在收到回覆前不會再被改動，回覆到了代表指令已送完）
+                sent_at = time.monotonic()
+                writer.write(data_command.set_time(datetime.now()))
                 await writer.drain()
-                # await asyncio.sleep(0.1)
                 try:
-                    MCUresponseData = await asyncio.wait_for(reader.read(1400), timeout=10.0)
+                    frame = await asyncio.wait_for(read_frame(reader, frame_size), timeout=10.0)
                 except asyncio.TimeoutError:
+                    TIMEOUTS.labels(device).inc()
                     raise ConnectionError("Timeout: No data received from MCU")
-
-                if not MCUresponseData:
-                    raise ConnectionError("MCU disconnected")
-
-                if MCUresponseData[5] != 3:
+                received_at = time.monotonic()
+                rtt = received_at - sent_at
+                frame_rtt.observe(rtt)
+                frames.inc()
+                frame_bytes.inc(len(frame))
+
+                reply = parse_reply(frame)
+                if reply.status != REPLY_OK:
+                    BAD_REPLIES.labels(device).inc()
                     continue
 
-                raw, heart = [], []
-                rawI, heartI = 32, 232
-
-                CurrentAdccurrent = (MCUresponseData[6]) << 8 | MCUresponseData[7]
-                HeartMCU = int(MCUresponseData[12])
-                RespMCU = int(MCUresponseData[13])
-                OobMCU = int(MCUresponseData[14])
-                rssiMCU = int.from_bytes(MCUresponseData[27:28], byteorder='big', signed=True)
-                if OobMCU == 79:
+                CurrentAdccurrent = reply.adc_index
+                HeartMCU = reply.heart_rate
+                RespMCU = reply.resp_rate
+                rssiMCU = reply.rssi
+                if reply.outofbed == OUT_OF_BED_CODE:
                     OobMCU = 1
                     BdmmtMCU = 0
                 else:
                     OobMCU = 0
-                    BdmmtMCU = MCUresponseData[15]
-                AutoScaling = int(MCUresponseData[24])
+                    BdmmtMCU = reply.movement
+                AutoScaling = reply.autoscaling
 
-                if CurrentAdccurrent > lastAdccurrent:
-                    for i in range(lastAdccurrent, CurrentAdccurrent):
-                        raw.append((MCUresponseData[(rawI+i*2)])<<8 | MCUresponseData[(rawI+i*2)+1])
-                        heart.append((MCUresponseData[(heartI+i*2)])<<8 | MCUresponseData[(heartI+i*2)+1])
-                else:
-                    for i in range(lastAdccurrent, 100):
-                        raw.append((MCUresponseData[(rawI+i*2)])<<8 | MCUresponseData[(rawI+i*2)+1])
-                        heart.append((MCUresponseData[(heartI+i*2)])<<8 | MCUresponseData[(heartI+i*2)+1])
-                    for i in range(CurrentAdccurrent):
-                        raw.append((MCUresponseData[(rawI+i*2)])<<8 | MCUresponseData[(rawI+i*2)+1])
-                        heart.append((MCUresponseData[(heartI+i*2)])<<8 | MCUresponseData[(heartI+i*2)+1])
+                raw, heart = decode_adc_window(frame, lastAdccurrent, CurrentAdccurrent)
                 lastAdccurrent = CurrentAdccurrent
+                decoded_at = time.monotonic()
+                decode_seconds.observe(decoded_at - received_at)
+                samples.inc(len(raw))
+                lost = scheduler.observe(len(raw), rtt)
+                if lost:
+                    LOST_SAMPLES.labels(device).inc(lost)
+                    print(f"⚠️ [{mcu_id}] ADC ring overrun, about {lost} samples lost")
                 # print(f'MCU device: {mcu_id}, raw length: {len(raw)}')
-                timestamp = datetime.now(self.taiwan_tz).strftime("%Y-%m-%d %H:%M:%S")
+                epoch = int(time.time())
+                timestamp = datetime.fromtimestamp(epoch, self.taiwan_tz).strftime("%Y-%m-%d %H:%M:%S")
 
                 if rssiMCU<=-30 and rssiMCU>=-50:
                     rssi_frontend = 0
@@ -167,27 +269,31 @@ class AsyncTCPServer:
                     "movement": BdmmtMCU, "outofbed": OobMCU,
                     "autoscaling": AutoScaling, "timestamp": timestamp, "RSSI": rssi_frontend
                 })
-
-                self.data_storage[mcu_id]["raw"] += raw
-                self.data_storage[mcu_id]["heart_rate"].append(HeartMCU)
-                self.data_storage[mcu_id]["resp_rate"].append(RespMCU)
-                self.data_storage[mcu_id]["movement"].append(BdmmtMCU)
-                self.data_storage[mcu_id]["outofbed"].append(OobMCU)
-                self.data_storage[mcu_id]["timestamp"].append(timestamp)
-                self.data_storage[mcu_id]["RSSI"].append(rssiMCU)
+                self._touch(addr_str)
+
+                minute_data = self.data_storage[mcu_id]
+                minute_data["raw"].extend(raw)
+                minute_data["heart"].extend(heart)
+                minute_data["heart_rate"].append(HeartMCU)
+                minute_data["resp_rate"].append(RespMCU)
+                minute_data["movement"].append(BdmmtMCU)
+                minute_data["outofbed"].append(OobMCU)
+                minute_data["timestamp"].append(epoch)
+                minute_data["RSSI"].append(rssiMCU)
 
                 """ append real time figure data """
+                publisher = self.realtime_publishers.get(mcu_id)
+                if publisher:
+                    publisher.begin()
                 if OobMCU == 1:
                     self.mcu_id_realTime_data[mcu_id]['status'].append(-1)
                 elif BdmmtMCU == 1:
                     self.mcu_id_realTime_data[mcu_id]['status'].append(1)
                 else:
                     self.mcu_id_realTime_data[mcu_id]['status'].append(0)
-                    
-                self.mcu_id_realTime_data[mcu_id]['status_timestamp'].append(timestamp)
-                if len(self.mcu_id_realTime_data[mcu_id]['status']) >= 4*60*100:
-                    self.mcu_id_realTime_data[mcu_id]['status'].pop(0)
-                    self.mcu_id_realTime_data[mcu_id]['status_timestamp'].pop(0)
+                self.mcu_id_realTime_data[mcu_id]['status_timestamp'].append(epoch)
+                if publisher:
+                    publisher.publish()
                 
                 # ensure callback is awaitable
                 if asyncio.iscoroutinefunction(self.callback):
@@ -195,35 +301,12 @@ class AsyncTCPServer:
                 else:
                     self.callback(self.data_frontend)
 
-                cpu_used = time.process_time() - cpu_start
-                wall_elapsed = time.time() - wall_start
-                self.mcu_cpu_log.setdefault(mcu_id, []).append((cpu_used, wall_elapsed))
-                """ draw cpu using percentage 
-                # if mcu_id not in self.mcu_cpu_fig.keys():
-                #     self.mcu_cpu_fig[mcu_id] = {}
-                #     self.mcu_cpu_fig[mcu_id]['cpu_per'] = []
-                #     self.mcu_cpu_fig[mcu_id]['time'] = []
-
-                # if len(self.mcu_cpu_fig[mcu_id]['cpu_per']) == 20:
-                #     import matplotlib.pyplot as plt
-                #     plt.plot(self.mcu_cpu_fig[mcu_id]['time'], self.mcu_cpu_fig[mcu_id]['cpu_per'])
-                #     plt.title(f'{mcu_id} cpu using')
-                #     plt.xlabel('time')
-                #     plt.ylabel('CPU usage')
-                #     plt.xticks(fontsize=8, rotation=45)
-                #     plt.savefig(f'/app/snapshots/{mcu_id}_cpu.png')
-                """
-                
-                if len(self.mcu_cpu_log[mcu_id]) >= 20:
-                    avg_cpu = sum(c for c, _ in self.mcu_cpu_log[mcu_id]) / 20
-                    avg_wall = sum(w for _, w in self.mcu_cpu_log[mcu_id]) / 20
-                    percent = avg_cpu / avg_wall * 100 if avg_wall > 0 else 0
-                    print(f"📊 [{mcu_id}] 平均 CPU 使用率：{percent:.2f}%")
-                    # self.mcu_cpu_fig[mcu_id]['cpu_per'].append(percent)
-                    # self.mcu_cpu_fig[mcu_id]['time'].append(str(timestamp).split(' ')[1])
-                    self.mcu_cpu_log[mcu_id].clear()
-
-                await asyncio.sleep(0.5)
+                done_at = time.monotonic()
+                callback_seconds.observe(done_at - decoded_at)
+                if self.frame_observer:
+                    self.frame_observer(mcu_id, done_at - sent_at)
+                # 依 ring 填充速度與 RTT 決定下一次輪詢時間，取代固定 0.5 秒
+                await asyncio.sleep(scheduler.next_delay())
 
         except Exception as e:
             print(f"⚠️ Client {addr_str} error: {e}")
@@ -237,45 +320,66 @@ class AsyncTCPServer:
                 await self.callback({addr_str: {"status": "disconnected"}})
             else:
                 self.callback({addr_str: {"status": "disconnected"}})
-            mcu_id = self.data_frontend[addr_str]['name']
+            CONNECTED.dec()
+            if mcu_id is None:  # 交握失敗時還沒有 ID
+                HANDSHAKE_FAILURES.inc()
             self.clients.pop(addr_str, None)
             self.data_storage.pop(mcu_id, None)
             self.data_frontend.pop(addr_str, None)
+            self.versions.pop(addr_str, None)
+            self.board_version += 1
             self.mcuid_ip.pop(mcu_id, None)
-            self.mcu_cpu_log.pop(mcu_id, None)
+            self.poll_schedulers.pop(mcu_id, None)
+            if rings is not None:
+                self._drop_real_time_storage(mcu_id, rings)
             print(f"🧹 Connection closed: {addr_str}")
 
+    def _count_overflow(self, mcu_id, data):
+        """ values the minute buffers lost before this flush (clear() resets the counts) """
+        frames, samples = data["timestamp"].overwritten, data["raw"].overwritten
+        if not frames and not samples:
+            return
+        scheduler = self.poll_schedulers.get(mcu_id)
+        if scheduler is not None:
+            scheduler.record_overflow(frames, samples)
+        device = device_label(mcu_id)
+        MINUTE_OVERFLOW.labels(device, "frames").inc(frames)
+        MINUTE_OVERFLOW.labels(device, "samples").inc(samples)
+        print(f"⚠️ [{mcu_id}] minute buffers overflowed: {frames} frames, {samples} samples overwritten")
+
     async def _prune_and_store(self):
         while self.running:
             now = datetime.now(self.taiwan_tz)
             if now.second == 0:
-                snapshot_time = now.strftime("%Y-%m-%d_%H-%M-%S")
+                snapshot_time = now.strftime("%Y-%m-%d_%H-%M-%S") + self.snapshot_suffix
                 today_str = now.strftime("%Y-%m-%d")
-                dated_dir = os.path.join(self.snapshot_dir, today_str)
-                os.makedirs(dated_dir, exist_ok=True)
                 snapshot = {}
                 for id, data in self.data_storage.items():
                     snapshot[id] = {}
-                    for key in data.keys():
+                    publisher = self.realtime_publishers.get(id)
+                    if publisher:
+                        publisher.begin()
+                    self._count_overflow(id, data)
+                    for key, buf in data.items():
                         if key=='heart_rate' or key=='resp_rate':
-                            min_data = np.array(data[key])
+                            min_data = buf.view()
                             if min_data[min_data>0].size > 0:
                                 self.mcu_id_realTime_data[id][key].append(np.mean(min_data[min_data>0]))
                             else:
                                 self.mcu_id_realTime_data[id][key].append(0)
 
-                        snapshot[id][key] = data[key]
-                        data[key] = []
+                        column = buf.view().copy()
+                        column.flags.writeable = False
+                        snapshot[id][key] = column
+                        buf.clear()
 
-                    timestamp = datetime.now(self.taiwan_tz).strftime("%Y-%m-%d %H:%M:%S")
-                    self.mcu_id_realTime_data[id]['rate_timestamp'].append(timestamp)
-                    if len(self.mcu_id_realTime_data[id]['rate_timestamp'])>=4*60:
-                        self.mcu_id_realTime_data[id]['rate_timestamp'].pop(0)
-                        self.mcu_id_realTime_data[id]['resp_rate'].pop(0)
-                        self.mcu_id_realTime_data[id]['heart_rate'].pop(0)
+                    self.mcu_id_realTime_data[id]['rate_timestamp'].append(int(time.time()))
+                    if publisher:
+                        publisher.publish()
 
-                with open(os.path.join(dated_dir, f'snapshot_{snapshot_time}.json'), "w") as f:
-                    json.dump(snapshot, f, indent=2)
+                # 序列化與寫檔交給背景執行緒，不佔用 event loop
+                await self.snapshot_writer.submit(flush_minute, self.snapshot_dir, today_str,
+                                                  snapshot_time, int(now.timestamp()), snapshot)
 
                 await asyncio.sleep(1)
             else:
@@ -283,9 +387,18 @@ class AsyncTCPServer:
 
     async def start(self):
         self.running = True
+        if self.prepare:
+            removed = clear_windows()
+            if removed:
+                print(f"🧹 removed {removed} stale realtime windows")
+            # 第一次寫入前把只存在 snapshot 裡的分鐘補進裝置檔
+            backfilled = await asyncio.to_thread(backfill_recent, self.snapshot_dir)
+            if backfilled:
+                print(f"🧩 backfilled {backfilled} device day files from the minute snapshots")
+        self.snapshot_writer.start()
         asyncio.create_task(self._prune_and_store())
 
-        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        server = await asyncio.start_server(self.handle_client, self.host, self.port, reuse_port=self.reuse_port or None)
         print(f"🚀 Async Server listening on {self.host}:{self.port}")
         async with server:
             await server.serve_forever()
@@ -296,13 +409,8 @@ class AsyncTCPServer:
             return
 
         _, writer = self.clients[addr_str]
-        arr = bytearray(513)
-        arr[0:11] = bytes([0x13, 0x00, 0x89, 0x00, 0x0D, 0x14, 0xEB, 1, 1, 0x00, 0x01])
-        checksum = self._calculate_checksum(sum(arr[:11]))
-        arr[11], arr[12] = checksum
-
         try:
-            writer.write(arr)
+            writer.write(autoscaling_command())
             await writer.drain()
             print(f"📤 已送出 Autoscaling 指令到 {addr_str}")
         except Exception as e:
@@ -317,6 +425,7 @@ class AsyncTCPServer:
                 await writer.wait_closed()
             except Exception as e:
                 print(f"⚠️ 關閉 {addr_str} 時發生錯誤：{e}")
+        await asyncio.to_thread(self.snapshot_writer.stop)
         print("✅ 所有連線已關閉")
 
 
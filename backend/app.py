@@ -9,8 +9,13 @@ import json
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response
 from TCP_server_text import AsyncTCPServer
+from broadcast import BroadcastTicker
+from ingest_shard import INGEST_WORKERS, ShardedIngest
+from metrics import REGISTRY, CONTENT_TYPE, render, observe_requests, stats_gauge
+from loop_monitor import LoopMonitor
+from payloads import PayloadCache
 
 app = FastAPI()
 app.add_middleware(
@@ -20,40 +25,130 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+observe_requests(app)
 
 sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*")
 sio_app = socketio.ASGIApp(sio, other_asgi_app=app)
 
-tcp_server = AsyncTCPServer(callback=lambda data: asyncio.create_task(sio.emit('mcu_update', data)))
+# 每個 frame 只標記有變動，由 ticker 每個 tick 合併成一則只含變動欄位的 mcu_update
+broadcaster = BroadcastTicker(sio, source=lambda: tcp_server.data_frontend,
+                              realtime_source=lambda mcu_id: tcp_server.realtime_rings(mcu_id),
+                              realtime_key=lambda mcu_id: tcp_server.realtime_window_id(mcu_id))
+if INGEST_WORKERS > 1:
+    # MCU 連線分散到多個 worker process（SO_REUSEPORT），這裡只保留合併後的狀態
+    tcp_server = ShardedIngest(callback=broadcaster.notify, workers=INGEST_WORKERS)
+else:
+    tcp_server = AsyncTCPServer(callback=broadcaster.notify)
+
+stats_gauge("broadcast_stats", "BroadcastTicker counters", lambda: broadcaster.stats)
+
+# /status、/mcu/{id}、/mcu_real_time_data 每個資料版本只編碼一次，輪詢的人共用同一份 bytes
+payloads = PayloadCache()
+stats_gauge("payload_cache_stats", "PayloadCache counters", payloads.snapshot_stats)
+
+# event loop 延遲取樣；卡住超過門檻時由看門狗執行緒記下當時的 stack（/debug/loop）
+loop_monitor = LoopMonitor()
 
 async def background_start():
     await tcp_server.start()
 
 # 啟動背景任務（只執行一次）
 asyncio.get_event_loop().create_task(background_start())
+asyncio.get_event_loop().create_task(broadcaster.run())
+asyncio.get_event_loop().create_task(loop_monitor.run())
+
+@sio.event
+async def connect(sid, environ):
+    await broadcaster.resync(sid)
+
+@sio.on("mcu_resync")
+async def mcu_resync(sid, data=None):
+    # 客戶端發現 seq 不連續時要求完整狀態
+    await broadcaster.resync(sid)
+
+def room_mcu_id(data):
+    """ mcu_id of a subscribe/unsubscribe payload, None when the payload is malformed """
+    mcu_id = data.get("mcu_id") if isinstance(data, dict) else None
+    return mcu_id if isinstance(mcu_id, str) and mcu_id else None
+
+@sio.on("subscribe")
+async def subscribe(sid, data=None):
+    # 詳細頁只訂閱單一裝置：mcu_state / mcu_realtime / mcu_disconnect 推到 room "mcu:{id}"
+    mcu_id = room_mcu_id(data)
+    if mcu_id is None:
+        return  # 格式不對的訂閱直接忽略
+    await broadcaster.subscribe(sid, mcu_id)
+
+@sio.on("unsubscribe")
+async def unsubscribe(sid, data=None):
+    mcu_id = room_mcu_id(data)
+    if mcu_id is None:
+        return
+    await broadcaster.unsubscribe(sid, mcu_id)
+
+@sio.event
+async def disconnect(sid, *args):
+    broadcaster.drop(sid)
 
 
 # 新增 FastAPI 的 shutdown 事件處理器
 @app.on_event("shutdown")
 async def shutdown_event():
     print("🛑 收到中止事件，關閉 TCP Server...")
+    broadcaster.stop()
+    loop_monitor.stop()
     await tcp_server.shutdown()
 
 from fastapi import Request
 
 @app.get("/status")
-async def get_status():
-    return tcp_server.data_frontend
+async def get_status(request: Request):
+    return payloads.respond(request, "status", tcp_server.board_version, lambda: tcp_server.data_frontend)
 
 @app.get("/mcu_real_time_data/{mcu_id}")
-async def get_mcu_real_time_data(mcu_id: str):
-    data = tcp_server.mcu_id_realTime_data.get(mcu_id)
-    if data is None:
+async def get_mcu_real_time_data(mcu_id: str, request: Request):
+    version = tcp_server.realtime_version(mcu_id)
+    if version is None:
+        payloads.drop(("realtime", mcu_id))  # 斷線的裝置不要一直佔著快取
         raise HTTPException(status_code=404, detail=f"MCU {mcu_id} not found")
-    return data
+
+    def build():
+        data = tcp_server.get_real_time_data(mcu_id)
+        if data is None:  # 剛好在這之間斷線
+            raise HTTPException(status_code=404, detail=f"MCU {mcu_id} not found")
+        return data
+
+    return payloads.respond(request, ("realtime", mcu_id), version, build)
+
+@app.get("/broadcast_stats")
+async def get_broadcast_stats():
+    return dict(broadcaster.stats, seq=broadcaster.seq, tick=broadcaster.tick, devices=len(broadcaster.sent),
+                subscriptions={mcu_id: len(sids) for mcu_id, sids in broadcaster.subscribers.items()})
+
+@app.get("/poll_stats")
+async def get_poll_stats():
+    # 每台 MCU 的輪詢間隔、RTT、ring 填充速度與 overrun（遺失樣本）統計
+    return tcp_server.poll_stats()
+
+@app.get("/snapshot_writer_stats")
+async def get_snapshot_writer_stats():
+    return tcp_server.snapshot_writer_stats()
+
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus 格式；sharded 模式下另外附上各 worker 最近一次回報的 metrics（label worker）
+    return Response(render(REGISTRY.collect() + tcp_server.metric_families()), media_type=CONTENT_TYPE)
+
+@app.get("/debug/loop")
+async def get_loop_health(limit: int = 10):
+    # 最近卡住 event loop 最久的呼叫（含 stack）與各位置的累計
+    result = loop_monitor.snapshot(limit)
+    if INGEST_WORKERS > 1:
+        result["workers"] = tcp_server.loop_stats()
+    return result
 
 @app.get('/mcu/{mcu_id}')
-async def get_mcu_by_id(mcu_id: str):
+async def get_mcu_by_id(mcu_id: str, request: Request):
     addr_str = tcp_server.mcuid_ip.get(mcu_id)
     if not addr_str:
         await sio.emit("mcu_disconnect", {"id": mcu_id})
@@ -63,7 +158,7 @@ async def get_mcu_by_id(mcu_id: str):
     if not data:
         return {"status": "waiting", "id": mcu_id}
 
-    return data
+    return payloads.respond(request, ("mcu", addr_str), tcp_server.versions.get(addr_str), lambda: data)
 
 from pydantic import BaseModel
 
@@ -3,17 +3,29 @@ import asyncio
 import requests
 import socketio
 import aiofiles
-import io
-import gzip
-import json
-import base64
-import matplotlib.pyplot as plt
 import numpy as np
 
 from requests.exceptions import RequestException
 from fastapi import FastAPI, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response
+from device_store import load_device_day, has_device_day, day_sources
+from rollup import SUM_FIELDS, load_rollup, rollup_from_records, minute_means, minute_str, rollup_path
+from result_cache import ResultCache, file_fingerprint
+from downsample import downsample
+from day_export import (export_etag, cached_export, stream_and_store, build_export,
+                        parse_range, etag_matches)
+from snapshot_store import taiwan_tz
+from realtime_shm import RealtimeReader
+from charts import analysis_charts, realtime_charts, history_charts
+from render_pool import RenderPool, RenderBusy, RenderTimeout
+from metrics import Counter, CONTENT_TYPE, render, observe_requests, stats_gauge
+from loop_monitor import LoopMonitor
+from compactor import COMPACTOR, Compactor
+from catalog import devices_on, device_dates, minutes_between
+from status_timeline import StatusTimeline, run_lengths, tick_indices, format_time, labelled_intervals
+from collections import defaultdict
+from datetime import datetime as dt, timedelta
 
 app = FastAPI()
 app.add_middleware(
@@ -23,92 +35,61 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+observe_requests(app)
 
 sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*")
 sio_app = socketio.ASGIApp(sio, other_asgi_app=app)
 
-@app.get("/download/{mcu_id}")
-async def download_snapshot(mcu_id: str, date: str):
-    file_path = f"/app/snapshots/{date}"  # 或根據你實際命名方式調整
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="指定日期資料不存在")
-    print(f'MCU device {mcu_id} is loading {date} data')
-    files = os.listdir(file_path)
-    # print(files)
-    collected_data = {}
-    for file in files:
-        if not file.endswith(".json"):
-            continue
-        try:
-            time = file.split('.')[0].split('_')[2]
-        except IndexError:
-            continue
-
-        async with aiofiles.open(os.path.join(file_path, file), mode='r') as f:
-            content = await f.read()
-            try:
-                json_file = json.loads(content)
-            except json.JSONDecodeError as e:
-                print(e)
-                continue
+SNAPSHOT_ROOT = "/app/snapshots"
 
-            if mcu_id in json_file:
-                collected_data[time] = json_file[mcu_id]
-
-    from collections import OrderedDict
-    def time_key(t):
-        h, m, s = map(int, t.split('-'))
-        return h * 60 + m
-
-    sorted_data = OrderedDict(sorted(collected_data.items(), key=lambda x: time_key(x[0])))
-    json_str = json.dumps(sorted_data, indent=2, ensure_ascii=False)
-    buffer = io.BytesIO()
-    with gzip.GzipFile(fileobj=buffer, mode="wb") as f:
-        f.write(json_str.encode("utf-8"))
-    buffer.seek(0)
-    print(f'MCU device {mcu_id} loading {date} data finished')
-    return StreamingResponse(buffer,
-                             media_type='application/gzip',
-                             headers={"Content-Disposition": f"attachment; filename={mcu_id}_{date}.json.gz"})
+# /analysis 與 /historyplot 的結果快取，key 內含來源檔案的 mtime/size
+result_cache = ResultCache(max_entries=int(os.environ.get("RESULT_CACHE_SIZE", "32")),
+                           disk_dir=os.environ.get("RESULT_CACHE_DIR") or None)
 
-@app.get("/analysis/{mcu_id}")
-async def analysis_mcu_data(mcu_id: str, date: str):
-    file_path = f"/app/snapshots/{date}"  # 或根據你實際命名方式調整
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="指定日期資料不存在")
-    print(f'MCU device {mcu_id} is processing {date} data')
-    files = os.listdir(file_path)
-    # print(files)
-    collected_data = {}
-    for file in files:
-        if not file.endswith(".json"):
-            continue
-        try:
-            time = file.split('.')[0].split('_')[2]
-        except IndexError:
-            continue
-
-        async with aiofiles.open(os.path.join(file_path, file), mode='r') as f:
-            content = await f.read()
-            try:
-                json_file = json.loads(content)
-            except json.JSONDecodeError as e:
-                print(e)
-                continue
+# 同一個 pod 內直接讀取 ingest 的共享即時資料；讀不到時才回頭走 HTTP（ingest 在同一個 pod）
+realtime_reader = RealtimeReader()
+INGEST_URL = os.environ.get("INGEST_URL", "http://127.0.0.1:8000")
+
+# matplotlib 繪圖交給 worker process，handler 只等結果，不會卡住其他請求
+render_pool = RenderPool()
+
+stats_gauge("result_cache_stats", "ResultCache counters", result_cache.snapshot_stats)
+stats_gauge("render_pool_stats", "RenderPool counters", render_pool.snapshot_stats)
+# 繪圖、requests.get 等同步工作若卡住 event loop，/debug/loop 會列出位置與 stack
+loop_monitor = LoopMonitor()
+
+# 關閉的日期壓成每台裝置一個 .day，並依 RETAIN_* 期限刪除舊資料（COMPACTOR=1 才啟用）
+compactor = Compactor(SNAPSHOT_ROOT)
+stats_gauge("compactor_stats", "Compactor counters", compactor.snapshot_stats)
 
-            if mcu_id in json_file:
-                collected_data[time] = json_file[mcu_id]
+REALTIME_FETCHES = Counter("realtime_fetch_total", "Realtime windows read, by source (shm / http / not_connected / error)", ("source",))
 
-    from collections import OrderedDict
-    def time_key(t):
-        h, m, s = map(int, t.split('-'))
-        return h * 60 + m
+@app.on_event("startup")
+async def startup_event():
+    render_pool.start()
+    asyncio.create_task(loop_monitor.run())
+    if COMPACTOR:
+        asyncio.create_task(compactor.run())
 
-    sorted_data = OrderedDict(sorted(collected_data.items(), key=lambda x: time_key(x[0])))
-    timestamps_count, timestamps_status, hearts, resps, status = [], [], [], [], []
+@app.on_event("shutdown")
+async def shutdown_event():
+    loop_monitor.stop()
+    compactor.stop()
+    await asyncio.to_thread(render_pool.stop)
+
+async def render_charts(func, *args):
+    try:
+        return await render_pool.render(func, *args)
+    except RenderBusy:
+        raise HTTPException(status_code=503, detail="繪圖佇列已滿，請稍後再試", headers={"Retry-After": "5"})
+    except RenderTimeout:
+        raise HTTPException(status_code=504, detail="繪圖逾時")
+
+def analysis_series(sorted_data):
+    """ per-frame (timestamps, hearts, resps, status) of one device-day """
+    timestamps_status, hearts, resps, status = [], [], [], []
 
     for time, record in sorted_data.items():
-        timestamps_count.append(time)
         heart_min = np.array(record['heart_rate'])
         resp_min = np.array(record['resp_rate'])
         # hearts.append(np.mean(heart_min[heart_min>0]))
@@ -127,261 +108,66 @@ async def analysis_mcu_data(mcu_id: str, date: str):
             timestamps_status.append(time)
             hearts.append(heart_min[i])
             resps.append(resp_min[i])
-    if len(hearts) < 48:
-        interval_status = len(hearts)
-    else:
-        interval_status = len(hearts)//24
-    labels = [str(timestamps_status[i]) if i%interval_status==0 else '' for i in range(len(timestamps_status))]
-    # heart data
-    fig, ax = plt.subplots(figsize=(10, 5), dpi=300)
-    ax.plot(timestamps_status, hearts)
-    ax.set_title(f'MCU device {mcu_id} {date} heartrate', fontsize=6)
-    ax.set_ylabel('heartrate')
-    ax.yaxis.label.set_fontsize(6)
-    ax.set_xlabel('time')
-    ax.xaxis.label.set_fontsize(6)
-    ax.set_xticks(ticks=range(len(timestamps_status)))
-    ax.set_xticklabels(labels, rotation=30)
-    ax.tick_params(axis='x', labelsize=6)
-    ax.tick_params(axis='y', labelsize=6)
-    buf = io.BytesIO()
-    fig.savefig(buf, format='png')
-    plt.close(fig)
-    buf.seek(0)
-    heart_img_base64 = base64.b64encode(buf.read()).decode('utf-8')
-
-    # resp data
-    fig, ax = plt.subplots(figsize=(10, 5), dpi=300)
-    ax.plot(timestamps_status, resps)
-    ax.set_title(f'MCU device {mcu_id} {date} resprate', fontsize=6)
-    ax.set_ylabel('resprate')
-    ax.yaxis.label.set_fontsize(6)
-    ax.set_xlabel('time')
-    ax.xaxis.label.set_fontsize(6)
-    ax.set_xticks(ticks=range(len(timestamps_status)))
-    ax.set_xticklabels(labels, rotation=30)
-    ax.tick_params(axis='x', labelsize=6)
-    ax.tick_params(axis='y', labelsize=6)
-    buf = io.BytesIO()
-    fig.savefig(buf, format='png')
-    plt.close(fig)
-    buf.seek(0)
-    resp_img_base64 = base64.b64encode(buf.read()).decode('utf-8')
-
-    interval_status = len(status)//24
-    labels = [str(timestamps_status[i]) if i%interval_status==0 else '' for i in range(len(timestamps_status))]
-    # status
-    fig, ax = plt.subplots(figsize=(10, 5), dpi=300)
-    ax.plot(timestamps_status, status)
-    ax.set_ylabel('status')
-    ax.yaxis.label.set_fontsize(6)
-    ax.set_xlabel('time')
-    ax.xaxis.label.set_fontsize(6)
-    ax.set_yticks(ticks=[-1, 0, 1])
-    ax.set_ylim(-2, 2)
-    ax.set_yticklabels(['out of bed', 'measuring', 'movement'])
-    ax.tick_params(axis='y', labelsize=6)
-    ax.set_xticks(ticks=range(len(timestamps_status)))
-    ax.set_xticklabels(labels, rotation=30)
-    ax.tick_params(axis='x', labelsize=6)
-    ax.set_title(f'MCU device {mcu_id} {date} status', fontsize=6)
-    buf = io.BytesIO()
-    fig.savefig(buf, format='png')
-    plt.close(fig)
-    buf.seek(0)
-    status_img_base64 = base64.b64encode(buf.read()).decode('utf-8')
-    
-    print(f'MCU device {mcu_id} processing {date} data finished')
+    return timestamps_status, hearts, resps, status
 
-    return {"heart_image": heart_img_base64, 'resp_image': resp_img_base64, 'status_image': status_img_base64}
+def daterange(start_date_obj, end_date_obj):
+    for n in range(int((end_date_obj - start_date_obj).days) + 1):
+        yield start_date_obj + timedelta(n)
 
-@app.get("/realtime/{mcu_id}")
-async def real_time_figure_mcu_data(mcu_id: str):
-    try:
-        response = requests.get(f"http://172.20.10.3:8000/mcu_real_time_data/{mcu_id}")
-        if response.status_code == 200:
-            data = response.json()
-            # 取得資料
-            heart = data.get("heart_rate", [])
-            resp = data.get("resp_rate", [])
-            rate_ts = data.get("rate_timestamp", [])
-            status = data.get("status", [])
-            status_ts = data.get("status_timestamp", [])
-
-            # 限制 x 軸 ticks 數量最多 10 個
-            def reduce_ticks(xlist):
-                if len(xlist) <= 10:
-                    return list(range(len(xlist))), xlist
-                step = len(xlist) // 10
-                indices = list(range(0, len(xlist), step))
-                labels = [xlist[i] for i in indices]
-                return indices, labels
-
-            # heart rate
-            fig, ax = plt.subplots(figsize=(10, 3), dpi=300)
-            fig.patch.set_alpha(0)  # 設定整個 figure 背景為透明
-            ax.set_facecolor('none')  
-            ax.plot(rate_ts, heart)
-            ax.set_ylabel("Heart Rate")
-            idx, lbl = reduce_ticks(rate_ts)
-            ax.set_xticks(idx)
-            ax.set_xticklabels(lbl, rotation=30, fontsize=6)
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png', bbox_inches='tight', transparent=True)  # 啟用透明背景
-            # fig.savefig(buf, format="png")
-            plt.close(fig)
-            buf.seek(0)
-            heart_img_base64 = base64.b64encode(buf.read()).decode("utf-8")
-
-            # resp rate
-            fig, ax = plt.subplots(figsize=(10, 3), dpi=300)
-            fig.patch.set_alpha(0)  # 設定整個 figure 背景為透明
-            ax.set_facecolor('none')  
-            ax.plot(rate_ts, resp)
-            ax.set_ylabel("Resp Rate")
-            idx, lbl = reduce_ticks(rate_ts)
-            ax.set_xticks(idx)
-            ax.set_xticklabels(lbl, rotation=30, fontsize=6)
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png', bbox_inches='tight', transparent=True)
-            plt.close(fig)
-            buf.seek(0)
-            resp_img_base64 = base64.b64encode(buf.read()).decode("utf-8")
-
-            # status 彩色區塊圖（無折線）
-            fig, ax = plt.subplots(figsize=(10, 3), dpi=300)
-            fig.patch.set_alpha(0)  # 設定整個 figure 背景為透明
-            ax.set_facecolor('none')  
-            # 狀態與顏色對應
-            colors = {1: 'orange', 0: 'blue', -1: 'red'}
-            labels = {1: 'Movement', 0: 'Measuring', -1: 'Out of Bed'}
-            used = set()
-
-            # 畫每一格顏色區段
-            for i in range(len(status)):
-                color = colors.get(status[i], 'gray')
-                label = labels[status[i]] if status[i] not in used else None
-                ax.axvspan(i - 0.5, i + 0.5, color=color, alpha=0.5, label=label)
-                used.add(status[i])
-
-            # y 軸與 x 軸設定
-            ax.set_yticks([])
-            ax.set_ylabel("Status")
-            idx, lbl = reduce_ticks(status_ts)
-            ax.set_xticks(idx)
-            ax.set_xticklabels(lbl, rotation=30, fontsize=6)
-
-            # 加入圖例
-            ax.legend(loc="upper right", fontsize=6)
-
-            # 儲存圖片
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png', bbox_inches='tight', transparent=True)
-            plt.close(fig)
-            buf.seek(0)
-            status_img_base64 = base64.b64encode(buf.read()).decode("utf-8")
-
-            return {
-                "heart_image": heart_img_base64,
-                "resp_image": resp_img_base64,
-                "status_image": status_img_base64
-            }
-        else:
-            return {"heart_image": None,
-                "resp_image": None,
-                "status_image": None, "error": f"MCU {mcu_id} 回應錯誤: {response.status_code}"}
-    except RequestException as e:
-        return {"heart_image": None,
-                "resp_image": None,
-                "status_image": None, "error": f"MCU {mcu_id} 無法連線: {str(e)}"}
-
-@app.get("/historyplot/{mcu_id}")
-async def history_plot_mcu_data(mcu_id: str, startdate: str=Query(...), enddate: str=Query(...)):
-    file_path = '/app/snapshots'
-    from datetime import datetime, timedelta
-    from datetime import datetime as dt, timedelta
-    # 解析帶有時分的起訖時間
+def parse_history_range(startdate, enddate):
+    # 解析帶有時分的起訖時間（格式 YYYY-MM-DD HH-MM）
     start_dt = dt.strptime(startdate, "%Y-%m-%d %H-%M")
     end_dt = dt.strptime(enddate, "%Y-%m-%d %H-%M")
-    start_date = start_dt.strftime("%Y-%m-%d")
-    end_date = end_dt.strftime("%Y-%m-%d")
-
-    # Collect all data from start_date to end_date
-
-    def daterange(start_date_obj, end_date_obj):
-        for n in range(int((end_date_obj - start_date_obj).days) + 1):
-            yield start_date_obj + timedelta(n)
-
-    start_date_obj = datetime.strptime(start_date, "%Y-%m-%d")
-    end_date_obj = datetime.strptime(end_date, "%Y-%m-%d")
-
-    heart_all = []
-    resp_all = []
-    time_all = []
-    status_all = []
-    status_time_all = []
-
-    from collections import defaultdict
-    minute_data_map = defaultdict(list)  # key: HH:MM, value: list of (heart, resp)
-
-    for single_date in daterange(start_date_obj, end_date_obj):
-        date_str = single_date.strftime("%Y-%m-%d")
-        date_path = os.path.join(file_path, date_str)
-        if not os.path.exists(date_path):
-            continue
-        files = os.listdir(date_path)
-        collected_data = {}
-        for file in files:
-            if not file.endswith(".json"):
-                continue
-            try:
-                time = file.split('.')[0].split('_')[2]
-            except IndexError:
+    return start_dt, end_dt
+
+def device_day_exists(mcu_id, date, known=None):
+    """ whether a device has data on a date: the catalog answers for the dates it covers, the files for the rest """
+    if known is None:
+        known = device_dates(SNAPSHOT_ROOT, mcu_id, [date])
+    found = known.get(date)
+    if found or has_device_day(SNAPSHOT_ROOT, mcu_id, date):  # catalog 寫入失敗時檔案仍在
+        return True
+    if found is False:
+        return False  # catalog 有這天，但沒有這台
+    return os.path.exists(os.path.join(SNAPSHOT_ROOT, date))
+
+def history_dates(mcu_id, start_dt, end_dt):
+    """ dates of the range that may hold the device's data (one catalog lookup for the whole range) """
+    dates = [single_date.strftime("%Y-%m-%d") for single_date in daterange(start_dt.date(), end_dt.date())]
+    known = device_dates(SNAPSHOT_ROOT, mcu_id, dates)
+    # 原始紀錄過了保留期限後只剩 rollup（catalog 也已刪掉那幾天）
+    return [date_str for date_str in dates if device_day_exists(mcu_id, date_str, known)
+            or os.path.exists(rollup_path(SNAPSHOT_ROOT, mcu_id, date_str))]
+
+def history_fingerprint(mcu_id, dates):
+    sources = []
+    for date_str in dates:
+        sources += day_sources(SNAPSHOT_ROOT, mcu_id, date_str)
+        sources.append(rollup_path(SNAPSHOT_ROOT, mcu_id, date_str))
+    return file_fingerprint(sources)
+
+async def load_history_series(mcu_id, start_dt, end_dt, dates):
+    """ per-minute heart/resp averages and the status timeline between start_dt and end_dt (history_dates) """
+    file_path = SNAPSHOT_ROOT
+    status_runs = []  # (minute, runs)
+
+    minute_data_map = defaultdict(lambda: dict.fromkeys(SUM_FIELDS, 0))  # key: HH:MM, value: summed rollup row
+    start_epoch = int(start_dt.replace(tzinfo=taiwan_tz).timestamp())
+    end_epoch = int(end_dt.replace(tzinfo=taiwan_tz).timestamp())
+
+    for date_str in dates:
+        # 心率/呼吸每分鐘平均與 status runs 都直接取 rollup，沒有 rollup（或舊格式沒有 runs）才讀原始資料計算
+        rows = await asyncio.to_thread(load_rollup, file_path, mcu_id, date_str)
+        if rows is None or any("runs" not in row for row in rows):
+            sorted_data = await asyncio.to_thread(load_device_day, file_path, mcu_id, date_str)
+            rows = await asyncio.to_thread(rollup_from_records, sorted_data)
+        for row in rows:
+            if not (start_epoch <= row["minute"] <= end_epoch):
                 continue
-
-            async with aiofiles.open(os.path.join(date_path, file), mode='r') as f:
-                content = await f.read()
-                try:
-                    json_file = json.loads(content)
-                except json.JSONDecodeError:
-                    continue
-
-                if mcu_id in json_file:
-                    collected_data[time] = json_file[mcu_id]
-
-        from collections import OrderedDict
-        def time_key(t):
-            h, m, s = map(int, t.split('-'))
-            return h * 60 + m
-
-        sorted_data = OrderedDict(sorted(collected_data.items(), key=lambda x: time_key(x[0])))
-
-        for time, record in sorted_data.items():
-            time_min = record['timestamp']
-            heart_min = record['heart_rate']
-            resp_min = record['resp_rate']
-            mov_min = record['movement']
-            oob_min = record['outofbed']
-            for i in range(len(time_min)):
-                full_time_str = time_min[i]
-                try:
-                    current_dt = dt.strptime(full_time_str, "%Y-%m-%d %H:%M:%S")
-                except ValueError:
-                    continue  # skip malformed timestamp
-
-                if not (start_dt <= current_dt <= end_dt):
-                    continue
-
-                minute_str = current_dt.strftime("%H:%M")
-                minute_data_map[minute_str].append((heart_min[i], resp_min[i]))
-
-                if oob_min[i] == 1:
-                    status_all.append(-1)
-                elif mov_min[i] == 1:
-                    status_all.append(1)
-                else:
-                    status_all.append(0)
-                status_time_all.append(current_dt.strftime("%H:%M:%S"))
+            merged = minute_data_map[minute_str(row["minute"])]
+            for key in SUM_FIELDS:
+                merged[key] += row[key]
+            status_runs.append((row["minute"], row["runs"]))
 
     # 根據每分鐘聚合平均
     heart_all = []
@@ -389,73 +175,238 @@ async def history_plot_mcu_data(mcu_id: str, startdate: str=Query(...), enddate:
     time_all = []
 
     for minute in sorted(minute_data_map.keys()):
-        values = minute_data_map[minute]
-        heart_values = [v[0] for v in values if v[0] > 0]
-        resp_values = [v[1] for v in values if v[1] > 0]
-        heart_avg = np.mean(heart_values) if heart_values else 0
-        resp_avg = np.mean(resp_values) if resp_values else 0
+        heart_avg, resp_avg = minute_means(minute_data_map[minute])
         time_all.append(minute)
         heart_all.append(heart_avg)
         resp_all.append(resp_avg)
 
-    # 繪製心跳圖
-    fig, ax = plt.subplots(figsize=(10, 3), dpi=300)
-    fig.patch.set_alpha(0)
-    ax.set_facecolor('none')
-    ax.plot(time_all, heart_all)
-    ax.set_ylabel("Heart Rate")
-    idx = list(range(0, len(time_all), max(1, len(time_all)//10)))
-    ax.set_xticks(idx)
-    ax.set_xticklabels([time_all[i] for i in idx], rotation=30, fontsize=6)
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight', transparent=True)
-    plt.close(fig)
-    buf.seek(0)
-    heart_img_base64 = base64.b64encode(buf.read()).decode("utf-8")
-
-    # 繪製呼吸圖
-    fig, ax = plt.subplots(figsize=(10, 3), dpi=300)
-    fig.patch.set_alpha(0)
-    ax.set_facecolor('none')
-    ax.plot(time_all, resp_all)
-    ax.set_ylabel("Resp Rate")
-    idx = list(range(0, len(time_all), max(1, len(time_all)//10)))
-    ax.set_xticks(idx)
-    ax.set_xticklabels([time_all[i] for i in idx], rotation=30, fontsize=6)
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight', transparent=True)
-    plt.close(fig)
-    buf.seek(0)
-    resp_img_base64 = base64.b64encode(buf.read()).decode("utf-8")
-
-    # 繪製 status 圖（色條）
-    fig, ax = plt.subplots(figsize=(10, 3), dpi=300)
-    fig.patch.set_alpha(0)
-    ax.set_facecolor('none')
-    colors = {1: 'orange', 0: 'blue', -1: 'red'}
-    labels_map = {1: 'Movement', 0: 'Measuring', -1: 'Out of Bed'}
-    used = set()
-    for i in range(len(status_all)):
-        color = colors.get(status_all[i], 'gray')
-        label = labels_map[status_all[i]] if status_all[i] not in used else None
-        ax.axvspan(i - 0.5, i + 0.5, color=color, alpha=0.5, label=label)
-        used.add(status_all[i])
-    ax.set_yticks([])
-    ax.set_ylabel("Status")
-    idx = list(range(0, len(status_time_all), max(1, len(status_time_all)//10)))
-    ax.set_xticks(idx)
-    ax.set_xticklabels([status_time_all[i] for i in idx], rotation=30, fontsize=6)
-    ax.legend(loc="upper right", fontsize=6)
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight', transparent=True)
-    plt.close(fig)
-    buf.seek(0)
-    status_img_base64 = base64.b64encode(buf.read()).decode("utf-8")
+    timeline = StatusTimeline()
+    for _, runs in sorted(status_runs, key=lambda item: item[0]):
+        for run in runs:
+            timeline.add_run(*run)
+
+    return time_all, heart_all, resp_all, timeline
+
+def fetch_realtime_data(mcu_id):
+    """ realtime window of one MCU from the ingest service -> (data, error) """
+    try:
+        _, data = realtime_reader.read_realtime_data(mcu_id)
+    except (OSError, ValueError) as e:
+        print(f"⚠️ shared realtime window of {mcu_id} unreadable: {e}")
+        data = None
+    if data is not None:
+        REALTIME_FETCHES.labels("shm").inc()
+        return data, None
+    if os.path.isdir(realtime_reader.directory) and not realtime_reader.has_window(mcu_id):
+        # 共享目錄在但沒有這台的視窗檔：裝置沒連線，不必再問 ingest
+        REALTIME_FETCHES.labels("not_connected").inc()
+        return None, f"MCU {mcu_id} 未連線"
+    try:
+        response = requests.get(f"{INGEST_URL}/mcu_real_time_data/{mcu_id}", timeout=5)
+    except RequestException as e:
+        REALTIME_FETCHES.labels("error").inc()
+        return None, f"MCU {mcu_id} 無法連線: {str(e)}"
+    if response.status_code != 200:
+        REALTIME_FETCHES.labels("error").inc()
+        return None, f"MCU {mcu_id} 回應錯誤: {response.status_code}"
+    REALTIME_FETCHES.labels("http").inc()
+    return response.json(), None
+
+@app.get("/cache_stats")
+async def get_cache_stats():
+    return result_cache.snapshot_stats()
+
+@app.get("/render_stats")
+async def get_render_stats():
+    return render_pool.snapshot_stats()
+
+@app.get("/compactor_stats")
+async def get_compactor_stats():
+    return compactor.snapshot_stats()
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(render(), media_type=CONTENT_TYPE)
+
+@app.get("/debug/loop")
+async def get_loop_health(limit: int = 10):
+    return loop_monitor.snapshot(limit)
+
+async def send_file_range(f, start, length, chunk_size=64 * 1024):
+    try:
+        await f.seek(start)
+        while length > 0:
+            chunk = await f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await f.close()
 
+@app.get("/download/{mcu_id}")
+async def download_snapshot(mcu_id: str, date: str, request: Request):
+    if not await asyncio.to_thread(device_day_exists, mcu_id, date):
+        raise HTTPException(status_code=404, detail="指定日期資料不存在")
+    sources = await asyncio.to_thread(day_sources, SNAPSHOT_ROOT, mcu_id, date)
+    etag = export_etag(await asyncio.to_thread(file_fingerprint, sources))
+    headers = {"Content-Disposition": f"attachment; filename={mcu_id}_{date}.json.gz",
+               "ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) != etag:
+        range_header = None  # 檔案已經變了，續傳無效，改送整份
+    path = await asyncio.to_thread(cached_export, SNAPSHOT_ROOT, mcu_id, date, etag)
+    if path is None:
+        if not range_header:
+            print(f'MCU device {mcu_id} is streaming {date} data')
+            # 一分鐘一分鐘讀檔、組 JSON、壓縮後直接送出，同時寫進 export 快取
+            return StreamingResponse(stream_and_store(SNAPSHOT_ROOT, mcu_id, date, etag),
+                                     media_type='application/gzip', headers=headers)
+        path = await asyncio.to_thread(build_export, SNAPSHOT_ROOT, mcu_id, date, etag)
+
+    f = await aiofiles.open(path, "rb")
+    size = os.fstat(f.fileno()).st_size
+    start, end, status_code = 0, size - 1, 200
+    if range_header:
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            await f.close()
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        if byte_range:
+            (start, end), status_code = byte_range, 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(send_file_range(f, start, end - start + 1), status_code=status_code,
+                             media_type='application/gzip', headers=headers)
+
+@app.get("/analysis/{mcu_id}")
+async def analysis_mcu_data(mcu_id: str, date: str):
+    if not await asyncio.to_thread(device_day_exists, mcu_id, date):
+        raise HTTPException(status_code=404, detail="指定日期資料不存在")
+    sources = await asyncio.to_thread(day_sources, SNAPSHOT_ROOT, mcu_id, date)
+    cache_key = ("analysis", mcu_id, date, await asyncio.to_thread(file_fingerprint, sources))
+    cached = await asyncio.to_thread(result_cache.get, cache_key)
+    if cached is not None:
+        return cached
+    print(f'MCU device {mcu_id} is processing {date} data')
+    sorted_data = await asyncio.to_thread(load_device_day, SNAPSHOT_ROOT, mcu_id, date)
+    timestamps_status, hearts, resps, status = analysis_series(sorted_data)
+    result = await render_charts(analysis_charts, mcu_id, date, timestamps_status, hearts, resps, status)
+    print(f'MCU device {mcu_id} processing {date} data finished')
+    await asyncio.to_thread(result_cache.put, cache_key, result)
+    return result
+
+@app.get("/realtime/{mcu_id}")
+async def real_time_figure_mcu_data(mcu_id: str):
+    data, error = await asyncio.to_thread(fetch_realtime_data, mcu_id)
+    if error:
+        return {"heart_image": None,
+                "resp_image": None,
+                "status_image": None, "error": error}
+    # status 以連續區段繪製，只把區段與 tick 傳給繪圖 worker
+    status_ts = data.get("status_timestamp", [])
+    ticks = tick_indices(len(status_ts))
+    return await render_charts(realtime_charts, data.get("heart_rate", []), data.get("resp_rate", []),
+                               data.get("rate_timestamp", []), run_lengths(data.get("status", [])),
+                               ticks, [status_ts[i] for i in ticks])
+
+@app.get("/historyplot/{mcu_id}")
+async def history_plot_mcu_data(mcu_id: str, startdate: str=Query(...), enddate: str=Query(...)):
+    start_dt, end_dt = parse_history_range(startdate, enddate)
+    dates = await asyncio.to_thread(history_dates, mcu_id, start_dt, end_dt)
+    cache_key = ("historyplot", mcu_id, startdate, enddate,
+                 await asyncio.to_thread(history_fingerprint, mcu_id, dates))
+    cached = await asyncio.to_thread(result_cache.get, cache_key)
+    if cached is not None:
+        return cached
+
+    time_all, heart_all, resp_all, timeline = await load_history_series(mcu_id, start_dt, end_dt, dates)
+    ticks = tick_indices(timeline.total)
+    result = await render_charts(history_charts, time_all, heart_all, resp_all, timeline.spans(),
+                                 ticks, [format_time(timeline.time_at(i), "%H:%M:%S") for i in ticks])
+    await asyncio.to_thread(result_cache.put, cache_key, result)
+    return result
+
+
+# 時序資料 API：回傳降採樣後的陣列，讓前端自行繪圖（取代 base64 PNG）
+@app.get("/series/analysis/{mcu_id}")
+async def analysis_series_data(mcu_id: str, date: str, points: int = Query(1000, ge=3, le=20000),
+                               method: str = Query("lttb", pattern="^(lttb|minmax)$")):
+    if not await asyncio.to_thread(device_day_exists, mcu_id, date):
+        raise HTTPException(status_code=404, detail="指定日期資料不存在")
+    sources = await asyncio.to_thread(day_sources, SNAPSHOT_ROOT, mcu_id, date)
+    cache_key = ("series/analysis", mcu_id, date, points, method, await asyncio.to_thread(file_fingerprint, sources))
+    cached = await asyncio.to_thread(result_cache.get, cache_key)
+    if cached is not None:
+        return cached
+    sorted_data = await asyncio.to_thread(load_device_day, SNAPSHOT_ROOT, mcu_id, date)
+    timestamps_status, hearts, resps, status = analysis_series(sorted_data)
+    result = {
+        "heart_rate": downsample(timestamps_status, hearts, points, method),
+        "resp_rate": downsample(timestamps_status, resps, points, method),
+        "status": {"intervals": labelled_intervals(status, timestamps_status), "total": len(status)},
+    }
+    await asyncio.to_thread(result_cache.put, cache_key, result)
+    return result
+
+@app.get("/series/realtime/{mcu_id}")
+async def real_time_series_data(mcu_id: str, points: int = Query(1000, ge=3, le=20000),
+                                method: str = Query("lttb", pattern="^(lttb|minmax)$")):
+    data, error = await asyncio.to_thread(fetch_realtime_data, mcu_id)
+    if error:
+        return {"heart_rate": None, "resp_rate": None, "status": None, "error": error}
+    rate_ts = data.get("rate_timestamp", [])
+    status_ts = data.get("status_timestamp", [])
     return {
-        "heart_image": heart_img_base64,
-        "resp_image": resp_img_base64,
-        "status_image": status_img_base64
+        "heart_rate": downsample(rate_ts, data.get("heart_rate", []), points, method),
+        "resp_rate": downsample(rate_ts, data.get("resp_rate", []), points, method),
+        "status": {"intervals": labelled_intervals(data.get("status", []), status_ts), "total": len(status_ts)},
+    }
+
+@app.get("/series/historyplot/{mcu_id}")
+async def history_series_data(mcu_id: str, startdate: str=Query(...), enddate: str=Query(...),
+                              points: int = Query(1000, ge=3, le=20000),
+                              method: str = Query("lttb", pattern="^(lttb|minmax)$")):
+    start_dt, end_dt = parse_history_range(startdate, enddate)
+    dates = await asyncio.to_thread(history_dates, mcu_id, start_dt, end_dt)
+    cache_key = ("series/historyplot", mcu_id, startdate, enddate, points, method,
+                 await asyncio.to_thread(history_fingerprint, mcu_id, dates))
+    cached = await asyncio.to_thread(result_cache.get, cache_key)
+    if cached is not None:
+        return cached
+    time_all, heart_all, resp_all, timeline = await load_history_series(mcu_id, start_dt, end_dt, dates)
+    result = {
+        "heart_rate": downsample(time_all, heart_all, points, method),
+        "resp_rate": downsample(time_all, resp_all, points, method),
+        "status": {"intervals": timeline.intervals(), "total": timeline.total},
     }
+    await asyncio.to_thread(result_cache.put, cache_key, result)
+    return result
+
+
+# catalog 查詢：走 SQLite 索引（mcu_id, ts），不列目錄、不解析資料檔
+@app.get("/catalog/devices")
+async def catalog_devices(date: str):
+    try:
+        dt.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日期格式應為 YYYY-MM-DD")
+    rows = await asyncio.to_thread(devices_on, SNAPSHOT_ROOT, date)
+    return {"date": date, "devices": rows}
+
+@app.get("/catalog/minutes/{mcu_id}")
+async def catalog_minutes(mcu_id: str, startdate: str=Query(...), enddate: str=Query(...)):
+    start_dt, end_dt = parse_history_range(startdate, enddate)
+    start_epoch = int(start_dt.replace(tzinfo=taiwan_tz).timestamp())
+    end_epoch = int(end_dt.replace(tzinfo=taiwan_tz).timestamp())
+    rows = await asyncio.to_thread(minutes_between, SNAPSHOT_ROOT, mcu_id, start_epoch, end_epoch)
+    # ts 是分鐘檔的時間（樣本在 ts 前 60 秒內），time 與 historyplot 一樣標樣本所在的分鐘
+    return {"mcu_id": mcu_id, "minutes": [
+        {"ts": row["ts"], "time": minute_str(row["ts"] - 60), "samples": row["samples"],
+         "measuring": row["measuring"], "movement": row["movement"], "oob": row["oob"]} for row in rows]}
 
 app = sio_app
\ No newline at end of file
@@ -0,0 +1,232 @@
+"""
+Coalesced Socket.IO broadcast of the MCU status board (data_frontend).
+
+The TCP server calls notify() after every frame; that only marks the
+board dirty. Every BROADCAST_TICK seconds the ticker diffs the board
+against what it sent last and emits one message with the changes:
+
+    mcu_update: {"seq": n, "changes": {addr: {field: value}}, "removed": [addr]}
+
+seq increases by one per message. A client that sees a gap (or just
+connected) emits "mcu_resync" and gets the whole board back:
+
+    mcu_update: {"seq": n, "full": {addr: {...}}}
+
+Detail pages subscribe to one device instead ("subscribe"/"unsubscribe"
+with {"mcu_id"}, room "mcu:{mcu_id}") and only get that device's data:
+
+    mcu_state:      {"mcu_id", "seq", "full": {...}} on subscribe, then {"mcu_id", "seq", "changes": {...}}
+    mcu_realtime:   {"mcu_id", "full": window} on subscribe, then {"mcu_id", "append": {column: [new values]}}
+    mcu_disconnect: {"id": mcu_id}
+"""
+import os
+import time
+import asyncio
+import traceback
+
+from snapshot_store import format_epochs
+from metrics import Histogram, FAST_BUCKETS
+
+EMIT_SECONDS = Histogram("broadcast_tick_seconds", "Diff and emit of one broadcast tick (board + rooms)",
+                         buckets=FAST_BUCKETS + (0.25, 0.5, 1.0))
+
+TIMESTAMP_COLUMNS = ('rate_timestamp', 'status_timestamp')
+
+
+def room_of(mcu_id):
+    return f"mcu:{mcu_id}"
+
+
+class BroadcastTicker:
+    def __init__(self, sio, source, event='mcu_update', tick=None, realtime_source=None, realtime_key=None):
+        self.sio = sio
+        self.source = source  # () -> current board {addr: {field: value}}
+        self.realtime_source = realtime_source  # mcu_id -> {column: RingBuffer} or None
+        # mcu_id -> identity of the window realtime_source just returned (changes on reconnect)
+        self.realtime_key = realtime_key
+        self.subscribers = {}  # mcu_id -> set(sid)
+        self.room_seq = {}  # mcu_id -> seq of its mcu_state messages
+        self.realtime_seen = {}  # mcu_id -> (window key, {column: appended}) already pushed
+        self.event = event
+        self.tick = tick or float(os.environ.get("BROADCAST_TICK", "1.0"))
+        self.seq = 0
+        self.sent = {}  # addr -> fields as last broadcast
+        self._removed_names = []
+        self.dirty = asyncio.Event()
+        self.running = False
+        self.stats = {"notified": 0, "messages": 0, "resyncs": 0, "changed_fields": 0,
+                      "room_messages": 0, "realtime_appends": 0}
+
+    def notify(self, data=None):
+        """ AsyncTCPServer callback: only remember that something changed """
+        self.stats["notified"] += 1
+        self.dirty.set()
+
+    def diff(self):
+        """ (changes, removed) of the board since the last broadcast; updates what counts as sent """
+        board = self.source()
+        changes = {}
+        for addr, fields in board.items():
+            last = self.sent.get(addr, {})
+            changed = {k: v for k, v in fields.items() if last.get(k) != v or k not in last}
+            if changed:
+                changes[addr] = changed
+                self.sent[addr] = dict(fields)
+        removed = [addr for addr in self.sent if addr not in board]
+        self._removed_names = [self.sent[addr].get("name") for addr in removed]
+        for addr in removed:
+            del self.sent[addr]
+        return changes, removed
+
+    def device_state(self, mcu_id):
+        for fields in self.sent.values():
+            if fields.get("name") == mcu_id:
+                return fields
+        return None
+
+    async def subscribe(self, sid, mcu_id):
+        await self.sio.enter_room(sid, room_of(mcu_id))
+        self.subscribers.setdefault(mcu_id, set()).add(sid)
+        # 先送一份完整狀態，之後只送變動
+        seq = self.room_seq.get(mcu_id, 0)
+        await self.sio.emit("mcu_state", {"mcu_id": mcu_id, "seq": seq, "full": self.device_state(mcu_id)}, to=sid)
+        window = self.realtime_window(mcu_id)
+        if window is not None:
+            await self.sio.emit("mcu_realtime", {"mcu_id": mcu_id, "full": window}, to=sid)
+
+    async def unsubscribe(self, sid, mcu_id):
+        await self.sio.leave_room(sid, room_of(mcu_id))
+        self._forget(sid, mcu_id)
+
+    def drop(self, sid):
+        """ client disconnected """
+        for mcu_id in list(self.subscribers):
+            self._forget(sid, mcu_id)
+
+    def _forget(self, sid, mcu_id):
+        sids = self.subscribers.get(mcu_id)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self.subscribers[mcu_id]
+                self.realtime_seen.pop(mcu_id, None)
+
+    def realtime_window(self, mcu_id):
+        """
+        realtime window of a device for a new subscriber, up to the room's
+        cursor: values appended since the last tick reach everyone (the new
+        sid included) with the next append, so nobody misses or repeats them
+        """
+        rings, key = self._realtime_rings(mcu_id)
+        if rings is None:
+            return None
+        seen = self.realtime_seen.get(mcu_id)
+        if seen is None:
+            return self._full_window(mcu_id, rings, key)  # 房間第一個訂閱者，從現在開始算
+        window = {}
+        same = not self._recreated(seen, rings, key)
+        for col, ring in rings.items():
+            values = ring.view()
+            if same:
+                pending = ring.appended - seen[1][col]
+                if pending > 0:
+                    values = values[:max(0, len(values) - pending)]
+            # window 重建過的話下一個 tick 會整份送給整個房間
+            window[col] = self._column(col, values)
+        return window
+
+    def _realtime_rings(self, mcu_id):
+        """ (rings, window key) of a device; a gone device forgets the room's cursor """
+        rings = self.realtime_source(mcu_id) if self.realtime_source else None
+        if rings is None:
+            self.realtime_seen.pop(mcu_id, None)  # 重新連線的 window 一定整份送
+            return None, None
+        return rings, self.realtime_key(mcu_id) if self.realtime_key else None
+
+    @staticmethod
+    def _recreated(seen, rings, key):
+        """ the cursor belongs to another window (reconnect), whatever the ring objects' addresses are """
+        key_seen, appended = seen
+        if key_seen != key or appended.keys() != rings.keys():
+            return True
+        return any(ring.appended < appended[col] for col, ring in rings.items())
+
+    def _full_window(self, mcu_id, rings, key):
+        """ whole window, and move the room's cursor to it """
+        self.realtime_seen[mcu_id] = (key, {col: ring.appended for col, ring in rings.items()})
+        return {col: self._column(col, ring.view()) for col, ring in rings.items()}
+
+    def realtime_appends(self, mcu_id):
+        """ {column: values appended since the last push}; a recreated window is sent whole """
+        rings, key = self._realtime_rings(mcu_id)
+        if rings is None:
+            return None, None
+        seen = self.realtime_seen.get(mcu_id)
+        if seen is None or self._recreated(seen, rings, key):
+            return None, self._full_window(mcu_id, rings, key)
+        append = {}
+        for col, ring in rings.items():
+            new = ring.appended - seen[1][col]
+            if new > 0:
+                append[col] = self._column(col, ring.tail(new))
+            seen[1][col] = ring.appended
+        return append, None
+
+    @staticmethod
+    def _column(col, values):
+        return format_epochs(values) if col in TIMESTAMP_COLUMNS else values.tolist()
+
+    async def publish_rooms(self, changes):
+        """ per-device messages for the subscribed rooms """
+        by_name = {}
+        for addr, changed in changes.items():
+            mcu_id = self.sent[addr].get("name")
+            if mcu_id in self.subscribers:
+                by_name[mcu_id] = changed
+        for mcu_id, changed in by_name.items():
+            self.room_seq[mcu_id] = self.room_seq.get(mcu_id, 0) + 1
+            self.stats["room_messages"] += 1
+            await self.sio.emit("mcu_state", {"mcu_id": mcu_id, "seq": self.room_seq[mcu_id], "changes": changed},
+                                room=room_of(mcu_id))
+        for mcu_id in self._removed_names:
+            if mcu_id in self.subscribers:
+                await self.sio.emit("mcu_disconnect", {"id": mcu_id}, room=room_of(mcu_id))
+        for mcu_id in list(self.subscribers):
+            append, full = self.realtime_appends(mcu_id)
+            if full is not None:
+                await self.sio.emit("mcu_realtime", {"mcu_id": mcu_id, "full": full}, room=room_of(mcu_id))
+            elif append:
+                self.stats["realtime_appends"] += 1
+                await self.sio.emit("mcu_realtime", {"mcu_id": mcu_id, "append": append}, room=room_of(mcu_id))
+
+    def full_message(self):
+        return {"seq": self.seq, "full": {addr: dict(fields) for addr, fields in self.sent.items()}}
+
+    async def resync(self, sid):
+        self.stats["resyncs"] += 1
+        await self.sio.emit(self.event, self.full_message(), to=sid)
+
+    async def run(self):
+        self.running = True
+        while self.running:
+            await self.dirty.wait()
+            self.dirty.clear()
+            start = time.perf_counter()
+            try:
+                changes, removed = self.diff()
+                if changes or removed:
+                    self.seq += 1
+                    self.stats["messages"] += 1
+                    self.stats["changed_fields"] += sum(len(c) for c in changes.values())
+                    await self.sio.emit(self.event, {"seq": self.seq, "changes": changes, "removed": removed})
+                if self.subscribers:
+                    await self.publish_rooms(changes)
+            except Exception as e:
+                print(f"⚠️ broadcast tick failed: {e}")
+                traceback.print_exc()
+            EMIT_SECONDS.observe(time.perf_counter() - start)
+            await asyncio.sleep(self.tick)
+
+    def stop(self):
+        self.running = False
+        self.dirty.set()
@@ -0,0 +1,319 @@
+"""
+SQLite catalog of the stored minutes: {snapshot_dir}/catalog.sqlite
+
+One row per device-minute, written by the snapshot writer as each minute
+is flushed:
+    (mcu_id, ts, date, file, offset, length, samples, measuring, movement, oob)
+ts is the minute epoch (samples in [ts - 60, ts)), file is relative to
+the snapshot root, offset/length the record's byte range in a .rec file
+(NULL once compactor.py folded it into a .day), and the last three count
+the minute's samples by status. The primary key (mcu_id, ts) is the index
+for "minutes of bed X between T1 and T2"; minutes_by_date answers "which
+beds had data on this date" without touching the data files.
+
+WAL mode: the ingest writer(s), the compactor and the download service
+use the same file at once; readers are never blocked by the writer.
+CATALOG=0 turns the writes off; without a catalog file the queries read
+the device files instead. The catalog is only an index, so
+    python catalog.py rebuild [--root /app/snapshots] [--date YYYY-MM-DD]
+recreates it from the device files at any time, and the compactor
+indexes closed device-days that have no rows yet.
+"""
+import os
+import sys
+import sqlite3
+import argparse
+import threading
+import numpy as np
+from datetime import datetime, timedelta
+from urllib.parse import unquote
+
+from device_store import (DEVICES_DIR, device_day_path, device_archive_path, iter_records, read_record,
+                          iter_device_minutes)
+from snapshot_store import taiwan_tz
+from metrics import Counter
+
+CATALOG = os.environ.get("CATALOG", "1") == "1"
+CATALOG_FILE = "catalog.sqlite"
+BUSY_TIMEOUT_MS = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS minutes (
+    mcu_id    TEXT NOT NULL,
+    ts        INTEGER NOT NULL,
+    date      TEXT NOT NULL,
+    file      TEXT NOT NULL,
+    offset    INTEGER,
+    length    INTEGER,
+    samples   INTEGER NOT NULL,
+    measuring INTEGER NOT NULL,
+    movement  INTEGER NOT NULL,
+    oob       INTEGER NOT NULL,
+    PRIMARY KEY (mcu_id, ts)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS minutes_by_date ON minutes (date, mcu_id);
+"""
+COLUMNS = ("mcu_id", "ts", "date", "file", "offset", "length", "samples", "measuring", "movement", "oob")
+INSERT = f"INSERT OR REPLACE INTO minutes ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+
+CATALOG_ERRORS = Counter("catalog_errors_total", "Catalog writes that failed (the data files are still written)")
+
+_local = threading.local()  # 每個執行緒各自的連線，{root: sqlite3.Connection}
+
+
+def catalog_path(root):
+    return os.path.join(root, CATALOG_FILE)
+
+
+def connect(root, readonly=False):
+    """ a connection to the catalog of `root`; read-only ones return None while there is no catalog yet """
+    path = catalog_path(root)
+    if readonly:
+        if not os.path.exists(path):
+            return None
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=BUSY_TIMEOUT_MS / 1000)
+    else:
+        os.makedirs(root, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # WAL 下斷電最多掉最後幾筆，catalog 可以重建
+        conn.executescript(SCHEMA)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def connection(root):
+    """ this thread's read-write connection (the snapshot writer and the compactor keep theirs open) """
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(root)
+    if conn is None:
+        conn = conns[root] = connect(root)
+    return conn
+
+
+def summarize(columns):
+    """ (samples, measuring, movement, oob) of one device-minute, same split as the rollup """
+    oob = np.asarray(columns.get("outofbed", ())) == 1
+    mov = (np.asarray(columns.get("movement", ())) == 1) & ~oob
+    samples = len(columns.get("timestamp", ()))
+    n_oob, n_mov = int(oob.sum()), int(mov.sum())
+    return samples, samples - n_oob - n_mov, n_mov, n_oob
+
+
+def minute_row(root, mcu_id, date, minute_epoch, path, offset, length, columns):
+    return (mcu_id, int(minute_epoch), date, os.path.relpath(path, root), offset, length) + summarize(columns)
+
+
+def add_minutes(root, rows):
+    """ record flushed device-minutes (minute_row tuples) in one transaction; failures are logged, not raised """
+    if not CATALOG or not rows:
+        return
+    try:
+        conn = connection(root)
+        with conn:
+            conn.executemany(INSERT, rows)
+    except sqlite3.Error as e:
+        CATALOG_ERRORS.inc()
+        print(f"⚠️ catalog write failed: {e}")
+
+
+def index_device_day(conn, root, mcu_id, date):
+    """ (re)index one device-day from its .day archive or .rec file, returns the number of minutes """
+    rows = []
+    archive = device_archive_path(root, mcu_id, date)
+    if os.path.exists(archive):
+        for minute_epoch, columns in iter_device_minutes(root, mcu_id, date):
+            rows.append(minute_row(root, mcu_id, date, minute_epoch, archive, None, None, columns))
+    else:
+        path = device_day_path(root, mcu_id, date)
+        if os.path.exists(path):
+            # 重複的分鐘由 INSERT OR REPLACE 留下最後一筆，與讀取端相同
+            for _, offset, length in iter_records(path):
+                minute_epoch, columns = read_record(path, offset, length)
+                rows.append(minute_row(root, mcu_id, date, minute_epoch, path, offset, length, columns))
+    with conn:
+        conn.execute("DELETE FROM minutes WHERE date = ? AND mcu_id = ?", (date, mcu_id))
+        conn.executemany(INSERT, rows)
+    return len(rows)
+
+
+def forget(conn, mcu_id, date):
+    with conn:
+        conn.execute("DELETE FROM minutes WHERE date = ? AND mcu_id = ?", (date, mcu_id))
+
+
+def reindex(root, mcu_id, date):
+    """ index_device_day() for the compactor; failures are logged, not raised """
+    if not CATALOG:
+        return
+    try:
+        index_device_day(connection(root), root, mcu_id, date)
+    except sqlite3.Error as e:
+        CATALOG_ERRORS.inc()
+        print(f"⚠️ catalog reindex of {mcu_id} {date} failed: {e}")
+
+
+def drop(root, mcu_id, date):
+    """ forget() for the compactor's retention; failures are logged, not raised """
+    if not CATALOG:
+        return
+    try:
+        forget(connection(root), mcu_id, date)
+    except sqlite3.Error as e:
+        CATALOG_ERRORS.inc()
+        print(f"⚠️ catalog cleanup of {mcu_id} {date} failed: {e}")
+
+
+def backfill(root, before):
+    """ index device-days older than `before` that have files but no rows (data from before the catalog) """
+    if not CATALOG:
+        return 0
+    conn = connection(root)
+    count = 0
+    for name, date in _device_days(root):
+        if date >= before:
+            continue
+        mcu_id = unquote(name)
+        if conn.execute("SELECT 1 FROM minutes WHERE date = ? AND mcu_id = ? LIMIT 1", (date, mcu_id)).fetchone():
+            continue
+        count += index_device_day(conn, root, mcu_id, date)
+    return count
+
+
+def _device_days(root):
+    """ (quoted device dir name, date) of every device file """
+    devices_root = os.path.join(root, DEVICES_DIR)
+    for name in sorted(os.listdir(devices_root)) if os.path.isdir(devices_root) else []:
+        dates = {f[:-4] for f in os.listdir(os.path.join(devices_root, name)) if f.endswith((".rec", ".day"))}
+        for date in sorted(dates):
+            yield name, date
+
+
+def devices_on(root, date):
+    """ [{"mcu_id", "minutes", "samples", "first", "last"}] of one date """
+    conn = connect(root, readonly=True)
+    if conn is None:
+        return _scan_devices_on(root, date)
+    try:
+        rows = conn.execute("SELECT mcu_id, COUNT(*) AS minutes, SUM(samples) AS samples, MIN(ts) AS first, "
+                            "MAX(ts) AS last FROM minutes WHERE date = ? GROUP BY mcu_id ORDER BY mcu_id",
+                            (date,)).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def device_dates(root, mcu_id, dates):
+    """
+    {date: whether mcu_id has minutes} for the `dates` the catalog covers
+    (has rows of any device); dates it does not cover, or every date
+    without a catalog, are left out so the caller looks at the files
+    """
+    dates = list(dates)
+    conn = connect(root, readonly=True) if dates else None
+    if conn is None:
+        return {}
+    try:
+        known = {}
+        for date in dates:
+            # 兩次都只走 minutes_by_date 索引的開頭，不掃整天的列
+            covered, found = conn.execute(
+                "SELECT EXISTS(SELECT 1 FROM minutes WHERE date = ?), "
+                "EXISTS(SELECT 1 FROM minutes WHERE date = ? AND mcu_id = ?)", (date, date, mcu_id)).fetchone()
+            if covered:
+                known[date] = bool(found)
+        return known
+    except sqlite3.Error as e:
+        CATALOG_ERRORS.inc()
+        print(f"⚠️ catalog lookup failed: {e}")
+        return {}
+    finally:
+        conn.close()
+
+
+def minutes_between(root, mcu_id, start_epoch, end_epoch):
+    """ catalog rows of one device whose minute overlaps [start_epoch, end_epoch] """
+    conn = connect(root, readonly=True)
+    if conn is None:
+        return _scan_minutes(root, mcu_id, start_epoch, end_epoch)
+    try:
+        rows = conn.execute("SELECT * FROM minutes WHERE mcu_id = ? AND ts > ? AND ts < ? ORDER BY ts",
+                            (mcu_id, start_epoch, end_epoch + 60)).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+
+# ---- 還沒有 catalog 時（CATALOG=0 或尚未建立）直接讀裝置檔，結果相同 ----
+
+def _scan_rows(root, mcu_id, date):
+    archive = device_archive_path(root, mcu_id, date)
+    path = archive if os.path.exists(archive) else device_day_path(root, mcu_id, date)
+    rows = {}
+    for minute_epoch, columns in iter_device_minutes(root, mcu_id, date):
+        row = minute_row(root, mcu_id, date, minute_epoch, path, None, None, columns)
+        rows[row[1]] = dict(zip(COLUMNS, row))
+    return [rows[ts] for ts in sorted(rows)]
+
+
+def _scan_devices_on(root, date):
+    result = []
+    for name, day in _device_days(root):
+        if day != date:
+            continue
+        rows = _scan_rows(root, unquote(name), date)
+        if rows:
+            result.append({"mcu_id": unquote(name), "minutes": len(rows), "samples": sum(r["samples"] for r in rows),
+                           "first": rows[0]["ts"], "last": rows[-1]["ts"]})
+    return sorted(result, key=lambda r: r["mcu_id"])
+
+
+def _scan_minutes(root, mcu_id, start_epoch, end_epoch):
+    day = datetime.fromtimestamp(start_epoch, taiwan_tz).date()
+    last = datetime.fromtimestamp(end_epoch + 60, taiwan_tz).date()
+    rows = []
+    while day <= last:
+        rows += [row for row in _scan_rows(root, mcu_id, day.strftime("%Y-%m-%d"))
+                 if start_epoch < row["ts"] < end_epoch + 60]
+        day += timedelta(days=1)
+    return rows
+
+
+def rebuild(root, dates=None):
+    """ index every device-day (or those of `dates`) from the device files """
+    conn = connect(root)
+    count = 0
+    try:
+        for name, date in _device_days(root):
+            if not dates or date in dates:
+                count += index_device_day(conn, root, unquote(name), date)
+        if not dates:
+            # 已經沒有裝置檔的舊資料
+            for row in conn.execute("SELECT DISTINCT mcu_id, date FROM minutes").fetchall():
+                if not os.path.exists(device_archive_path(root, row["mcu_id"], row["date"])) and \
+                        not os.path.exists(device_day_path(root, row["mcu_id"], row["date"])):
+                    forget(conn, row["mcu_id"], row["date"])
+    finally:
+        conn.close()
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild or inspect the minute catalog of /app/snapshots")
+    parser.add_argument("command", choices=["rebuild", "devices"])
+    parser.add_argument("--root", default="/app/snapshots")
+    parser.add_argument("--date", action="append", help="YYYY-MM-DD, repeatable (default: every date)")
+    args = parser.parse_args(argv)
+
+    if args.command == "rebuild":
+        print(f"✅ indexed {rebuild(args.root, args.date)} device-minutes")
+        return
+    for date in args.date or []:
+        for row in devices_on(args.root, date) or []:
+            print(f"{date} {row['mcu_id']}: {row['minutes']} minutes, {row['samples']} samples")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+Chart rendering for the download service. Every function here is a
+plain top-level function taking plain lists, so it can run inside a
+render_pool worker process and return {name: base64 png}.
+"""
+import io
+import base64
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+STATUS_COLORS = {1: 'orange', 0: 'blue', -1: 'red'}
+STATUS_LABELS = {1: 'Movement', 0: 'Measuring', -1: 'Out of Bed'}
+
+
+def warm_up():
+    """ load Agg, the font cache and the text layout once per worker """
+    fig, ax = plt.subplots(figsize=(1, 1), dpi=72)
+    ax.plot([0, 1], [0, 1])
+    ax.set_title("warm up", fontsize=6)
+    fig.savefig(io.BytesIO(), format='png')
+    plt.close(fig)
+
+
+def png_base64(fig, **savefig_kwargs):
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', **savefig_kwargs)
+    plt.close(fig)
+    return base64.b64encode(buf.getvalue()).decode('utf-8')
+
+
+def _status_strip(ax, spans, ticks, tick_labels):
+    """ status color strip from run-length intervals [(state, start, end)], one broken_barh per state """
+    by_state = {}
+    for state, start, end in spans:
+        by_state.setdefault(state, []).append((start - 0.5, end - start))
+    for state, ranges in by_state.items():
+        ax.broken_barh(ranges, (0, 1), color=STATUS_COLORS.get(state, 'gray'), alpha=0.5,
+                       label=STATUS_LABELS.get(state))
+    ax.set_ylim(0, 1)
+    ax.set_yticks([])
+    ax.set_ylabel("Status")
+    ax.set_xticks(ticks)
+    ax.set_xticklabels(tick_labels, rotation=30, fontsize=6)
+    ax.legend(loc="upper right", fontsize=6)
+
+
+def analysis_charts(mcu_id, date, timestamps_status, hearts, resps, status):
+    """ /analysis: heart, resp and status line charts of one device-day """
+    if len(hearts) < 48:
+        interval_status = len(hearts)
+    else:
+        interval_status = len(hearts)//24
+    labels = [str(timestamps_status[i]) if i%interval_status==0 else '' for i in range(len(timestamps_status))]
+    images = {}
+    for key, values, name in (("heart_image", hearts, "heartrate"), ("resp_image", resps, "resprate")):
+        fig, ax = plt.subplots(figsize=(10, 5), dpi=300)
+        ax.plot(timestamps_status, values)
+        ax.set_title(f'MCU device {mcu_id} {date} {name}', fontsize=6)
+        ax.set_ylabel(name)
+        ax.yaxis.label.set_fontsize(6)
+        ax.set_xlabel('time')
+        ax.xaxis.label.set_fontsize(6)
+        ax.set_xticks(ticks=range(len(timestamps_status)))
+        ax.set_xticklabels(labels, rotation=30)
+        ax.tick_params(axis='x', labelsize=6)
+        ax.tick_params(axis='y', labelsize=6)
+        images[key] = png_base64(fig)
+
+    interval_status = len(status)//24
+    labels = [str(timestamps_status[i]) if i%interval_status==0 else '' for i in range(len(timestamps_status))]
+    # status
+    fig, ax = plt.subplots(figsize=(10, 5), dpi=300)
+    ax.plot(timestamps_status, status)
+    ax.set_ylabel('status')
+    ax.yaxis.label.set_fontsize(6)
+    ax.set_xlabel('time')
+    ax.xaxis.label.set_fontsize(6)
+    ax.set_yticks(ticks=[-1, 0, 1])
+    ax.set_ylim(-2, 2)
+    ax.set_yticklabels(['out of bed', 'measuring', 'movement'])
+    ax.tick_params(axis='y', labelsize=6)
+    ax.set_xticks(ticks=range(len(timestamps_status)))
+    ax.set_xticklabels(labels, rotation=30)
+    ax.tick_params(axis='x', labelsize=6)
+    ax.set_title(f'MCU device {mcu_id} {date} status', fontsize=6)
+    images["status_image"] = png_base64(fig)
+    return images
+
+
+def realtime_charts(heart, resp, rate_ts, status_spans, status_ticks, status_tick_labels):
+    """ /realtime: transparent heart/resp line charts and the status color strip """
+    # 限制 x 軸 ticks 數量最多 10 個
+    def reduce_ticks(xlist):
+        if len(xlist) <= 10:
+            return list(range(len(xlist))), xlist
+        step = len(xlist) // 10
+        indices = list(range(0, len(xlist), step))
+        labels = [xlist[i] for i in indices]
+        return indices, labels
+
+    images = {}
+    for key, values, ylabel in (("heart_image", heart, "Heart Rate"), ("resp_image", resp, "Resp Rate")):
+        fig, ax = plt.subplots(figsize=(10, 3), dpi=300)
+        fig.patch.set_alpha(0)  # 設定整個 figure 背景為透明
+        ax.set_facecolor('none')
+        ax.plot(rate_ts, values)
+        ax.set_ylabel(ylabel)
+        idx, lbl = reduce_ticks(rate_ts)
+        ax.set_xticks(idx)
+        ax.set_xticklabels(lbl, rotation=30, fontsize=6)
+        images[key] = png_base64(fig, bbox_inches='tight', transparent=True)
+
+    # status 彩色區塊圖（無折線）
+    fig, ax = plt.subplots(figsize=(10, 3), dpi=300)
+    fig.patch.set_alpha(0)
+    ax.set_facecolor('none')
+    _status_strip(ax, status_spans, status_ticks, status_tick_labels)
+    images["status_image"] = png_base64(fig, bbox_inches='tight', transparent=True)
+    return images
+
+
+def history_charts(time_all, heart_all, resp_all, status_spans, status_ticks, status_tick_labels):
+    """ /historyplot: per-minute heart/resp over a date range plus the status color strip """
+    images = {}
+    for key, values, ylabel in (("heart_image", heart_all, "Heart Rate"), ("resp_image", resp_all, "Resp Rate")):
+        fig, ax = plt.subplots(figsize=(10, 3), dpi=300)
+        fig.patch.set_alpha(0)
+        ax.set_facecolor('none')
+        ax.plot(time_all, values)
+        ax.set_ylabel(ylabel)
+        idx = list(range(0, len(time_all), max(1, len(time_all)//10)))
+        ax.set_xticks(idx)
+        ax.set_xticklabels([time_all[i] for i in idx], rotation=30, fontsize=6)
+        images[key] = png_base64(fig, bbox_inches='tight', transparent=True)
+
+    # 繪製 status 圖（色條）
+    fig, ax = plt.subplots(figsize=(10, 3), dpi=300)
+    fig.patch.set_alpha(0)
+    ax.set_facecolor('none')
+    _status_strip(ax, status_spans, status_ticks, status_tick_labels)
+    images["status_image"] = png_base64(fig, bbox_inches='tight', transparent=True)
+    return images
@@ -0,0 +1,329 @@
+"""
+Retention and compaction of /app/snapshots.
+
+A date is closed COMPACT_GRACE seconds after its midnight (Taiwan time),
+when the ingest writer can no longer append to it. For a closed date:
+
+  1. the device day files are rebuilt from the minute snapshots when
+     those still exist (device_store.migrate_date, the snapshots are the
+     complete copy);
+  2. old records that still carry raw move it into the waveform archive;
+  3. each devices/{mcu_id}/{date}.rec is folded into one compressed
+     {date}.day (written to .tmp and renamed), then the .rec is removed;
+  4. missing or old-format rollups are rebuilt from the .day (they
+     outlive the records);
+  5. the catalog rows of the day point at the .day (catalog.py);
+  6. the minute snapshot directory is removed.
+
+Readers (device_store, rollup) take .day, then .rec, then the minute
+snapshots, so every endpoint reads the same day before and after.
+
+Retention, in whole days before today (0 keeps forever):
+    RETAIN_WAVEFORM_DAYS   waveform archives .wfa/.wfi      (default 30)
+    RETAIN_RECORD_DAYS     device days .day/.rec, snapshots (default 365)
+    RETAIN_ROLLUP_DAYS     vitals rollups                   (default 0)
+Directories are first renamed into .trash/ and then deleted, so a reader
+sees either the whole directory or nothing.
+
+    COMPACTOR=1 in the download container runs it every COMPACT_INTERVAL
+    seconds (default 3600), or by hand:
+    python compactor.py run [--root /app/snapshots] [--date YYYY-MM-DD] [--dry-run]
+"""
+import os
+import sys
+import time
+import fcntl
+import shutil
+import sqlite3
+import asyncio
+import argparse
+import traceback
+from datetime import datetime, timedelta
+from urllib.parse import unquote
+
+import catalog
+from device_store import (DEVICES_DIR, device_day_path, device_archive_path, unique_records,
+                          write_day_archive, migrate_date)
+from rollup import ROLLUP_DIR, load_rollup, rebuild_device
+from snapshot_store import taiwan_tz, list_snapshot_files
+from waveform_archive import WAVEFORM_ARCHIVE, WAVEFORMS_DIR, DayArchive, append_block
+from metrics import Counter, Histogram
+
+COMPACTOR = os.environ.get("COMPACTOR", "0") == "1"
+COMPACT_INTERVAL = float(os.environ.get("COMPACT_INTERVAL", "3600"))
+COMPACT_GRACE = float(os.environ.get("COMPACT_GRACE", "3600"))
+RETAIN_WAVEFORM_DAYS = int(os.environ.get("RETAIN_WAVEFORM_DAYS", "30"))
+RETAIN_RECORD_DAYS = int(os.environ.get("RETAIN_RECORD_DAYS", "365"))
+RETAIN_ROLLUP_DAYS = int(os.environ.get("RETAIN_ROLLUP_DAYS", "0"))
+
+TRASH_DIR = ".trash"
+LOCK_FILE = ".compactor.lock"
+
+RUN_SECONDS = Histogram("compactor_run_seconds", "One compaction and retention pass",
+                        buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0))
+FILES_REMOVED = Counter("compactor_removed_total", "Files and directories removed, by kind", ("kind",))
+
+
+def _is_date(name):
+    try:
+        datetime.strptime(name, "%Y-%m-%d")
+        return True
+    except ValueError:
+        return False
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except FileNotFoundError:
+        return []
+
+
+def _device_names(root):
+    return _listdir(os.path.join(root, DEVICES_DIR))
+
+
+def closed_before(now=None):
+    """ dates < the returned 'YYYY-MM-DD' are closed """
+    now = now or datetime.now(taiwan_tz)
+    return (now - timedelta(seconds=COMPACT_GRACE)).strftime("%Y-%m-%d")
+
+
+def pending_dates(root, before):
+    """ closed dates that still have minute snapshots or .rec files """
+    dates = {name for name in _listdir(root) if _is_date(name) and os.path.isdir(os.path.join(root, name))}
+    for name in _device_names(root):
+        dates.update(f[:-4] for f in _listdir(os.path.join(root, DEVICES_DIR, name)) if f.endswith(".rec"))
+    return sorted(d for d in dates if _is_date(d) and d < before)
+
+
+def discard(root, path, kind, dry_run=False):
+    """ remove a file, or a directory by renaming it into .trash/ first """
+    if not os.path.lexists(path):
+        return False
+    if dry_run:
+        print(f"🗑️ would remove {path}")
+        return True
+    if os.path.isdir(path):
+        trash = os.path.join(root, TRASH_DIR)
+        os.makedirs(trash, exist_ok=True)
+        target = os.path.join(trash, f"{os.path.basename(path)}.{os.getpid()}.{time.time_ns()}")
+        os.rename(path, target)
+        shutil.rmtree(target, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+    FILES_REMOVED.labels(kind).inc()
+    return True
+
+
+def empty_trash(root):
+    """ finish removals that a crash left in .trash/ """
+    trash = os.path.join(root, TRASH_DIR)
+    for name in _listdir(trash):
+        shutil.rmtree(os.path.join(trash, name), ignore_errors=True)
+
+
+def fold_device_day(root, mcu_id, date):
+    """ .rec -> .day for one device-day; raw left in old records moves to the waveform archive """
+    path = device_day_path(root, mcu_id, date)
+    archived = None
+    minutes = []
+    for minute_epoch, columns in unique_records(path):
+        if WAVEFORM_ARCHIVE and "raw" in columns:
+            # raw 一分鐘一分鐘移到 waveform archive，不留在記憶體裡
+            if archived is None:
+                archived = set(DayArchive(root, mcu_id, date).minutes())
+            if minute_epoch not in archived:
+                append_block(root, mcu_id, date, minute_epoch, {"raw": columns["raw"]})
+            columns = {key: values for key, values in columns.items() if key != "raw"}
+        minutes.append((minute_epoch, columns))
+    write_day_archive(device_archive_path(root, mcu_id, date), minutes)
+    os.remove(path)
+    return len(minutes)
+
+
+def compact_date(root, date, dry_run=False):
+    """ fold one closed date into per-device .day archives and drop its minute snapshots """
+    stats = {"date": date, "devices": 0, "minutes": 0, "rollups": 0}
+    date_dir = os.path.join(root, date)
+    has_snapshots = bool(list_snapshot_files(date_dir))
+    if dry_run:
+        stats["devices"] = sum(os.path.exists(os.path.join(root, DEVICES_DIR, name, f"{date}.rec"))
+                               for name in _device_names(root))
+        print(f"🗜️ would compact {date}: {stats['devices']} device files"
+              + (" (+ rebuild from minute snapshots)" if has_snapshots else ""))
+        return stats
+    if has_snapshots:
+        migrate_date(root, date)
+    for name in _device_names(root):
+        mcu_id = unquote(name)
+        if not os.path.exists(device_day_path(root, mcu_id, date)):
+            continue
+        stats["minutes"] += fold_device_day(root, mcu_id, date)
+        stats["devices"] += 1
+        catalog.reindex(root, mcu_id, date)  # byte ranges of the .rec are gone
+        rows = load_rollup(root, mcu_id, date)
+        if rows is None or any("runs" not in row for row in rows):  # rollup 比原始紀錄保存得久，要是完整的
+            rebuild_device(root, mcu_id, date)
+            stats["rollups"] += 1
+    discard(root, date_dir, "snapshots")
+    return stats
+
+
+def _expired(name, suffixes, cutoff):
+    for suffix in suffixes:
+        if name.endswith(suffix):
+            date = name[:-len(suffix)]
+            return _is_date(date) and date < cutoff
+    return False
+
+
+def apply_retention(root, today, dry_run=False):
+    """ delete what is older than the RETAIN_* windows, returns {kind: count} """
+    today = datetime.strptime(today, "%Y-%m-%d")
+    cutoff = lambda days: (today - timedelta(days=days)).strftime("%Y-%m-%d")
+    removed = {"waveforms": 0, "records": 0, "snapshots": 0, "rollups": 0}
+    groups = [("waveforms", WAVEFORMS_DIR, RETAIN_WAVEFORM_DAYS, (".wfi", ".wfa")),
+              ("records", DEVICES_DIR, RETAIN_RECORD_DAYS, (".day", ".rec")),
+              ("rollups", ROLLUP_DIR, RETAIN_ROLLUP_DAYS, (".jsonl",))]
+    for kind, subdir, days, suffixes in groups:
+        if days <= 0:
+            continue
+        limit = cutoff(days)
+        for name in _listdir(os.path.join(root, subdir)):
+            folder = os.path.join(root, subdir, name)
+            for file_name in sorted(_listdir(folder), reverse=True):  # .wfi 先於 .wfa 刪，索引不會指向不存在的檔案
+                if _expired(file_name, suffixes, limit):
+                    removed[kind] += discard(root, os.path.join(folder, file_name), kind, dry_run)
+                    if kind == "records" and not dry_run:
+                        catalog.drop(root, unquote(name), file_name[:-4])
+            if not dry_run and not _listdir(folder):
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    pass  # 同時有新檔寫入
+    if RETAIN_RECORD_DAYS > 0:
+        limit = cutoff(RETAIN_RECORD_DAYS)
+        for name in _listdir(root):
+            if _is_date(name) and name < limit:
+                removed["snapshots"] += discard(root, os.path.join(root, name), "snapshots", dry_run)
+    return removed
+
+
+def _locked(root):
+    """ exclusive lock on the snapshot root, None when another compactor holds it """
+    f = open(os.path.join(root, LOCK_FILE), "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+def run_once(root, dates=None, dry_run=False, now=None):
+    """ compact closed dates, then apply retention; returns a summary (None if another run holds the lock) """
+    if not os.path.isdir(root):
+        return None
+    lock = _locked(root)
+    if lock is None:
+        print("⏭️ another compactor is running")
+        return None
+    start = time.perf_counter()
+    try:
+        if not dry_run:
+            empty_trash(root)
+        before = closed_before(now)
+        compacted = []
+        for date in dates or pending_dates(root, before):
+            if date >= before:
+                print(f"⏭️ skip {date} (not closed yet)")
+                continue
+            try:
+                compacted.append(compact_date(root, date, dry_run))
+            except Exception:
+                print(f"❌ compacting {date} failed")
+                traceback.print_exc()
+        removed = apply_retention(root, (now or datetime.now(taiwan_tz)).strftime("%Y-%m-%d"), dry_run)
+        if not dry_run:
+            try:
+                catalog.backfill(root, before)
+            except sqlite3.Error as e:
+                print(f"⚠️ catalog backfill failed: {e}")
+        return {"compacted": compacted, "removed": removed, "seconds": round(time.perf_counter() - start, 3)}
+    finally:
+        RUN_SECONDS.observe(time.perf_counter() - start)
+        lock.close()
+
+
+class Compactor:
+    """ run_once() in a worker thread every COMPACT_INTERVAL seconds (download service) """
+
+    def __init__(self, root, interval=None):
+        self.root = root
+        self.interval = interval or COMPACT_INTERVAL
+        self.running = False
+        self.last = None
+        self.stats = {"runs": 0, "failed": 0, "dates_compacted": 0, "files_removed": 0, "last_run_seconds": 0.0,
+                      "last_run_at": 0.0}
+
+    async def run(self):
+        self.running = True
+        while self.running:
+            try:
+                summary = await asyncio.to_thread(run_once, self.root)
+            except Exception:
+                self.stats["failed"] += 1
+                traceback.print_exc()
+            else:
+                if summary is not None:
+                    self._record(summary)
+            await asyncio.sleep(self.interval)
+
+    def _record(self, summary):
+        self.last = summary
+        self.stats["runs"] += 1
+        self.stats["dates_compacted"] += len(summary["compacted"])
+        self.stats["files_removed"] += sum(summary["removed"].values())
+        self.stats["last_run_seconds"] = summary["seconds"]
+        self.stats["last_run_at"] = time.time()
+        if summary["compacted"] or any(summary["removed"].values()):
+            print(f"🗜️ compacted {[s['date'] for s in summary['compacted']]}, removed {summary['removed']}")
+
+    def stop(self):
+        self.running = False
+
+    def snapshot_stats(self):
+        return dict(self.stats, interval=self.interval, retain_waveform_days=RETAIN_WAVEFORM_DAYS,
+                    retain_record_days=RETAIN_RECORD_DAYS, retain_rollup_days=RETAIN_ROLLUP_DAYS, last=self.last)
+
+
+def main(argv=None):
+    global RETAIN_WAVEFORM_DAYS, RETAIN_RECORD_DAYS, RETAIN_ROLLUP_DAYS
+    parser = argparse.ArgumentParser(description="Compact closed days and apply retention under /app/snapshots")
+    parser.add_argument("command", choices=["run"])
+    parser.add_argument("--root", default="/app/snapshots")
+    parser.add_argument("--date", action="append", help="YYYY-MM-DD, repeatable (default: every closed date)")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would be compacted or removed")
+    parser.add_argument("--retain-waveform-days", type=int, default=RETAIN_WAVEFORM_DAYS)
+    parser.add_argument("--retain-record-days", type=int, default=RETAIN_RECORD_DAYS)
+    parser.add_argument("--retain-rollup-days", type=int, default=RETAIN_ROLLUP_DAYS)
+    args = parser.parse_args(argv)
+
+    RETAIN_WAVEFORM_DAYS = args.retain_waveform_days
+    RETAIN_RECORD_DAYS = args.retain_record_days
+    RETAIN_ROLLUP_DAYS = args.retain_rollup_days
+    summary = run_once(args.root, args.date, args.dry_run)
+    if summary is None:
+        return 1
+    for stats in summary["compacted"]:
+        print(f"✅ {stats['date']}: {stats['devices']} devices, {stats['minutes']} minutes, "
+              f"{stats['rollups']} rollups rebuilt")
+    print(f"🗑️ removed {summary['removed']} in {summary['seconds']} s")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
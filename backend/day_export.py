@@ -0,0 +1,175 @@
+"""
+Streaming /download export: one device-day as gzip'ed JSON, produced a
+minute at a time so memory stays at about one minute of data and the
+first bytes go out immediately.
+
+The decompressed document is byte-identical to
+json.dumps(load_device_day(...), indent=2, ensure_ascii=False).
+
+Finished exports are kept in {root}/.exports/{mcu_id}/{date}.json.gz with
+a .etag sidecar. The gzip output is deterministic (mtime 0, fixed
+level), so the strong ETag is derived from the source file fingerprint
+and known before a single byte is compressed; a day is only recompressed
+when its source files change (i.e. new minutes for today).
+"""
+import os
+import json
+import zlib
+import uuid
+import hashlib
+from urllib.parse import quote
+
+from device_store import iter_device_day
+
+EXPORT_DIR = ".exports"
+EXPORT_FORMAT = 1  # 輸出格式有變動時加一，讓舊的 ETag 全部失效
+EXPORT_GZIP_LEVEL = 6
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get("EXPORT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+
+def json_fragments(pairs):
+    """ (key, value) pairs -> text pieces of the indent=2 JSON object """
+    first = True
+    for key, value in pairs:
+        # {key: value} 以 indent=2 輸出後去掉外層的 "{\n" 與 "\n}"，就是整份文件裡的那一段
+        fragment = json.dumps({key: value}, indent=2, ensure_ascii=False)[2:-2]
+        yield ("{\n" if first else ",\n") + fragment
+        first = False
+    yield "{}" if first else "\n}"
+
+
+def gzip_stream(pieces, level=EXPORT_GZIP_LEVEL, chunk_size=EXPORT_CHUNK_SIZE):
+    """ text pieces -> gzip member bytes, yielded in chunks of about chunk_size """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31: gzip header/trailer
+    pending = []
+    pending_size = 0
+    for piece in pieces:
+        out = compressor.compress(piece.encode("utf-8"))
+        if out:
+            pending.append(out)
+            pending_size += len(out)
+            if pending_size >= chunk_size:
+                yield b"".join(pending)
+                pending, pending_size = [], 0
+    pending.append(compressor.flush())
+    yield b"".join(pending)
+
+
+def stream_day(root, mcu_id, date):
+    """ gzip'ed JSON of one device-day, as a byte chunk generator """
+    return gzip_stream(json_fragments(iter_device_day(root, mcu_id, date)))
+
+
+def export_path(root, mcu_id, date):
+    return os.path.join(root, EXPORT_DIR, quote(mcu_id, safe=''), f"{date}.json.gz")
+
+
+def export_etag(fingerprint):
+    """ strong ETag of the export built from these source files """
+    key = repr((EXPORT_FORMAT, EXPORT_GZIP_LEVEL, zlib.ZLIB_RUNTIME_VERSION, fingerprint))
+    return '"' + hashlib.sha256(key.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def cached_export(root, mcu_id, date, etag):
+    """ path of the stored export if it was built from the same sources, else None """
+    path = export_path(root, mcu_id, date)
+    try:
+        with open(path + ".etag", "r") as f:
+            if f.read() == etag and os.path.exists(path):
+                return path
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def stream_and_store(root, mcu_id, date, etag):
+    """ stream_day, also written to the export cache; a half-sent download leaves nothing behind """
+    path = export_path(root, mcu_id, date)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    f = open(tmp, "wb")
+    try:
+        for chunk in stream_day(root, mcu_id, date):
+            f.write(chunk)
+            yield chunk
+        f.close()
+        os.replace(tmp, path)
+        with open(tmp + ".etag", "w") as meta:
+            meta.write(etag)
+        os.replace(tmp + ".etag", path + ".etag")
+        prune_exports(root)
+    finally:
+        if not f.closed:
+            f.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def build_export(root, mcu_id, date, etag):
+    """ make sure the export exists (e.g. before serving a Range of it) and return its path """
+    path = cached_export(root, mcu_id, date, etag)
+    if path is None:
+        for _ in stream_and_store(root, mcu_id, date, etag):
+            pass
+        path = export_path(root, mcu_id, date)
+    return path
+
+
+def prune_exports(root, max_bytes=None):
+    """ drop the least recently written exports above EXPORT_CACHE_MAX_BYTES """
+    max_bytes = max_bytes or EXPORT_CACHE_MAX_BYTES
+    files = []
+    for dirpath, _, names in os.walk(os.path.join(root, EXPORT_DIR)):
+        for name in names:
+            if name.endswith(".json.gz"):
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        for p in (path + ".etag", path):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def parse_range(header, size):
+    """
+    single 'bytes=' range -> (start, end) inclusive; None if the header
+    should be ignored (not bytes / multiple ranges), ValueError if unsatisfiable
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    if not (first or last) or not (first or "0").isdigit() or not (last or "0").isdigit():
+        return None
+    if first == "":  # bytes=-N：最後 N bytes
+        start, end = max(0, size - int(last)), size - 1
+        if int(last) == 0:
+            raise ValueError(header)
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end
+
+
+def etag_matches(header, etag):
+    """ If-None-Match (weak comparison) """
+    if not header:
+        return False
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
@@ -0,0 +1,393 @@
+"""
+Per-device day files: {snapshot_dir}/devices/{mcu_id}/{YYYY-MM-DD}.rec
+
+Append-only stream of minute records, each one is
+    RECORD_HEADER (magic, minute epoch, payload length) + npz payload
+so one device's day can be read without touching other beds' data.
+
+Since the waveform archive, new records have no 'raw' column; the
+readers below put it back from waveform_archive so the records (and
+/download) look the same as before.
+
+Closed days are folded by compactor.py into one compressed archive per
+device-day, {mcu_id}/{YYYY-MM-DD}.day (npz: "minute" epochs, "columns"
+names, and per column the concatenated values plus "{column}@counts",
+samples per minute). Readers take .day, then .rec, then the minute
+snapshots, so a day reads the same before and after compaction.
+
+The ingest service runs backfill_date() for today and yesterday before
+its first append, so a day file also holds the minutes of that date
+that were only written as snapshots (e.g. before an upgrade).
+"""
+
+import os
+import io
+import sys
+import struct
+import argparse
+import numpy as np
+from collections import OrderedDict, deque
+from datetime import datetime
+from urllib.parse import quote
+
+import snapshot_store
+import waveform_archive
+from snapshot_store import (COLUMN_DTYPES, SNAPSHOT_COMPRESS, taiwan_tz, to_json_record,
+                            from_json_record, list_snapshot_files, read_snapshot)
+
+DEVICES_DIR = "devices"
+RECORD_MAGIC = b'MREC'
+RECORD_HEADER = struct.Struct('<4sqI')
+
+_checked_paths = set()  # day files whose tail was verified by this process
+
+
+def device_dir(root, mcu_id):
+    return os.path.join(root, DEVICES_DIR, quote(mcu_id, safe=''))
+
+
+def device_day_path(root, mcu_id, date):
+    return os.path.join(device_dir(root, mcu_id), f"{date}.rec")
+
+
+def device_archive_path(root, mcu_id, date):
+    return os.path.join(device_dir(root, mcu_id), f"{date}.day")
+
+
+def encode_columns(columns, compress=None):
+    compress = SNAPSHOT_COMPRESS if compress is None else compress
+    buf = io.BytesIO()
+    arrays = {key: np.asarray(values, dtype=COLUMN_DTYPES.get(key)) for key, values in columns.items()}
+    if compress:
+        np.savez_compressed(buf, **arrays)
+    else:
+        np.savez(buf, **arrays)
+    return buf.getvalue()
+
+
+def decode_columns(payload):
+    with np.load(io.BytesIO(payload)) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+def encode_record(minute_epoch, columns, compress=None):
+    payload = encode_columns(columns, compress)
+    return RECORD_HEADER.pack(RECORD_MAGIC, int(minute_epoch), len(payload)) + payload
+
+
+def append_minute(root, mcu_id, date, minute_epoch, columns, compress=None):
+    """ append one minute to the device day file, returns (path, offset, length) of the record """
+    path = device_day_path(root, mcu_id, date)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if path not in _checked_paths:
+        truncate_torn_tail(path)
+        _checked_paths.add(path)
+    record = encode_record(minute_epoch, columns, compress)
+    with open(path, "ab") as f:
+        offset = f.tell()
+        f.write(record)
+    return path, offset, len(record)
+
+
+def iter_records(path):
+    """ yield (minute_epoch, offset, length) of every complete record, reading only the headers """
+    with open(path, "rb") as f:
+        yield from _scan_records(f)
+
+
+def _scan_records(f):
+    size = os.fstat(f.fileno()).st_size
+    offset = 0
+    while offset + RECORD_HEADER.size <= size:
+        f.seek(offset)
+        magic, minute_epoch, length = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+        end = offset + RECORD_HEADER.size + length
+        if magic != RECORD_MAGIC or end > size:
+            break  # 寫到一半的尾端紀錄
+        yield minute_epoch, offset, end - offset
+        offset = end
+
+
+def truncate_torn_tail(path):
+    """ drop a half-written last record (e.g. after a crash) so new appends stay readable """
+    if not os.path.exists(path):
+        return
+    end = 0
+    for _, offset, length in iter_records(path):
+        end = offset + length
+    if end < os.path.getsize(path):
+        print(f"⚠️ truncating torn tail of {path} at {end}")
+        with open(path, "r+b") as f:
+            f.truncate(end)
+
+
+def read_record(path, offset, length):
+    """ (minute_epoch, columns) of the record at a byte range """
+    with open(path, "rb") as f:
+        return _read_record_at(f, offset, length)
+
+
+def _read_record_at(f, offset, length):
+    f.seek(offset)
+    data = f.read(length)
+    magic, minute_epoch, payload_len = RECORD_HEADER.unpack_from(data)
+    if magic != RECORD_MAGIC:
+        raise ValueError(f"bad record at {f.name}:{offset}")
+    return minute_epoch, decode_columns(data[RECORD_HEADER.size:RECORD_HEADER.size + payload_len])
+
+
+def minute_label(minute_epoch):
+    """ minute epoch -> 'HH-MM-SS' (same as the time part of snapshot file names) """
+    return datetime.fromtimestamp(minute_epoch, taiwan_tz).strftime("%H-%M-%S")
+
+
+def unique_records(path):
+    """ yield (minute_epoch, columns) of a day file; a repeated minute keeps its first position and last record """
+    with open(path, "rb") as f:
+        yield from _unique_records(f)
+
+
+def _unique_records(f):
+    # 只留 offset，紀錄一筆一筆讀，整天的資料不會同時在記憶體裡
+    entries = OrderedDict()
+    for minute_epoch, offset, length in _scan_records(f):
+        entries[minute_label(minute_epoch)] = (offset, length)
+    for offset, length in entries.values():
+        yield _read_record_at(f, offset, length)
+
+
+def write_day_archive(path, minutes, compress=True):
+    """ fold [(minute_epoch, columns), ...] into one .day file (written to .tmp, then renamed over `path`) """
+    names = []
+    for _, columns in minutes:
+        names += [key for key in columns if key not in names]
+    arrays = {"minute": np.array([minute_epoch for minute_epoch, _ in minutes], dtype=np.int64),
+              "columns": np.array(names)}
+    for key in names:
+        parts = [np.asarray(columns.get(key, ()), dtype=COLUMN_DTYPES.get(key)) for _, columns in minutes]
+        arrays[f"{key}@counts"] = np.array([len(part) for part in parts], dtype=np.uint32)
+        arrays[key] = np.concatenate(parts) if parts else np.zeros(0, dtype=COLUMN_DTYPES.get(key))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        (np.savez_compressed if compress else np.savez)(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def iter_day_archive(path):
+    """ yield (minute_epoch, columns) of a .day file in time order """
+    with np.load(path) as npz:
+        names = [str(name) for name in npz["columns"]]
+        minutes = npz["minute"]
+        values = {key: npz[key] for key in names}
+        bounds = {key: np.concatenate(([0], np.cumsum(npz[f"{key}@counts"], dtype=np.int64))) for key in names}
+    for i, minute_epoch in enumerate(minutes):
+        yield int(minute_epoch), {key: values[key][bounds[key][i]:bounds[key][i + 1]] for key in names}
+
+
+def iter_device_minutes(root, mcu_id, date):
+    """ (minute_epoch, columns) of one device-day from its .day archive or .rec file, nothing if neither exists """
+    archive = device_archive_path(root, mcu_id, date)
+    if not os.path.exists(archive):
+        try:
+            f = open(device_day_path(root, mcu_id, date), "rb")
+        except FileNotFoundError:
+            f = None  # 沒有這一天，或剛好被壓縮成 .day
+        if f is not None:
+            # 開著的檔案在 compactor 刪掉 .rec 之後仍可讀完
+            with f:
+                yield from _unique_records(f)
+            return
+        if not os.path.exists(archive):
+            return
+    yield from iter_day_archive(archive)
+
+
+def _with_raw(minutes, waveforms):
+    """ put raw back from `waveforms` (a waveform_archive.DayArchive), empty if the archive has no such minute """
+    for minute_epoch, columns in minutes:
+        if waveforms is not None and "raw" not in columns:
+            block = waveforms.get(minute_epoch)
+            raw = block["raw"] if block is not None else np.zeros(0, dtype=np.uint16)
+            columns = {"raw": raw, **columns}  # raw 放回原本的第一個欄位
+        yield minute_epoch, columns
+
+
+def read_device_day(root, mcu_id, date):
+    """ OrderedDict {time: record} from the device archive or day file, or None if there is neither """
+    if not has_device_day(root, mcu_id, date):
+        return None
+    return OrderedDict(_json_records(root, mcu_id, date))
+
+
+def iter_device_file(path, waveforms=None):
+    """
+    yield (time, record) of a day file one minute at a time; a repeated
+    minute keeps its first position and last record. Records without raw
+    get it from `waveforms` (a waveform_archive.DayArchive), empty if the
+    archive has no such minute.
+    """
+    for minute_epoch, columns in _with_raw(unique_records(path), waveforms):
+        yield minute_label(minute_epoch), to_json_record(columns)
+
+
+def _json_records(root, mcu_id, date):
+    waveforms = waveform_archive.DayArchive(root, mcu_id, date)
+    for minute_epoch, columns in _with_raw(iter_device_minutes(root, mcu_id, date), waveforms):
+        yield minute_label(minute_epoch), to_json_record(columns)
+
+
+def has_device_day(root, mcu_id, date):
+    return (os.path.exists(device_archive_path(root, mcu_id, date))
+            or os.path.exists(device_day_path(root, mcu_id, date)))
+
+
+def day_sources(root, mcu_id, date):
+    """ files load_device_day() reads for this device-day (for cache fingerprints) """
+    for path in (device_archive_path(root, mcu_id, date), device_day_path(root, mcu_id, date)):
+        if os.path.exists(path):
+            archive = waveform_archive.archive_path(root, mcu_id, date)
+            return [path, archive] if os.path.exists(archive) else [path]
+    return [p for _, p in list_snapshot_files(os.path.join(root, date))]
+
+
+def iter_device_day(root, mcu_id, date):
+    """ streaming form of load_device_day: (time, record) pairs in time order """
+    if has_device_day(root, mcu_id, date):
+        return _json_records(root, mcu_id, date)
+    return snapshot_store.iter_device_day(os.path.join(root, date), mcu_id)
+
+
+def load_device_day(root, mcu_id, date):
+    """ one device's day, from its archive or day file when available, else from the minute snapshots """
+    collected_data = read_device_day(root, mcu_id, date)
+    if collected_data is not None:
+        return collected_data
+    return snapshot_store.load_device_day(os.path.join(root, date), mcu_id)
+
+
+def snapshot_epoch(date, t):
+    """ ('2025-07-17', '11-32-00') -> epoch seconds (Taiwan time) """
+    return int(datetime.strptime(f"{date} {t}", "%Y-%m-%d %H-%M-%S").replace(tzinfo=taiwan_tz).timestamp())
+
+
+def migrate_date(root, date, compress=None):
+    """ rebuild every device day file of one date directory from its minute snapshots """
+    files = list_snapshot_files(os.path.join(root, date))
+    if not files:
+        return 0
+    handles = {}
+    try:
+        for t, path in files:
+            try:
+                snapshot = read_snapshot(path)
+            except Exception as e:
+                print(f"⚠️ skip {path}: {e}")
+                continue
+            for mcu_id, record in snapshot.items():
+                if mcu_id not in handles:
+                    target = device_day_path(root, mcu_id, date)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    handles[mcu_id] = open(target + ".tmp", "wb")
+                handles[mcu_id].write(encode_record(snapshot_epoch(date, t), from_json_record(record), compress))
+    finally:
+        for f in handles.values():
+            f.close()
+    for mcu_id in handles:
+        target = device_day_path(root, mcu_id, date)
+        os.replace(target + ".tmp", target)
+    return len(handles)
+
+
+def backfill_date(root, date, compress=None):
+    """
+    add the minutes that only the date directory's snapshots have (e.g.
+    written before the day files existed) to the device day files, in
+    time order; records already in a day file are kept as they are.
+    Run before the writer appends to that date. Returns the devices
+    whose day file was rewritten.
+    """
+    files = list_snapshot_files(os.path.join(root, date))
+    if not files:
+        return []
+    sources = {}  # mcu_id -> (open day file or None, deque of its (minute_epoch, offset, length) not copied yet)
+    present = {}  # mcu_id -> minute epochs the day file already has
+    handles = {}  # mcu_id -> [tmp file, minutes added]
+    suffix = ".backfill"  # 與 migrate_date / compactor 的 .tmp 分開
+
+    def copy_until(mcu_id, minute_epoch):
+        source, pending = sources[mcu_id]
+        while pending and (minute_epoch is None or pending[0][0] < minute_epoch):
+            _, offset, length = pending.popleft()
+            source.seek(offset)
+            handles[mcu_id][0].write(source.read(length))
+
+    try:
+        for t, path in files:
+            try:
+                snapshot = read_snapshot(path)
+            except Exception as e:
+                print(f"⚠️ skip {path}: {e}")
+                continue
+            minute_epoch = snapshot_epoch(date, t)
+            for mcu_id, record in snapshot.items():
+                if mcu_id not in sources:
+                    target = device_day_path(root, mcu_id, date)
+                    if os.path.exists(target):
+                        source = open(target, "rb")
+                        sources[mcu_id] = (source, deque(_scan_records(source)))
+                    else:
+                        sources[mcu_id] = (None, deque())
+                    present[mcu_id] = {epoch for epoch, _, _ in sources[mcu_id][1]}
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    handles[mcu_id] = [open(target + suffix, "wb"), 0]
+                if minute_epoch in present[mcu_id]:
+                    continue  # 這一分鐘 day file 已經有了
+                copy_until(mcu_id, minute_epoch)
+                handles[mcu_id][0].write(encode_record(minute_epoch, from_json_record(record), compress))
+                handles[mcu_id][1] += 1
+        for mcu_id in handles:
+            copy_until(mcu_id, None)
+    finally:
+        for source, _ in sources.values():
+            if source is not None:
+                source.close()
+        for f, _ in handles.values():
+            f.close()
+    rewritten = []
+    for mcu_id, (_, added) in handles.items():
+        target = device_day_path(root, mcu_id, date)
+        if added:
+            os.replace(target + suffix, target)
+            rewritten.append(mcu_id)
+        else:
+            os.remove(target + suffix)
+    return rewritten
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build per-device day files from /app/snapshots/YYYY-MM-DD trees")
+    parser.add_argument("command", choices=["migrate"])
+    parser.add_argument("--root", default="/app/snapshots")
+    parser.add_argument("--date", action="append", help="YYYY-MM-DD, repeatable (default: every date directory)")
+    parser.add_argument("--include-today", action="store_true",
+                        help="also rebuild today's files (stop the ingest service first)")
+    args = parser.parse_args(argv)
+
+    today = datetime.now(taiwan_tz).strftime("%Y-%m-%d")
+    dates = args.date or sorted(d for d in os.listdir(args.root) if os.path.isdir(os.path.join(args.root, d)))
+    for date in dates:
+        try:
+            datetime.strptime(date, "%Y-%m-%d")
+        except ValueError:
+            continue
+        if date == today and not args.include_today:
+            print(f"⏭️ skip {date} (today, ingest is still appending)")
+            continue
+        count = migrate_date(args.root, date)
+        print(f"✅ {date}: {count} device files")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
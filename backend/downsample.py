@@ -0,0 +1,57 @@
+import numpy as np
+
+
+def lttb_indices(y, threshold):
+    """
+    Largest-Triangle-Three-Buckets: indices of `threshold` points that keep
+    the visual shape of y (x is the sample index, like the charts use).
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.arange(n, dtype=np.float64)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)  # 中間 threshold-2 個 bucket
+    picked = np.empty(threshold, dtype=np.int64)
+    picked[0], picked[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = end, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        bx, by = x[start:end], y[start:end]
+        area = np.abs((x[a] - avg_x) * (by - y[a]) - (x[a] - bx) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        picked[i + 1] = a
+    return picked
+
+
+def minmax_indices(y, threshold):
+    """ min and max of each bucket (threshold // 2 buckets), in index order """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if threshold >= n or threshold < 2:
+        return np.arange(n)
+    edges = np.linspace(0, n, threshold // 2 + 1).astype(np.int64)
+    picked = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end <= start:
+            continue
+        bucket = y[start:end]
+        picked += sorted({start + int(np.argmin(bucket)), start + int(np.argmax(bucket))})
+    return np.asarray(picked, dtype=np.int64)
+
+
+def downsample(labels, values, points, method="lttb"):
+    """ -> {"t": labels, "v": values} reduced to about `points` samples """
+    values = np.asarray(values, dtype=np.float64)
+    if method == "minmax":
+        idx = minmax_indices(values, points)
+    else:
+        idx = lttb_indices(values, points)
+    return {
+        "t": [labels[i] for i in idx.tolist()],
+        "v": np.round(values[idx], 2).tolist(),
+        "total": len(values),
+    }
@@ -0,0 +1,50 @@
+import sys
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # 沒有 numpy 時改用純 Python 版本
+    np = None
+
+RAW_OFFSET = 32
+HEART_OFFSET = 232
+ADC_RING_SIZE = 100
+
+
+def window_length(last_adc, current_adc):
+    """ number of new samples between two ADC ring positions (same rule as the old loops) """
+    if current_adc > last_adc:
+        return current_adc - last_adc
+    return ADC_RING_SIZE - last_adc + current_adc
+
+
+def decode_adc_window_numpy(payload, last_adc, current_adc):
+    # raw (offset 32) 與 heart (offset 232) 兩段剛好相連，一次 view 成 (2, 100) 的 big-endian uint16
+    ring = np.frombuffer(payload, dtype='>u2', count=2 * ADC_RING_SIZE, offset=RAW_OFFSET)
+    ring = ring.reshape(2, ADC_RING_SIZE)
+    idx = (last_adc + np.arange(window_length(last_adc, current_adc))) % ADC_RING_SIZE
+    window = ring[:, idx].astype(np.uint16)
+    return window[0], window[1]
+
+
+def decode_adc_window_python(payload, last_adc, current_adc):
+    ring = array('H', bytes(payload[RAW_OFFSET:HEART_OFFSET + 2 * ADC_RING_SIZE]))
+    if len(ring) != 2 * ADC_RING_SIZE:
+        raise ValueError("MCU payload too short for ADC ring")
+    if sys.byteorder == 'little':
+        ring.byteswap()
+    n = window_length(last_adc, current_adc)
+    raw = array('H', [ring[(last_adc + i) % ADC_RING_SIZE] for i in range(n)])
+    heart = array('H', [ring[ADC_RING_SIZE + (last_adc + i) % ADC_RING_SIZE] for i in range(n)])
+    return raw, heart
+
+
+def decode_adc_window(payload, last_adc, current_adc):
+    """
+    Return the (raw, heart) samples written to the MCU ADC ring between
+    last_adc and current_adc, including the wrap-around at 100.
+    Both implementations give the same values (uint16 ndarray / array('H')).
+    """
+    if np is not None:
+        return decode_adc_window_numpy(payload, last_adc, current_adc)
+    return decode_adc_window_python(payload, last_adc, current_adc)
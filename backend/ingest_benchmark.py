@@ -0,0 +1,204 @@
+"""
+Ingest load benchmark: the real AsyncTCPServer in this process, a fleet
+of mcu_simulator beds in worker processes, and a report of
+
+    frames/s                       frames the server processed per second
+    frame latency p50/p90/p99/max  data command sent -> reply processed (callback done)
+    CPU                            server process CPU, in total and per device
+    loop lag p50/p99/max           how late a 50 ms asyncio timer fires
+    poll overruns                  ADC ring wraps seen by the poll schedulers
+
+Snapshots and realtime windows go to a temporary directory, never to
+/app/snapshots.
+
+    python ingest_benchmark.py --beds 200 --duration 30
+    python ingest_benchmark.py --beds 1000 --procs 4 --json result.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import resource
+import multiprocessing
+import numpy as np
+
+import realtime_shm
+import mcu_simulator
+from TCP_server_text import AsyncTCPServer
+
+LAG_PROBE_INTERVAL = 0.05
+
+
+def _simulator_process(host, port, beds, first, ramp, duration, reply_delay, results):
+    stats = asyncio.run(mcu_simulator.run_fleet(host, port, beds, "BENCH", first, ramp, duration, reply_delay))
+    stats["cpu_seconds"] = time.process_time()
+    results.put(stats)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _raise_fd_limit():
+    # 每台床一個 socket，上千台時預設的 1024 不夠
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return {f"p{p}": None for p in points} | {"max": None}
+    arr = np.asarray(values)
+    result = {f"p{p}": round(float(np.percentile(arr, p)) * 1000, 2) for p in points}
+    result["max"] = round(float(arr.max()) * 1000, 2)
+    return result
+
+
+class Recorder:
+    """ per-frame observations, only kept inside the measuring window """
+
+    def __init__(self):
+        self.measuring = False
+        self.frames = 0
+        self.latencies = []
+        self.lags = []
+        self.devices = set()
+
+    def frame(self, mcu_id, wall_seconds):
+        if self.measuring:
+            self.frames += 1
+            self.latencies.append(wall_seconds)
+            self.devices.add(mcu_id)
+
+    async def probe_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            if self.measuring:
+                self.lags.append(max(0.0, loop.time() - start - LAG_PROBE_INTERVAL))
+
+
+async def benchmark(beds, duration, warmup, procs, ramp, reply_delay, port):
+    workdir = tempfile.mkdtemp(prefix="ingest_benchmark_")
+    realtime_shm.REALTIME_SHM_DIR = os.path.join(workdir, ".realtime")
+    server = AsyncTCPServer(callback=lambda data: None, host="127.0.0.1", port=port)
+    server.snapshot_dir = workdir
+    recorder = Recorder()
+    server.frame_observer = recorder.frame
+    server_task = asyncio.create_task(server.start())
+    probe_task = asyncio.create_task(recorder.probe_loop_lag())
+    await asyncio.sleep(0.5)
+
+    # 床平均分給各個模擬程序，連線速度也平均分攤
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    ramp_seconds = beds / ramp if ramp else 0
+    run_seconds = ramp_seconds + warmup + duration + 2
+    workers = []
+    first = 0
+    for i in range(procs):
+        count = beds // procs + (1 if i < beds % procs else 0)
+        if count == 0:
+            continue
+        p = ctx.Process(target=_simulator_process,
+                        args=("127.0.0.1", port, count, first, ramp / procs if ramp else 0,
+                              run_seconds, reply_delay, results))
+        p.start()
+        workers.append(p)
+        first += count
+
+    print(f"🛏️ {beds} beds in {len(workers)} simulator processes, ramp {ramp_seconds:.1f}s, warm up {warmup}s")
+    await asyncio.sleep(ramp_seconds + warmup)
+    connected = len(server.clients)
+    cpu_start = os.times()
+    wall_start = time.monotonic()
+    recorder.measuring = True
+    await asyncio.sleep(duration)
+    recorder.measuring = False
+    wall = time.monotonic() - wall_start
+    cpu_end = os.times()
+    cpu = (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+
+    overruns = sum(s.stats["overruns"] for s in server.poll_schedulers.values())
+    lost = sum(s.stats["lost_samples"] for s in server.poll_schedulers.values())
+    fleet = {"frames": 0, "connect_errors": 0, "dropped": 0, "cpu_seconds": 0.0}
+    for _ in workers:
+        stats = await asyncio.to_thread(results.get)
+        for key in fleet:
+            fleet[key] += stats.get(key, 0)
+    for p in workers:
+        await asyncio.to_thread(p.join)
+
+    # 模擬器已斷線，等 server 端的連線在下一次輪詢時自行收尾
+    for _ in range(50):
+        if not server.clients:
+            break
+        await asyncio.sleep(0.1)
+    probe_task.cancel()
+    await server.shutdown()
+    server_task.cancel()
+
+    devices = max(1, len(recorder.devices))
+    return {
+        "beds": beds,
+        "connected": connected,
+        "active_devices": len(recorder.devices),
+        "duration": round(wall, 2),
+        "frames": recorder.frames,
+        "frames_per_second": round(recorder.frames / wall, 1),
+        "frames_per_device_second": round(recorder.frames / wall / devices, 3),
+        "frame_latency_ms": percentiles(recorder.latencies),
+        "loop_lag_ms": percentiles(recorder.lags),
+        "cpu_percent": round(cpu / wall * 100, 1),
+        "cpu_percent_per_device": round(cpu / wall * 100 / devices, 4),
+        "poll_overruns": overruns,
+        "lost_samples": lost,
+        "simulator": fleet,
+        "snapshot_dir": workdir,
+    }
+
+
+def report(result):
+    lat, lag = result["frame_latency_ms"], result["loop_lag_ms"]
+    print(f"📈 {result['active_devices']}/{result['beds']} beds active over {result['duration']}s")
+    print(f"   frames/s            {result['frames_per_second']} ({result['frames_per_device_second']} per device)")
+    print(f"   frame latency (ms)  p50 {lat['p50']}  p90 {lat['p90']}  p99 {lat['p99']}  max {lat['max']}")
+    print(f"   loop lag (ms)       p50 {lag['p50']}  p90 {lag['p90']}  p99 {lag['p99']}  max {lag['max']}")
+    print(f"   CPU                 {result['cpu_percent']}% ({result['cpu_percent_per_device']}% per device)")
+    print(f"   poll overruns       {result['poll_overruns']} ({result['lost_samples']} samples lost)")
+    print(f"   simulator           {result['simulator']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load benchmark of the ingest TCP server with simulated MCUs")
+    parser.add_argument("--beds", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30, help="measuring window in seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds between the last connection and measuring")
+    parser.add_argument("--procs", type=int, default=max(1, min(4, (os.cpu_count() or 2) - 1)),
+                        help="simulator processes")
+    parser.add_argument("--ramp", type=float, default=200.0, help="new connections per second (0: all at once)")
+    parser.add_argument("--reply-delay", type=float, default=0.0, help="simulated MCU response time in seconds")
+    parser.add_argument("--port", type=int, default=0, help="server port (default: a free one)")
+    parser.add_argument("--json", help="also write the result to this file")
+    args = parser.parse_args(argv)
+
+    _raise_fd_limit()
+    result = asyncio.run(benchmark(args.beds, args.duration, args.warmup, args.procs, args.ramp,
+                                   args.reply_delay, args.port or _free_port()))
+    report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
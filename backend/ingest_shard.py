@@ -0,0 +1,324 @@
+"""
+Sharded ingest: with INGEST_WORKERS > 1 the MCU connections are spread
+over N worker processes that all accept on the ingest port
+(SO_REUSEPORT, the kernel balances new connections). Each worker is a
+plain AsyncTCPServer owning its devices' state, minute storage, realtime
+window (shared memory, see realtime_shm) and snapshot writer; minute
+snapshot files get a '_w{n}' suffix so workers never write the same file.
+
+Workers stream their status board to the API process over a Unix socket
+(INGEST_IPC_PATH), one JSON object per line, using the same coalesced
+delta messages as the Socket.IO broadcast (see broadcast.py):
+
+    worker -> api:  {"event": "hello", "data": {"worker": n}}   first line of every connection
+                    {"event": "mcu_update", "data": {"seq", "changes", "removed"} | {"seq", "full"}}
+                    {"event": "stats", "data": {"poll": {...}, "snapshot_writer": {...}, "metrics": [family],
+                                                "loop": {...}}}
+    api -> worker:  {"cmd": "resync"} | {"cmd": "autoscaling", "addr": addr}
+
+ShardedIngest merges the boards and offers the AsyncTCPServer attributes
+and methods app.py uses, so the endpoints and the broadcast do not care
+which mode is running.
+
+INGEST_WORKERS    worker processes (default 1: no sharding, AsyncTCPServer in the API process)
+INGEST_IPC_PATH   Unix socket of the API process (default /tmp/ingest_shard.sock)
+INGEST_IPC_TICK   seconds between board deltas of a worker (default 0.2)
+"""
+import os
+import json
+import signal
+import asyncio
+import multiprocessing
+
+from broadcast import BroadcastTicker
+from metrics import REGISTRY, with_labels
+from loop_monitor import LoopMonitor
+from realtime_shm import RealtimeReader, clear_windows, discard_window, window_path
+from TCP_server_text import AsyncTCPServer
+from snapshot_writer import backfill_recent
+
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "1"))
+INGEST_IPC_PATH = os.environ.get("INGEST_IPC_PATH", "/tmp/ingest_shard.sock")
+INGEST_IPC_TICK = float(os.environ.get("INGEST_IPC_TICK", "0.2"))
+STATS_INTERVAL = 5.0
+IPC_LINE_LIMIT = 64 * 1024 * 1024
+
+
+def encode(message):
+    return (json.dumps(message, separators=(',', ':')) + "\n").encode("utf-8")
+
+
+class IpcEmitter:
+    """ stands in for the Socket.IO server of a worker's BroadcastTicker: emits go to the API process """
+
+    def __init__(self):
+        self.writer = None
+
+    async def emit(self, event, data, to=None, room=None):
+        if self.writer is None:
+            return
+        self.writer.write(encode({"event": event, "data": data}))
+        await self.writer.drain()
+
+
+class ShardWorker:
+    def __init__(self, index, host, port, ipc_path):
+        self.index = index
+        self.ipc_path = ipc_path
+        self.server = AsyncTCPServer(callback=None, host=host, port=port, reuse_port=True,
+                                     snapshot_suffix=f"_w{index}", prepare=False)
+        self.emitter = IpcEmitter()
+        self.ticker = BroadcastTicker(self.emitter, source=lambda: self.server.data_frontend, tick=INGEST_IPC_TICK)
+        self.server.callback = self.ticker.notify
+        self.loop_monitor = LoopMonitor()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        tasks = [asyncio.create_task(self.server.start()), asyncio.create_task(self.ticker.run()),
+                 asyncio.create_task(self._ipc()), asyncio.create_task(self.loop_monitor.run())]
+        await stop.wait()
+        self.ticker.stop()
+        self.loop_monitor.stop()
+        await self.server.shutdown()
+        for task in tasks:
+            task.cancel()
+
+    async def _ipc(self):
+        """ keep a connection to the API process; resend the whole board after every (re)connect """
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.ipc_path, limit=IPC_LINE_LIMIT)
+            except OSError:
+                await asyncio.sleep(1)
+                continue
+            self.emitter.writer = writer
+            stats_task = asyncio.create_task(self._send_stats())
+            try:
+                await self.emitter.emit("hello", {"worker": self.index, "pid": os.getpid()})
+                self.ticker.diff()  # 先把目前的狀態算成「已送出」，再送一份完整的
+                await self.ticker.resync(None)
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    await self._command(json.loads(line))
+            except (ConnectionError, ValueError) as e:
+                print(f"⚠️ worker {self.index} IPC error: {e}")
+            finally:
+                stats_task.cancel()
+                self.emitter.writer = None
+                writer.close()
+            await asyncio.sleep(1)
+
+    async def _command(self, message):
+        cmd = message.get("cmd")
+        if cmd == "resync":
+            await self.ticker.resync(None)
+        elif cmd == "autoscaling":
+            await self.server.start_autoscaling(message["addr"])
+
+    async def _send_stats(self):
+        while True:
+            await self.emitter.emit("stats", {"poll": self.server.poll_stats(),
+                                              "snapshot_writer": self.server.snapshot_writer_stats(),
+                                              "metrics": REGISTRY.collect(),
+                                              "loop": self.loop_monitor.snapshot()})
+            await asyncio.sleep(STATS_INTERVAL)
+
+
+def _worker_main(index, host, port, ipc_path):
+    print(f"🧩 ingest worker {index} (pid {os.getpid()}) on {host}:{port}")
+    asyncio.run(ShardWorker(index, host, port, ipc_path).run())
+
+
+class ShardedIngest:
+    """ API-process side: starts the workers and keeps the merged view """
+
+    def __init__(self, callback, workers=None, host='0.0.0.0', port=5001, ipc_path=None):
+        self.callback = callback
+        self.workers = workers or INGEST_WORKERS
+        self.host = host
+        self.port = port
+        self.ipc_path = ipc_path or INGEST_IPC_PATH
+        self.data_frontend = {}  # addr_str -> display dict, all workers
+        self.mcuid_ip = {}  # mcu_id -> addr_str
+        self.owner = {}  # addr_str -> worker index
+        self.board_version = 0  # same meaning as in AsyncTCPServer (payloads)
+        self.versions = {}  # addr_str -> board_version of its last change
+        self.links = {}  # worker index -> [writer, last mcu_update seq]
+        self.worker_stats = {}  # worker index -> last stats message
+        self.processes = {}
+        self.realtime_reader = RealtimeReader()
+        self.snapshot_dir = "/app/snapshots"  # 與 worker 的 AsyncTCPServer 相同
+        self.running = False
+        self._ipc_server = None
+
+    # ---- AsyncTCPServer compatible interface ----
+
+    def realtime_rings(self, mcu_id):
+        return self.realtime_reader.rings(mcu_id)
+
+    def realtime_window_id(self, mcu_id):
+        return self.realtime_reader.window_id(mcu_id)
+
+    def realtime_version(self, mcu_id):
+        if mcu_id not in self.mcuid_ip:
+            return None
+        return self.realtime_reader.version(mcu_id)
+
+    def get_real_time_data(self, mcu_id):
+        if mcu_id not in self.mcuid_ip:
+            return None
+        return self.realtime_reader.read_realtime_data(mcu_id)[1]
+
+    def poll_stats(self):
+        merged = {}
+        for stats in self.worker_stats.values():
+            merged.update(stats.get("poll", {}))
+        return merged
+
+    def snapshot_writer_stats(self):
+        return {f"worker_{index}": stats.get("snapshot_writer") for index, stats in sorted(self.worker_stats.items())}
+
+    def metric_families(self):
+        """ the workers' metrics as of their last stats message, labelled worker="n" """
+        families = []
+        for index, stats in sorted(self.worker_stats.items()):
+            families.extend(with_labels(stats.get("metrics", []), worker=str(index)))
+        return families
+
+    def loop_stats(self):
+        return {f"worker_{index}": stats.get("loop") for index, stats in sorted(self.worker_stats.items())}
+
+    async def start_autoscaling(self, addr_str):
+        index = self.owner.get(addr_str)
+        if index is None or index not in self.links:
+            print(f"⚠️ 無法發送 Autoscaling 指令，{addr_str} 尚未連線")
+            return
+        await self._send(index, {"cmd": "autoscaling", "addr": addr_str})
+
+    async def start(self):
+        self.running = True
+        if os.path.exists(self.ipc_path):
+            os.remove(self.ipc_path)
+        self._ipc_server = await asyncio.start_unix_server(self._handle_worker, self.ipc_path, limit=IPC_LINE_LIMIT)
+        # 上次留下的即時視窗檔在 worker 開始收連線前清掉、裝置檔在 worker 寫入前補齊（worker 自己不做，避免彼此衝突）
+        removed = clear_windows()
+        if removed:
+            print(f"🧹 removed {removed} stale realtime windows")
+        backfilled = await asyncio.to_thread(backfill_recent, self.snapshot_dir)
+        if backfilled:
+            print(f"🧩 backfilled {backfilled} device day files from the minute snapshots")
+        for index in range(self.workers):
+            self._spawn(index)
+        print(f"🚀 Sharded ingest: {self.workers} workers on {self.host}:{self.port}")
+        while self.running:
+            await asyncio.sleep(2)
+            for index, process in list(self.processes.items()):
+                if self.running and not process.is_alive():
+                    print(f"⚠️ ingest worker {index} exited ({process.exitcode}), restarting")
+                    self._drop_worker(index)
+                    self._spawn(index)
+
+    async def shutdown(self):
+        print("🧹 正在關閉 sharded ingest...")
+        self.running = False
+        for process in self.processes.values():
+            process.terminate()  # worker 收到 SIGTERM 後會把 snapshot 寫完再結束
+        for process in self.processes.values():
+            await asyncio.to_thread(process.join, 30)
+        if self._ipc_server is not None:
+            self._ipc_server.close()
+        print("✅ 所有 ingest worker 已結束")
+
+    # ---- workers ----
+
+    def _spawn(self, index):
+        # spawn：不要把 uvicorn 的執行緒與 socket 狀態 fork 進 worker
+        ctx = multiprocessing.get_context("spawn")
+        process = ctx.Process(target=_worker_main, args=(index, self.host, self.port, self.ipc_path),
+                              name=f"ingest-worker-{index}", daemon=True)
+        process.start()
+        self.processes[index] = process
+
+    async def _send(self, index, message):
+        writer, _ = self.links[index]
+        writer.write(encode(message))
+        await writer.drain()
+
+    async def _handle_worker(self, reader, writer):
+        index = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                event, data = message["event"], message["data"]
+                if event == "hello":
+                    index = data["worker"]
+                    self.links[index] = [writer, None]
+                elif index is None:
+                    continue
+                elif event == "mcu_update":
+                    await self._apply(index, data)
+                elif event == "stats":
+                    self.worker_stats[index] = data
+        except (ConnectionError, ValueError, KeyError) as e:
+            print(f"⚠️ ingest worker IPC error: {e}")
+        finally:
+            if index is not None and self.links.get(index, [None])[0] is writer:
+                self._drop_worker(index)
+            writer.close()
+
+    async def _apply(self, index, data):
+        """ merge one worker's board message into data_frontend """
+        link = self.links[index]
+        if "full" in data:
+            for addr in [addr for addr, owner in self.owner.items() if owner == index and addr not in data["full"]]:
+                self._remove(addr)
+            for addr, fields in data["full"].items():
+                self._update(index, addr, fields)
+        else:
+            if link[1] is not None and data["seq"] != link[1] + 1:
+                # 不應該發生（Unix socket 不會掉資料），保險起見要一份完整狀態
+                link[1] = None
+                await self._send(index, {"cmd": "resync"})
+                return
+            for addr, fields in data["changes"].items():
+                self._update(index, addr, fields)
+            for addr in data["removed"]:
+                self._remove(addr)
+        link[1] = data["seq"]
+        self.callback(self.data_frontend)
+
+    def _update(self, index, addr, fields):
+        self.data_frontend.setdefault(addr, {}).update(fields)
+        self.owner[addr] = index
+        self.board_version += 1
+        self.versions[addr] = self.board_version
+        name = self.data_frontend[addr].get("name")
+        if name is not None:
+            self.mcuid_ip[name] = addr
+
+    def _remove(self, addr):
+        fields = self.data_frontend.pop(addr, {})
+        self.owner.pop(addr, None)
+        self.versions.pop(addr, None)
+        self.board_version += 1
+        if self.mcuid_ip.get(fields.get("name")) == addr:
+            del self.mcuid_ip[fields["name"]]
+
+    def _drop_worker(self, index):
+        """ a worker is gone: its devices are no longer connected """
+        self.links.pop(index, None)
+        self.worker_stats.pop(index, None)
+        for addr in [addr for addr, owner in self.owner.items() if owner == index]:
+            name = self.data_frontend.get(addr, {}).get("name")
+            if name and self.mcuid_ip.get(name) == addr:
+                discard_window(window_path(name))  # worker 沒機會在斷線時移除自己的即時視窗檔
+            self._remove(addr)
+        self.callback(self.data_frontend)
@@ -0,0 +1,159 @@
+"""
+Event-loop health: how late the loop runs, and what blocked it.
+
+A sampler task sleeps LOOP_LAG_INTERVAL seconds and records how much
+later than that it woke up (event_loop_lag_seconds). A watchdog thread
+checks the sampler's heartbeat; once it is more than
+LOOP_SLOW_THRESHOLD late the loop is stuck in one callback, so the
+watchdog grabs the loop thread's stack (sys._current_frames) and the
+task that is running. When the loop comes back the sampler knows how
+long the stall was and files it under the innermost frame of our own
+code ("site").
+
+    monitor = LoopMonitor()
+    asyncio.create_task(monitor.run())
+    monitor.snapshot()    # -> /debug/loop
+
+LOOP_LAG_INTERVAL     seconds between samples (default 0.1)
+LOOP_SLOW_THRESHOLD   lag that counts as a stall (default 0.1)
+LOOP_STALL_HISTORY    stalls kept for /debug/loop (default 200)
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from collections import deque
+
+import numpy as np
+
+from metrics import Counter, Histogram
+
+LOOP_LAG = Histogram("event_loop_lag_seconds", "How late the loop monitor's timer fired",
+                     buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+LOOP_STALLS = Counter("event_loop_stalls_total", "Loop stalls longer than LOOP_SLOW_THRESHOLD", ("site",))
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STACK_LIMIT = 25
+LAG_WINDOW = 600  # 最近 600 次取樣（預設約一分鐘）算 percentiles
+
+
+def _site(frames):
+    """ innermost frame in this repo's code, else the innermost frame """
+    for frame in reversed(frames):
+        if frame.filename.startswith(APP_DIR) and not frame.filename.endswith("loop_monitor.py"):
+            return f"{os.path.basename(frame.filename)}:{frame.lineno} {frame.name}"
+    if frames:
+        frame = frames[-1]
+        return f"{os.path.basename(frame.filename)}:{frame.lineno} {frame.name}"
+    return "unknown"
+
+
+def _task_name(task):
+    if task is None:
+        return None
+    coro = task.get_coro()
+    return f"{task.get_name()} ({getattr(coro, '__qualname__', coro)})"
+
+
+class LoopMonitor:
+    def __init__(self, interval=None, threshold=None, history=None):
+        self.interval = interval or float(os.environ.get("LOOP_LAG_INTERVAL", "0.1"))
+        self.threshold = threshold or float(os.environ.get("LOOP_SLOW_THRESHOLD", "0.1"))
+        self.lags = deque(maxlen=LAG_WINDOW)
+        self.stalls = deque(maxlen=history or int(os.environ.get("LOOP_STALL_HISTORY", "200")))
+        self.sites = {}  # site -> {"count", "total_seconds", "max_seconds"}
+        self.stats = {"samples": 0, "stalls": 0, "captured": 0, "max_lag_seconds": 0.0}
+        self.loop = None
+        self.thread_id = None
+        self.beat = None
+        self.pending = None  # 看門狗抓到、還沒結束的 stall
+        self._lock = threading.Lock()
+        self._watchdog = None
+        self.running = False
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.running = True
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        try:
+            while self.running:
+                start = time.monotonic()
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                self.beat = now
+                self._sample(now - start - self.interval)
+        finally:
+            self.running = False
+
+    def stop(self):
+        self.running = False
+
+    def _sample(self, lag):
+        lag = max(0.0, lag)
+        LOOP_LAG.observe(lag)
+        self.lags.append(lag)
+        self.stats["samples"] += 1
+        self.stats["max_lag_seconds"] = max(self.stats["max_lag_seconds"], lag)
+        with self._lock:
+            pending, self.pending = self.pending, None
+        if lag < self.threshold:
+            return
+        if pending is None:
+            # 沒被看門狗抓到（執行緒沒搶到 GIL，或 stall 剛好卡在門檻附近），只記時間
+            pending = {"task": None, "site": "unknown", "stack": []}
+        self._record(dict(pending, seconds=round(lag, 4), at=time.time()))
+
+    def _record(self, stall):
+        self.stats["stalls"] += 1
+        self.stalls.append(stall)
+        site = self.sites.setdefault(stall["site"], {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+        site["count"] += 1
+        site["total_seconds"] += stall["seconds"]
+        site["max_seconds"] = max(site["max_seconds"], stall["seconds"])
+        LOOP_STALLS.labels(stall["site"]).inc()
+        print(f"🐢 event loop blocked {stall['seconds'] * 1000:.0f} ms at {stall['site']} (task {stall['task']})")
+
+    def _watch(self):
+        check = self.threshold / 2
+        while self.running:
+            time.sleep(check)
+            beat = self.beat
+            if self.pending is not None or time.monotonic() - beat < self.interval + self.threshold:
+                continue
+            stall = self._capture()
+            with self._lock:
+                # 取樣 task 已經醒來就不算（這次 stall 已經結束）
+                if self.beat == beat:
+                    self.pending = stall
+
+    def _capture(self):
+        frame = sys._current_frames().get(self.thread_id)
+        frames = traceback.extract_stack(frame, limit=STACK_LIMIT) if frame is not None else []
+        try:
+            task = asyncio.current_task(self.loop)
+        except RuntimeError:
+            task = None
+        self.stats["captured"] += 1
+        return {"task": _task_name(task), "site": _site(frames),
+                "stack": [f"{os.path.basename(f.filename)}:{f.lineno} {f.name}: {f.line}" for f in frames]}
+
+    def snapshot(self, limit=10):
+        lags = np.asarray(self.lags) * 1000 if self.lags else np.zeros(1)
+        worst = sorted(self.stalls, key=lambda s: s["seconds"], reverse=True)[:limit]
+        sites = sorted(({"site": site, **values} for site, values in self.sites.items()),
+                       key=lambda s: s["total_seconds"], reverse=True)[:limit]
+        return {
+            "interval": self.interval,
+            "threshold": self.threshold,
+            "lag_ms": {"p50": round(float(np.percentile(lags, 50)), 2), "p99": round(float(np.percentile(lags, 99)), 2),
+                       "max": round(float(lags.max()), 2), "window": len(self.lags)},
+            "stats": dict(self.stats),
+            "worst": worst,
+            "sites": sites,
+            "recent": list(self.stalls)[-limit:][::-1],
+        }
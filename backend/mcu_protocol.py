@@ -0,0 +1,153 @@
+"""
+MCU wire protocol: command frames we send and reply frames we read.
+
+Commands are fixed-size frames, zero padded after the content:
+
+    [0]          0x13
+    [1:3]        command (big endian)
+    [3:5]        content length, checksum included (big endian)
+    [5:n-2]      body
+    [n-2:n]      checksum: sum of bytes [0:n-2] & 0xFFFF (big endian)
+
+Reply frames have no length field. The handshake replies are read with
+read_reply(): at least the bytes we need (13 for the check reply, up to
+the ID for the first data reply), then whatever else arrives until the
+line is quiet for MCU_REPLY_IDLE seconds. Only one command is
+outstanding, so those bytes all belong to that reply. The size of the
+first data reply becomes the connection's frame size. MCU_FRAME_SIZE
+(default 513, the simulator's frame) is only the expected value. Later
+replies are read with read_frame(), exactly one frame each, even when a
+reply arrives split over several TCP segments or two arrive together.
+Fields are unpacked straight from the frame (REPLY_FIELDS, memoryview
+for the ID) without slicing copies. frame_decoder reads the ADC rings
+the same way.
+"""
+import os
+import struct
+import asyncio
+from collections import namedtuple
+
+COMMAND_SIZE = 513
+FRAME_SIZE = int(os.environ.get("MCU_FRAME_SIZE", "513"))
+MAX_REPLY_SIZE = 1400  # 舊版一次 read(1400)
+REPLY_IDLE = float(os.environ.get("MCU_REPLY_IDLE", "0.2"))
+START_BYTE = 0x13
+
+CMD_CHECK = 0x0001
+CMD_DATA = 0x0028
+CMD_AUTOSCALING = 0x0089
+
+REPLY_OK = 0x03
+OUT_OF_BED_CODE = 79
+ID_OFFSET = 432
+ID_SIZE = 16
+CHECK_REPLY_MIN = 13  # 舊版的判斷：len(data) >= 13 and data[5] == 0x03
+DATA_REPLY_MIN = ID_OFFSET + ID_SIZE
+
+COMMAND_HEADER = struct.Struct('>BHH')
+CHECKSUM = struct.Struct('>H')
+ADC_INDEX = struct.Struct('>H')
+
+# [5] status, [6:8] ADC ring position, [12] heart, [13] resp, [14] out of bed (79),
+# [15] movement, [24] autoscaling, [27] RSSI (signed)
+REPLY_FIELDS = struct.Struct('>5xBH4xBBBB8xB2xb')
+ReplyFields = namedtuple('ReplyFields', 'status adc_index heart_rate resp_rate outofbed movement autoscaling rssi')
+
+
+class CommandBuffer:
+    """
+    One preallocated command frame. Body fields are written in place and
+    the checksum is updated from the difference of the changed bytes only.
+    """
+
+    def __init__(self, command, body=b'', size=COMMAND_SIZE):
+        length = COMMAND_HEADER.size + len(body) + CHECKSUM.size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        COMMAND_HEADER.pack_into(self.buffer, 0, START_BYTE, command, length)
+        self.buffer[COMMAND_HEADER.size:COMMAND_HEADER.size + len(body)] = body
+        self.checksum_offset = length - CHECKSUM.size
+        self._sum = sum(self.view[:self.checksum_offset])
+        self._write_checksum()
+
+    def _write_checksum(self):
+        CHECKSUM.pack_into(self.buffer, self.checksum_offset, self._sum & 0xFFFF)
+
+    def set_body(self, offset, data):
+        """ overwrite body bytes at `offset` (relative to the body start) """
+        start = COMMAND_HEADER.size + offset
+        end = start + len(data)
+        if end > self.checksum_offset:
+            raise ValueError("field runs into the checksum")
+        old = self.view[start:end]
+        if old == data:
+            return
+        self._sum += sum(data) - sum(old)
+        self.buffer[start:end] = data
+        self._write_checksum()
+
+    @property
+    def checksum(self):
+        return CHECKSUM.unpack_from(self.buffer, self.checksum_offset)[0]
+
+
+class DataCommand(CommandBuffer):
+    """ data command: body = local time 'YYYYmmddHHMM' (ascii) + 00 01 """
+
+    def __init__(self):
+        super().__init__(CMD_DATA, b'0' * 12 + b'\x00\x01')
+        self._minute = None
+
+    def set_time(self, now):
+        # 時間只到分鐘，同一分鐘內不用重寫也不用重算 checksum
+        minute = now.strftime("%Y%m%d%H%M")
+        if minute != self._minute:
+            self.set_body(0, minute.encode("ascii"))
+            self._minute = minute
+        return self.buffer
+
+
+def check_command():
+    return bytes(CommandBuffer(CMD_CHECK, b'\x00\x01').buffer)
+
+
+def autoscaling_command():
+    return bytes(CommandBuffer(CMD_AUTOSCALING, bytes([0x14, 0xEB, 1, 1, 0x00, 0x01])).buffer)
+
+
+CHECK_COMMAND = check_command()
+
+
+async def read_frame(reader, size=FRAME_SIZE):
+    """ exactly one reply frame; ConnectionError when the MCU closes mid-frame """
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionError(f"MCU disconnected ({len(e.partial)}/{size} bytes of a frame)")
+
+
+async def read_reply(reader, min_size, max_size=MAX_REPLY_SIZE, idle=None):
+    """
+    one reply of unknown length: at least `min_size` bytes, then whatever
+    follows until the MCU is quiet for `idle` seconds (or max_size)
+    """
+    idle = REPLY_IDLE if idle is None else idle
+    reply = bytearray(await read_frame(reader, min_size))
+    while len(reply) < max_size:
+        try:
+            chunk = await asyncio.wait_for(reader.read(max_size - len(reply)), timeout=idle)
+        except asyncio.TimeoutError:
+            break
+        if not chunk:
+            raise ConnectionError(f"MCU disconnected after {len(reply)} bytes of a reply")
+        reply += chunk
+    return bytes(reply)
+
+
+def parse_reply(frame):
+    return ReplyFields._make(REPLY_FIELDS.unpack_from(frame))
+
+
+def reply_id(frame):
+    view = memoryview(frame)[ID_OFFSET:ID_OFFSET + ID_SIZE]
+    return bytes(view).decode('ascii').rstrip('\x00')
@@ -0,0 +1,188 @@
+"""
+Virtual mattress MCUs for load testing AsyncTCPServer without hardware.
+
+Each bed answers every command (check, ID and data commands alike; the
+server sends one and waits for the answer) with a MCU_FRAME_SIZE reply
+in the real layout (see mcu_protocol):
+
+    [5]        0x03
+    [6:8]      ADC ring write position (big endian)
+    [12] [13]  heart / resp rate
+    [14]       79 when out of bed
+    [15]       movement
+    [24]       autoscaling
+    [27]       RSSI (signed)
+    [32:232]   raw ADC ring, 100 x uint16 big endian
+    [232:432]  heart ADC ring, 100 x uint16 big endian
+    [432:448]  MCU ID (ascii, zero padded)
+
+The rings are filled from wall-clock time at 100 Hz, so a server that
+polls too slowly loses samples exactly like with a real bed. Waveforms:
+respiration swing plus a small ballistocardiogram on the raw channel, a
+pulse train at the heart rate on the heart channel; beds now and then
+move or get up.
+
+    python mcu_simulator.py --beds 500 --host 127.0.0.1 --port 5001
+"""
+import sys
+import time
+import asyncio
+import argparse
+import numpy as np
+
+from frame_decoder import RAW_OFFSET, HEART_OFFSET, ADC_RING_SIZE
+from mcu_protocol import FRAME_SIZE, REPLY_OK, ID_OFFSET, ID_SIZE, OUT_OF_BED_CODE, ADC_INDEX
+
+COMMAND_READ_SIZE = 2048
+SAMPLE_RATE = 100
+
+
+class VirtualBed:
+    def __init__(self, mcu_id, seed=None, sample_rate=SAMPLE_RATE, now=None):
+        self.mcu_id = mcu_id
+        self.rng = np.random.default_rng(seed)
+        self.sample_rate = sample_rate
+        self.t0 = time.monotonic() if now is None else now
+        self.produced = 0
+        self.raw_ring = np.zeros(ADC_RING_SIZE, dtype='>u2')
+        self.heart_ring = np.zeros(ADC_RING_SIZE, dtype='>u2')
+        self.heart_rate = float(self.rng.uniform(55, 80))
+        self.resp_rate = float(self.rng.uniform(12, 18))
+        self.baseline = float(self.rng.uniform(1800, 2400))
+        self.rssi = int(self.rng.integers(-80, -40))
+        self.movement = 0
+        self.outofbed = 0
+        self.autoscaling = 0
+        self.state_until = 0.0
+        self.phase_heart = float(self.rng.uniform(0, 1))
+        self.phase_resp = float(self.rng.uniform(0, 1))
+        self.reply = bytearray(FRAME_SIZE)
+        self.reply[5] = REPLY_OK
+        name = mcu_id.encode('ascii')[:ID_SIZE]
+        self.reply[ID_OFFSET:ID_OFFSET + len(name)] = name
+
+    def _update_state(self, t):
+        """ slow drift of the vitals, occasional movement / out-of-bed episodes """
+        if t < self.state_until:
+            return
+        self.heart_rate = float(np.clip(self.heart_rate + self.rng.normal(0, 1.5), 45, 110))
+        self.resp_rate = float(np.clip(self.resp_rate + self.rng.normal(0, 0.5), 8, 26))
+        self.rssi = int(np.clip(self.rssi + self.rng.integers(-2, 3), -90, -30))
+        roll = self.rng.random()
+        if self.outofbed:
+            self.outofbed = int(roll < 0.7)
+        else:
+            self.outofbed = int(roll < 0.01)
+        self.movement = int(not self.outofbed and self.rng.random() < 0.08)
+        self.state_until = t + float(self.rng.uniform(2, 10))
+
+    def _samples(self, n, start):
+        t = (start + np.arange(n)) / self.sample_rate
+        if self.outofbed:
+            raw = 300 + self.rng.normal(0, 8, n)
+            heart = 2048 + self.rng.normal(0, 15, n)
+        else:
+            resp = np.sin(2 * np.pi * (self.resp_rate / 60 * t + self.phase_resp))
+            beat = (self.heart_rate / 60 * t + self.phase_heart) % 1.0
+            pulse = np.exp(-((beat - 0.3) / 0.04) ** 2) - 0.4 * np.exp(-((beat - 0.42) / 0.06) ** 2)
+            raw = self.baseline + 150 * resp + 20 * pulse + self.rng.normal(0, 6, n)
+            heart = 2048 + 800 * pulse + 60 * resp + self.rng.normal(0, 20, n)
+            if self.movement:
+                raw += np.cumsum(self.rng.normal(0, 40, n))
+                heart += self.rng.normal(0, 300, n)
+        return np.clip(raw, 0, 4095), np.clip(heart, 0, 4095)
+
+    def advance(self, now=None):
+        """ write the samples due until `now` into the rings """
+        now = time.monotonic() if now is None else now
+        self._update_state(now - self.t0)
+        due = int((now - self.t0) * self.sample_rate) - self.produced
+        if due <= 0:
+            return 0
+        # 超過一圈的部分反正會被覆蓋，只產生最後一圈
+        skip = max(0, due - ADC_RING_SIZE)
+        raw, heart = self._samples(due - skip, self.produced + skip)
+        idx = (self.produced + skip + np.arange(due - skip)) % ADC_RING_SIZE
+        self.raw_ring[idx] = raw
+        self.heart_ring[idx] = heart
+        self.produced += due
+        return due
+
+    def build_reply(self, now=None):
+        self.advance(now)
+        reply = self.reply
+        ADC_INDEX.pack_into(reply, 6, self.produced % ADC_RING_SIZE)
+        reply[12] = 0 if self.outofbed else int(round(self.heart_rate))
+        reply[13] = 0 if self.outofbed else int(round(self.resp_rate))
+        reply[14] = OUT_OF_BED_CODE if self.outofbed else 0
+        reply[15] = self.movement
+        reply[24] = self.autoscaling
+        reply[27] = self.rssi & 0xFF
+        reply[RAW_OFFSET:RAW_OFFSET + 2 * ADC_RING_SIZE] = self.raw_ring.tobytes()
+        reply[HEART_OFFSET:HEART_OFFSET + 2 * ADC_RING_SIZE] = self.heart_ring.tobytes()
+        return bytes(reply)
+
+
+async def run_bed(host, port, bed, stats, reply_delay=0.0, stop_at=None):
+    """ one TCP connection: answer every command until the server closes it (or stop_at) """
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        stats["connect_errors"] += 1
+        return
+    stats["connected"] += 1
+    try:
+        while stop_at is None or time.monotonic() < stop_at:
+            command = await reader.read(COMMAND_READ_SIZE)
+            if not command:
+                break
+            if reply_delay:
+                await asyncio.sleep(reply_delay)
+            writer.write(bed.build_reply())
+            await writer.drain()
+            stats["frames"] += 1
+    except ConnectionError:
+        stats["dropped"] += 1
+    finally:
+        stats["connected"] -= 1
+        writer.close()
+
+
+async def run_fleet(host, port, beds, prefix="SIM", first=0, ramp=200.0, duration=None, reply_delay=0.0, seed=0):
+    """ start `beds` virtual beds, `ramp` new connections per second; returns the fleet stats """
+    stats = {"frames": 0, "connected": 0, "connect_errors": 0, "dropped": 0}
+    stop_at = None if duration is None else time.monotonic() + duration
+    tasks = []
+    for i in range(first, first + beds):
+        bed = VirtualBed(f"{prefix}-{i:05d}", seed=seed + i)
+        tasks.append(asyncio.create_task(run_bed(host, port, bed, stats, reply_delay, stop_at)))
+        if ramp:
+            await asyncio.sleep(1.0 / ramp)
+    await asyncio.gather(*tasks)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulated mattress MCUs speaking the ingest TCP protocol")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--beds", type=int, default=10)
+    parser.add_argument("--prefix", default="SIM", help="MCU IDs are PREFIX-00000, PREFIX-00001, ...")
+    parser.add_argument("--first", type=int, default=0, help="number of the first bed")
+    parser.add_argument("--ramp", type=float, default=200.0, help="new connections per second (0: all at once)")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run (default: until interrupted)")
+    parser.add_argument("--reply-delay", type=float, default=0.0, help="seconds each bed waits before replying")
+    args = parser.parse_args(argv)
+
+    print(f"🛏️ starting {args.beds} virtual beds against {args.host}:{args.port}")
+    try:
+        stats = asyncio.run(run_fleet(args.host, args.port, args.beds, args.prefix, args.first,
+                                      args.ramp, args.duration, args.reply_delay))
+    except KeyboardInterrupt:
+        return 0
+    print(f"✅ {stats}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,292 @@
+"""
+In-process metrics in the Prometheus text format (0.0.4), served at
+/metrics by both services. No client library: a metric is a dict of
+label values -> child, a child is a few floats, so updating one is a
+dict lookup and an add. Hot paths keep the child (metric.labels(...))
+and only call inc()/observe() per frame.
+
+    FRAMES = Counter("ingest_frames_total", "Frames received", ("mcu_id",))
+    FRAMES.labels(mcu_id).inc()
+    RTT = Histogram("ingest_frame_rtt_seconds", "Data command -> reply", buckets=...)
+    RTT.observe(0.012)
+
+Per-device labels are on by default; METRICS_DEVICE_LABELS=0 folds every
+device into mcu_id="all" when there are too many beds for the scraper.
+
+Metrics of other processes (ingest_shard workers) are merged at render
+time: collect() gives JSON-able families, render(families) writes them.
+"""
+import os
+import time
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEVICE_LABELS = os.environ.get("METRICS_DEVICE_LABELS", "1") != "0"
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAST_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+
+def device_label(mcu_id):
+    return mcu_id if DEVICE_LABELS else "all"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"metric {metric.name} already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def collect(self):
+        """ [{"name", "type", "help", "samples": [[name, {label: value}, value], ...]}] """
+        return [metric.family() for metric in list(self.metrics.values())]
+
+
+REGISTRY = Registry()
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最後一格是 +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class _Metric:
+    kind = None
+    child_class = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}  # 沒有 label 的 metric 在第一次更新時才出現，沒用到的程序不會輸出一串 0
+        if registry is not None:
+            registry.register(self)
+
+    def _new_child(self):
+        return self.child_class()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self.children[values] = self._new_child()
+        return child
+
+    def remove(self, *values):
+        self.children.pop(values, None)
+
+    def _label_dict(self, values):
+        return dict(zip(self.labelnames, values))
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield [self.name, self._label_dict(values), child.value]
+
+    def family(self):
+        return {"name": self.name, "type": self.kind, "help": self.help, "samples": list(self.samples())}
+
+
+class Counter(_Metric):
+    kind = "counter"
+    child_class = _CounterChild
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+    child_class = _GaugeChild
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            labels = self._label_dict(values)
+            counts = list(child.counts)
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float("inf"),), counts):
+                cumulative += count
+                yield [self.name + "_bucket", dict(labels, le=_format_value(bound)), cumulative]
+            yield [self.name + "_sum", labels, child.sum]
+            yield [self.name + "_count", labels, cumulative]
+
+
+class Callback(_Metric):
+    """ value(s) read at scrape time: fn() -> number, or {label value: number} with one label """
+
+    def __init__(self, name, help, fn, kind="gauge", labelnames=(), registry=REGISTRY):
+        self.fn = fn
+        self.kind = kind
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return None
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return
+        if not self.labelnames:
+            yield [self.name, {}, value]
+            return
+        for key, item in list(value.items()):
+            if isinstance(item, (int, float)) and not isinstance(item, bool):
+                yield [self.name, {self.labelnames[0]: key}, item]
+
+
+def stats_gauge(name, help, stats_fn, registry=REGISTRY):
+    """ expose the numeric entries of an existing .stats dict as {name}{key="..."} """
+    return Callback(name, help, stats_fn, labelnames=("key",), registry=registry)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if value == float("-inf"):
+        return "-Inf"
+    if value != value:
+        return "NaN"
+    if float(value).is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def with_labels(families, **labels):
+    """ families of another process with extra labels, e.g. worker="1" """
+    return [dict(family, samples=[[name, dict(sample_labels, **labels), value]
+                                  for name, sample_labels, value in family["samples"]])
+            for family in families]
+
+
+def render(families=None):
+    """ Prometheus text of `families` (default: this process); families with the same name are merged """
+    if families is None:
+        families = REGISTRY.collect()
+    merged = {}
+    for family in families:
+        entry = merged.get(family["name"])
+        if entry is None:
+            merged[family["name"]] = dict(family, samples=list(family["samples"]))
+        else:
+            entry["samples"].extend(family["samples"])
+    lines = []
+    for family in merged.values():
+        lines.append(f"# HELP {family['name']} {_escape(family['help'])}")
+        lines.append(f"# TYPE {family['name']} {family['type']}")
+        for name, labels, value in family["samples"]:
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# ---- process ----
+
+def _cpu_seconds():
+    times = os.times()
+    return times.user + times.system
+
+
+def _resident_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+_START_TIME = time.time()
+Callback("process_cpu_seconds_total", "User and system CPU time of this process", _cpu_seconds, kind="counter")
+Callback("process_resident_memory_bytes", "Resident memory of this process", _resident_bytes)
+Callback("process_start_time_seconds", "Start time of this process (unix epoch)", lambda: _START_TIME)
+
+
+# ---- HTTP ----
+
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds",
+                                 "Handler time until the response starts, by route template",
+                                 ("method", "route", "status"))
+
+
+def observe_requests(app):
+    """ FastAPI middleware: latency of every request, labelled by route template (not the raw path) """
+
+    @app.middleware("http")
+    async def _observe(request, call_next):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            route = request.scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.labels(request.method, path, str(status)).observe(time.perf_counter() - start)
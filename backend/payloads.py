@@ -0,0 +1,107 @@
+"""
+Pre-serialized JSON responses for the endpoints every dashboard polls
+(/status, /mcu/{id}, /mcu_real_time_data/{id}).
+
+The ingest side keeps version numbers that change whenever the data
+behind a payload changes (AsyncTCPServer.board_version / versions /
+realtime_version). A payload is encoded once per version and the same
+bytes go to every client until the version moves; the ETag is the
+version, so a client that already has it gets a 304 without the body
+being built at all.
+
+orjson is used when it is installed, json otherwise (same document).
+PAYLOAD_CACHE_BYTES bounds the cached bodies (LRU, default 64 MB).
+"""
+import os
+import json
+import time
+from collections import OrderedDict, namedtuple
+
+from fastapi.responses import Response
+
+from day_export import etag_matches
+
+try:
+    import orjson
+except ImportError:  # 沒有 orjson 時改用標準 json
+    orjson = None
+
+PAYLOAD_CACHE_BYTES = int(os.environ.get("PAYLOAD_CACHE_BYTES", str(64 * 1024 * 1024)))
+# ETag 內含程序啟動時間：重啟後 version 從頭數，舊的 ETag 不能再對上
+BOOT_ID = f"{os.getpid():x}{int(time.time() * 1000):x}"
+
+Payload = namedtuple("Payload", "body etag")
+
+
+def _default(value):
+    if hasattr(value, "tolist"):  # numpy 陣列與純量
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    """ compact UTF-8 JSON bytes """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+def make_etag(version):
+    if isinstance(version, tuple):
+        version = "-".join(str(part) for part in version)
+    return f'"{BOOT_ID}-{version}"'
+
+
+class PayloadCache:
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes or PAYLOAD_CACHE_BYTES
+        self._entries = OrderedDict()  # key -> (version, Payload)
+        self.bytes = 0
+        self.stats = {"hits": 0, "builds": 0, "not_modified": 0, "evictions": 0, "build_seconds": 0.0}
+
+    def get(self, key, version, build):
+        """ Payload of `key` at `version`; build() -> JSON-able object, only called when the version is new """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+        start = time.perf_counter()
+        payload = Payload(dumps(build()), make_etag(version))
+        self.stats["builds"] += 1
+        self.stats["build_seconds"] += time.perf_counter() - start
+        self._store(key, version, payload)
+        return payload
+
+    def _store(self, key, version, payload):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old[1].body)
+        if len(payload.body) > self.max_bytes:
+            return
+        self._entries[key] = (version, payload)
+        self.bytes += len(payload.body)
+        while self.bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.bytes -= len(evicted.body)
+            self.stats["evictions"] += 1
+
+    def drop(self, key):
+        """ forget the payload of `key` (its data is gone, e.g. the device disconnected) """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry[1].body)
+
+    def respond(self, request, key, version, build):
+        """ 304 when the client's If-None-Match is this version (nothing is built), else the cached bytes """
+        etag = make_etag(version)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            self.stats["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+        payload = self.get(key, version, build)
+        return Response(payload.body, media_type="application/json", headers=headers)
+
+    def snapshot_stats(self):
+        return dict(self.stats, entries=len(self._entries), bytes=self.bytes, max_bytes=self.max_bytes,
+                    encoder="orjson" if orjson is not None else "json")
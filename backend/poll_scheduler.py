@@ -0,0 +1,96 @@
+"""
+Per-connection poll timing. The MCU writes its samples into a 100-slot
+ADC ring and we read the new part on every data command; polling too
+rarely lets the ring wrap (samples lost), polling too often only costs
+round trips. Instead of a fixed sleep the next poll is planned so that
+the reply comes back when the ring is about POLL_TARGET_FILL full:
+
+    next poll = last reply + target_fill * ring / fill_rate - rtt
+
+fill_rate (samples/s) and rtt are moving averages of what the
+connection actually shows.
+
+POLL_MIN_INTERVAL / POLL_MAX_INTERVAL  bounds of the sleep (seconds, default 0.1 / 0.8)
+POLL_TARGET_FILL                       ring fraction per poll (default 0.5)
+
+The server sizes each connection's minute buffers from min_interval
+(frames_per_minute). Whatever still does not fit before the minute is
+flushed is counted here (overflow_frames / overflow_samples).
+"""
+import os
+import math
+import time
+
+from frame_decoder import ADC_RING_SIZE
+
+
+class PollScheduler:
+    def __init__(self, capacity=ADC_RING_SIZE, min_interval=None, max_interval=None, target_fill=None,
+                 initial_interval=0.5, smoothing=0.2):
+        self.capacity = capacity
+        self.min_interval = min_interval or float(os.environ.get("POLL_MIN_INTERVAL", "0.1"))
+        self.max_interval = max_interval or float(os.environ.get("POLL_MAX_INTERVAL", "0.8"))
+        self.target_fill = target_fill or float(os.environ.get("POLL_TARGET_FILL", "0.5"))
+        self.initial_interval = initial_interval
+        self.smoothing = smoothing
+        self.fill_rate = None  # samples/s
+        self.rtt = None  # seconds
+        self.last_reply = None  # time.monotonic() of the last reply
+        self.stats = {"polls": 0, "samples": 0, "overruns": 0, "lost_samples": 0,
+                      "max_fill": 0, "last_delay": initial_interval, "overflow_frames": 0, "overflow_samples": 0}
+
+    def _average(self, old, new):
+        return new if old is None else old + self.smoothing * (new - old)
+
+    def observe(self, samples, rtt, now=None):
+        """
+        a reply with `samples` new ring values arrived `rtt` seconds after the
+        command was sent; returns the number of samples lost since the last reply
+        """
+        now = time.monotonic() if now is None else now
+        lost = 0
+        if self.last_reply is not None:
+            elapsed = now - self.last_reply
+            expected = self.fill_rate * elapsed if self.fill_rate else samples
+            if expected >= self.capacity:
+                # ring 已經繞過一圈以上：讀到的只是最後不到一圈的部分
+                lost = max(0, int(round(expected)) - samples)
+                self.stats["overruns"] += 1
+                self.stats["lost_samples"] += lost
+            elif elapsed > 0 and samples < self.capacity:
+                # samples == capacity 代表 ring 位置沒變（全新一圈或沒有新資料），不拿來估速率
+                self.fill_rate = self._average(self.fill_rate, samples / elapsed)
+            self.stats["polls"] += 1
+            self.stats["samples"] += samples
+            self.stats["max_fill"] = max(self.stats["max_fill"], samples)
+        self.rtt = self._average(self.rtt, rtt)
+        self.last_reply = now
+        return lost
+
+    def frames_per_minute(self):
+        """ most replies one minute can hold at the shortest poll interval """
+        return math.ceil(60 / max(self.min_interval, 0.01))
+
+    def record_overflow(self, frames, samples):
+        """ frames / ADC samples that did not fit in the minute buffers before the flush """
+        self.stats["overflow_frames"] += frames
+        self.stats["overflow_samples"] += samples
+
+    def next_delay(self, now=None):
+        """ seconds to sleep before sending the next data command """
+        if not self.fill_rate or self.last_reply is None:
+            delay = self.initial_interval
+        else:
+            now = time.monotonic() if now is None else now
+            cycle = self.target_fill * self.capacity / self.fill_rate
+            delay = self.last_reply + cycle - self.rtt - now
+        delay = min(self.max_interval, max(self.min_interval, delay))
+        self.stats["last_delay"] = round(delay, 4)
+        return delay
+
+    def snapshot_stats(self):
+        return dict(self.stats,
+                    fill_rate=None if self.fill_rate is None else round(self.fill_rate, 2),
+                    rtt_ms=None if self.rtt is None else round(self.rtt * 1000, 2),
+                    min_interval=self.min_interval, max_interval=self.max_interval,
+                    target_fill=self.target_fill)
@@ -0,0 +1,238 @@
+"""
+Shared-memory realtime window: the ingest process keeps each device's
+realtime ring buffers directly inside an mmap'ed file
+({REALTIME_SHM_DIR}/{mcu_id}.rt) and the download service maps the same
+file read-only, so /realtime needs no HTTP hop and no serialization.
+
+Layout: HEADER (magic, layout version, seq, window id) + COLUMN_STATE
+(head, size, appended) per column, then each column's double-length ring
+array. seq is a seqlock counter: odd while the writer is updating,
+readers retry until they see the same even value before and after
+copying. The window id is new for every file (inodes get reused), so
+(window id, seq) identifies the content across reconnects.
+
+A window lives as long as its device's connection: the ingest side
+removes the file on disconnect (RealtimePublisher.remove) and clears
+what an earlier run left behind before accepting devices
+(clear_windows), so a window file always means a connected device.
+Removed windows are marked DEAD first, so a reader still mapping the
+old file drops it instead of serving it.
+"""
+import os
+import mmap
+import time
+import struct
+import numpy as np
+from urllib.parse import quote
+
+from ring_buffer import RingBuffer
+from snapshot_store import format_epochs
+
+REALTIME_SHM_DIR = os.environ.get("REALTIME_SHM_DIR", "/app/snapshots/.realtime")
+MAGIC = b'RTW1'
+DEAD = b'RTW0'  # 檔案已被移除（裝置斷線），仍 map 著的讀取端要放掉
+LAYOUT_VERSION = 3
+HEADER = struct.Struct('<4sIQQ')
+COLUMN_STATE = struct.Struct('<IIQ')
+
+# 與 AsyncTCPServer 即時圖表相同的容量：rate 4 小時（每分鐘一筆），status 4*60*100 筆
+REALTIME_COLUMNS = (
+    ('heart_rate', 4 * 60, np.float64),
+    ('resp_rate', 4 * 60, np.float64),
+    ('rate_timestamp', 4 * 60, np.int64),
+    ('status', 4 * 60 * 100, np.int8),
+    ('status_timestamp', 4 * 60 * 100, np.int64),
+)
+
+
+def _layout():
+    offset = HEADER.size + COLUMN_STATE.size * len(REALTIME_COLUMNS)
+    offset = (offset + 63) // 64 * 64
+    layout = []
+    for name, capacity, dtype in REALTIME_COLUMNS:
+        nbytes = RingBuffer.nbytes_for(capacity, dtype)
+        layout.append((name, capacity, dtype, offset, nbytes))
+        offset = (offset + nbytes + 63) // 64 * 64
+    return layout, offset
+
+
+def window_path(mcu_id, directory=None):
+    return os.path.join(directory or REALTIME_SHM_DIR, f"{quote(mcu_id, safe='')}.rt")
+
+
+class RealtimePublisher:
+    """ writer side: owns the realtime ring buffers of one device inside the shared file """
+
+    def __init__(self, mcu_id, directory=None):
+        directory = directory or REALTIME_SHM_DIR
+        os.makedirs(directory, exist_ok=True)
+        layout, total = _layout()
+        path = window_path(mcu_id, directory)
+        # 新檔案寫好後再 rename，讀取端若還 map 著舊檔案也不會讀到半成品
+        with open(path + ".tmp", "w+b") as f:
+            f.truncate(total)
+            self._mm = mmap.mmap(f.fileno(), total)
+        self.window_id = time.time_ns()
+        HEADER.pack_into(self._mm, 0, MAGIC, LAYOUT_VERSION, 0, self.window_id)
+        os.replace(path + ".tmp", path)
+        self.path = path
+        self.inode = os.stat(path).st_ino
+        self.seq = 0
+        self.buffers = {}
+        for name, capacity, dtype, offset, nbytes in layout:
+            self.buffers[name] = RingBuffer(capacity, dtype, memoryview(self._mm)[offset:offset + nbytes])
+
+    def begin(self):
+        self.seq += 1  # odd: update in progress
+        HEADER.pack_into(self._mm, 0, MAGIC, LAYOUT_VERSION, self.seq, self.window_id)
+
+    def publish(self):
+        for i, (name, _, _) in enumerate(REALTIME_COLUMNS):
+            COLUMN_STATE.pack_into(self._mm, HEADER.size + i * COLUMN_STATE.size, *self.buffers[name].state)
+        self.seq += 1  # even: consistent
+        HEADER.pack_into(self._mm, 0, MAGIC, LAYOUT_VERSION, self.seq, self.window_id)
+
+    def remove(self):
+        """ mark the window dead and unlink it (device disconnected); a newer publisher's file is left alone """
+        self._mm[0:len(DEAD)] = DEAD
+        try:
+            if os.stat(self.path).st_ino == self.inode:
+                os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def discard_window(path):
+    """ mark a window file dead and unlink it, for files whose publisher is gone; False if there was none """
+    try:
+        with open(path, "r+b") as f:
+            f.write(DEAD)
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def clear_windows(directory=None):
+    """ discard every window file (left by an earlier run), returns how many """
+    directory = directory or REALTIME_SHM_DIR
+    if not os.path.isdir(directory):
+        return 0
+    count = 0
+    for name in os.listdir(directory):
+        if name.endswith((".rt", ".rt.tmp")):
+            count += discard_window(os.path.join(directory, name))
+    return count
+
+
+class RealtimeReader:
+    """ reader side (download service): maps each device's window read-only """
+
+    def __init__(self, directory=None):
+        self.directory = directory or REALTIME_SHM_DIR
+        self._maps = {}  # mcu_id -> (inode, mmap)
+        self._rings = {}  # mcu_id -> (window id, {column: RingBuffer}) local copies, see rings()
+
+    def _map(self, mcu_id):
+        path = window_path(mcu_id, self.directory)
+        try:
+            inode = os.stat(path).st_ino
+        except FileNotFoundError:
+            self._maps.pop(mcu_id, None)
+            return None
+        cached = self._maps.get(mcu_id)
+        # 同一個 inode 可能已是新檔案：舊檔案移除前會標成 DEAD
+        if cached and cached[0] == inode and cached[1][0:len(MAGIC)] == MAGIC:
+            return cached[1]
+        self._maps.pop(mcu_id, None)
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mm) < HEADER.size:
+            return None
+        magic, layout_version, _, _ = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or layout_version != LAYOUT_VERSION:
+            return None
+        self._maps[mcu_id] = (inode, mm)
+        return mm
+
+    def version(self, mcu_id):
+        """ current seq of a device window (None if there is none), cheap change detection """
+        mm = self._map(mcu_id)
+        if mm is None:
+            return None
+        _, _, seq, window_id = HEADER.unpack_from(mm, 0)
+        return (window_id, seq)
+
+    def _read(self, mcu_id, retries=50):
+        """ -> (version, {column: (ndarray copy, appended)}) or (None, None) """
+        mm = self._map(mcu_id)
+        if mm is None:
+            return None, None
+        layout, _ = _layout()
+        for attempt in range(retries):
+            magic, _, seq, window_id = HEADER.unpack_from(mm, 0)
+            if magic != MAGIC:
+                return None, None
+            if seq % 2:
+                # writer 更新到一半（可能剛好被搶走 CPU）：先讓出執行權，之後再稍等
+                time.sleep(0 if attempt < 10 else 0.001)
+                continue
+            columns = {}
+            for i, (name, capacity, dtype, offset, nbytes) in enumerate(layout):
+                head, size, appended = COLUMN_STATE.unpack_from(mm, HEADER.size + i * COLUMN_STATE.size)
+                ring = RingBuffer.attach(capacity, dtype, memoryview(mm)[offset:offset + nbytes], head, size)
+                columns[name] = (ring.view().copy(), appended)
+            if HEADER.unpack_from(mm, 0)[2] == seq:
+                return (window_id, seq), columns
+        return None, None
+
+    def read(self, mcu_id, retries=50):
+        """ -> (version, {column: ndarray copy}) or (None, None) """
+        version, columns = self._read(mcu_id, retries)
+        if columns is None:
+            return None, None
+        return version, {name: values for name, (values, _) in columns.items()}
+
+    def rings(self, mcu_id):
+        """
+        {column: RingBuffer} holding a consistent copy of the window, with
+        the writer's appended counters; the same objects are refreshed until
+        the window file is recreated (device reconnected), like the ingest
+        process' own mcu_id_realTime_data entry
+        """
+        version, columns = self._read(mcu_id)
+        if columns is None:
+            self._rings.pop(mcu_id, None)
+            return None
+        cached = self._rings.get(mcu_id)
+        if cached is None or cached[0] != version[0]:
+            cached = (version[0], {name: RingBuffer(capacity, dtype) for name, capacity, dtype in REALTIME_COLUMNS})
+            self._rings[mcu_id] = cached
+        for name, ring in cached[1].items():
+            values, appended = columns[name]
+            ring.clear()
+            ring.extend(values)
+            ring.appended = appended
+        return cached[1]
+
+    def has_window(self, mcu_id):
+        """ False when the device has no window file (not connected to the ingest service) """
+        return os.path.exists(window_path(mcu_id, self.directory))
+
+    def window_id(self, mcu_id):
+        """ window id of the rings the last rings(mcu_id) returned """
+        cached = self._rings.get(mcu_id)
+        return cached[0] if cached else None
+
+    def read_realtime_data(self, mcu_id):
+        """ same dict layout as the ingest /mcu_real_time_data endpoint """
+        version, columns = self.read(mcu_id)
+        if columns is None:
+            return None, None
+        return version, {
+            'heart_rate': columns['heart_rate'].tolist(),
+            'resp_rate': columns['resp_rate'].tolist(),
+            'rate_timestamp': format_epochs(columns['rate_timestamp']),
+            'status': columns['status'].tolist(),
+            'status_timestamp': format_epochs(columns['status_timestamp']),
+        }
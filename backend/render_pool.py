@@ -0,0 +1,102 @@
+"""
+Process pool for chart rendering. matplotlib holds the GIL for the whole
+plot/savefig, so rendering inside the async handlers (or in to_thread)
+stalls every other request of the download service. Jobs are sent to a
+few warm worker processes instead; handlers only await the result.
+
+RENDER_WORKERS      worker processes (default: cpu count, at most 4)
+RENDER_TIMEOUT      seconds a handler waits for one job (default 60)
+RENDER_MAX_PENDING  jobs queued or running before new ones get RenderBusy
+"""
+import os
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import charts
+
+
+class RenderBusy(Exception):
+    pass
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+def _init_worker():
+    charts.warm_up()
+
+
+class RenderPool:
+    def __init__(self, workers=None, timeout=None, max_pending=None):
+        self.workers = workers or int(os.environ.get("RENDER_WORKERS", "0")) or min(4, os.cpu_count() or 1)
+        self.timeout = timeout or float(os.environ.get("RENDER_TIMEOUT", "60"))
+        self.max_pending = max_pending or int(os.environ.get("RENDER_MAX_PENDING", "0")) or self.workers * 4
+        self._executor = None
+        self.pending = 0
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "timeouts": 0, "rejected": 0,
+                      "restarts": 0, "max_pending": 0, "last_render_seconds": 0.0, "max_render_seconds": 0.0}
+
+    def _create_executor(self):
+        # spawn：不要把 uvicorn/執行緒的狀態 fork 進 worker
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                   mp_context=multiprocessing.get_context("spawn"))
+
+    def start(self):
+        if self._executor is None:
+            self._executor = self._create_executor()
+            # 先把 worker 都叫起來並完成 warm up，第一個請求就不用等 import matplotlib
+            for _ in range(self.workers):
+                self._executor.submit(time.sleep, 0)
+            print(f"🎨 render pool started with {self.workers} workers")
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def render(self, func, *args):
+        """ run charts.<func>(*args) in a worker; raises RenderBusy / RenderTimeout """
+        if self.pending >= self.max_pending:
+            self.stats["rejected"] += 1
+            raise RenderBusy(f"{self.pending} render jobs pending")
+        self.start()
+        start = time.perf_counter()
+        try:
+            future = self._executor.submit(func, *args)
+        except BrokenProcessPool:
+            # worker 被 OOM killer 之類的砍掉時，整個 pool 重建
+            self.stats["restarts"] += 1
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._create_executor()
+            future = self._executor.submit(func, *args)
+        # pending 跟著工作本身走：逾時的工作仍佔著 worker，直到它真正結束
+        self.pending += 1
+        self.stats["submitted"] += 1
+        self.stats["max_pending"] = max(self.stats["max_pending"], self.pending)
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._job_done))
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            # 還在排隊的工作會被取消；已在執行的無法中斷，worker 算完後自行回到 pool
+            self.stats["timeouts"] += 1
+            raise RenderTimeout(f"render job exceeded {self.timeout}s")
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        elapsed = time.perf_counter() - start
+        self.stats["completed"] += 1
+        self.stats["last_render_seconds"] = round(elapsed, 3)
+        self.stats["max_render_seconds"] = max(self.stats["max_render_seconds"], round(elapsed, 3))
+        return result
+
+    def _job_done(self):
+        self.pending -= 1
+
+    def snapshot_stats(self):
+        return dict(self.stats, workers=self.workers, pending=self.pending,
+                    max_pending_allowed=self.max_pending, timeout=self.timeout)
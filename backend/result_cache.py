@@ -0,0 +1,100 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def file_fingerprint(paths):
+    """ ((path, mtime_ns, size), ...) of the files a result was built from; missing files are skipped """
+    fingerprint = []
+    for path in sorted(paths):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        fingerprint.append((path, st.st_mtime_ns, st.st_size))
+    return tuple(fingerprint)
+
+
+class ResultCache:
+    """
+    Bounded LRU cache for endpoint results (JSON-able dicts) with an
+    optional on-disk tier. Keys must already contain the fingerprint of
+    the source files, so a changed file simply produces a new key.
+    """
+
+    def __init__(self, max_entries=32, disk_dir=None, max_disk_entries=512):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_evictions": 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        digest = self._digest(key)
+        with self._lock:
+            if digest in self._entries:
+                self._entries.move_to_end(digest)
+                self.stats["hits"] += 1
+                return self._entries[digest]
+        value = self._disk_get(digest)
+        if value is not None:
+            self.stats["disk_hits"] += 1
+            self._memory_put(digest, value)
+            return value
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key, value):
+        digest = self._digest(key)
+        self._memory_put(digest, value)
+        self._disk_put(digest, value)
+
+    def _memory_put(self, digest, value):
+        with self._lock:
+            self._entries[digest] = value
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def _disk_get(self, digest):
+        if not self.disk_dir:
+            return None
+        path = os.path.join(self.disk_dir, f"{digest}.json")
+        try:
+            with open(path, "r") as f:
+                value = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        os.utime(path)  # 讓磁碟層也依最近使用排序
+        return value
+
+    def _disk_put(self, digest, value):
+        if not self.disk_dir:
+            return
+        path = os.path.join(self.disk_dir, f"{digest}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(value, f)
+        os.replace(path + ".tmp", path)
+        files = [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir) if name.endswith(".json")]
+        if len(files) > self.max_disk_entries:
+            files.sort(key=os.path.getmtime)
+            for old in files[:len(files) - self.max_disk_entries]:
+                try:
+                    os.remove(old)
+                    self.stats["disk_evictions"] += 1
+                except FileNotFoundError:
+                    pass
+
+    def snapshot_stats(self):
+        return dict(self.stats, entries=len(self._entries), max_entries=self.max_entries,
+                    disk_dir=self.disk_dir)
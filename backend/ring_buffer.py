@@ -0,0 +1,102 @@
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Fixed-capacity ring buffer backed by a numpy array.
+    Every value is written twice (i and i + capacity) so the ordered
+    content is always one contiguous slice: append is O(1) and view()
+    never copies.
+    """
+
+    def __init__(self, capacity, dtype, buffer=None):
+        self.capacity = int(capacity)
+        self.dtype = np.dtype(dtype)
+        if buffer is None:
+            self._buf = np.zeros(2 * self.capacity, dtype=self.dtype)
+        else:
+            # 直接使用外部記憶體（例如 mmap），讓其他程序可以讀取同一份資料
+            self._buf = np.frombuffer(buffer, dtype=self.dtype, count=2 * self.capacity)
+        self._head = 0  # next write position, 0 <= head < capacity
+        self._size = 0
+        self.appended = 0  # values ever written, never reset (lets readers ask for "new since")
+        self.overwritten = 0  # values pushed out by newer ones since the last clear()
+
+    @classmethod
+    def attach(cls, capacity, dtype, buffer, head, size, appended=0):
+        """ ring over existing memory with a known (head, size), e.g. a reader of a shared window """
+        ring = cls(capacity, dtype, buffer)
+        ring._head, ring._size = int(head) % ring.capacity, min(int(size), ring.capacity)
+        ring.appended = int(appended)
+        return ring
+
+    @classmethod
+    def nbytes_for(cls, capacity, dtype):
+        return 2 * int(capacity) * np.dtype(dtype).itemsize
+
+    @property
+    def state(self):
+        return self._head, self._size, self.appended
+
+    def __len__(self):
+        return self._size
+
+    def append(self, value):
+        self._buf[self._head] = value
+        self._buf[self._head + self.capacity] = value
+        self._head = (self._head + 1) % self.capacity
+        if self._size < self.capacity:
+            self._size += 1
+        else:
+            self.overwritten += 1
+        self.appended += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        n = len(values)
+        if n == 0:
+            return
+        self.appended += n
+        self.overwritten += max(0, self._size + n - self.capacity)
+        if n > self.capacity:
+            values = values[-self.capacity:]
+            n = self.capacity
+        cap = self.capacity
+        first = min(n, cap - self._head)
+        self._buf[self._head:self._head + first] = values[:first]
+        self._buf[self._head + cap:self._head + cap + first] = values[:first]
+        rest = n - first
+        if rest:
+            self._buf[:rest] = values[first:]
+            self._buf[cap:cap + rest] = values[first:]
+        self._head = (self._head + n) % cap
+        self._size = min(self._size + n, cap)
+
+    def view(self):
+        """ read-only ordered view (oldest -> newest), valid until the next write """
+        start = (self._head - self._size) % self.capacity
+        out = self._buf[start:start + self._size]
+        out.flags.writeable = False
+        return out
+
+    def tail(self, n):
+        """ read-only view of the newest n values (fewer if not that many are kept) """
+        view = self.view()
+        return view[len(view) - min(n, len(view)):]
+
+    def last(self, default=None):
+        if self._size == 0:
+            return default
+        return self._buf[(self._head - 1) % self.capacity].item()
+
+    def tolist(self):
+        return self.view().tolist()
+
+    def clear(self):
+        self._head = 0
+        self._size = 0
+        self.overwritten = 0
+
+    @property
+    def nbytes(self):
+        return self._buf.nbytes
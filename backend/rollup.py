@@ -0,0 +1,192 @@
+"""
+Per-device, per-day vitals rollup: {snapshot_dir}/rollup/{mcu_id}/{YYYY-MM-DD}.jsonl
+
+One JSON line per minute (keyed by the sample timestamps, not the file
+the samples came from) with sums and counts, so rows of the same minute
+can be merged exactly:
+    {"minute": epoch, "heart_sum", "heart_n", "resp_sum", "resp_n",
+     "samples", "oob", "movement", "measuring", "runs"}
+"runs" is the minute's status run-length encoded (status_timeline.minute_runs);
+runs of merged rows are concatenated in file order.
+"""
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import quote, unquote
+
+from snapshot_store import taiwan_tz, from_json_record, list_snapshot_files, read_snapshot
+from device_store import DEVICES_DIR, iter_device_minutes
+from status_timeline import status_codes, minute_runs
+
+ROLLUP_DIR = "rollup"
+SUM_FIELDS = ("heart_sum", "heart_n", "resp_sum", "resp_n", "samples", "oob", "movement", "measuring")
+
+
+def rollup_path(root, mcu_id, date):
+    return os.path.join(root, ROLLUP_DIR, quote(mcu_id, safe=''), f"{date}.jsonl")
+
+
+def minute_rollup(columns):
+    """ one device's minute columns -> rollup rows, one per timestamp minute """
+    ts = np.asarray(columns['timestamp'], dtype=np.int64)
+    heart = np.asarray(columns['heart_rate'])
+    resp = np.asarray(columns['resp_rate'])
+    oob = np.asarray(columns['outofbed']) == 1
+    mov = (np.asarray(columns['movement']) == 1) & ~oob
+    status = status_codes(columns['outofbed'], columns['movement'])
+    minutes = ts // 60 * 60
+    rows = []
+    for minute in np.unique(minutes):
+        mask = minutes == minute
+        h, r = heart[mask], resp[mask]
+        samples = int(mask.sum())
+        n_oob, n_mov = int(oob[mask].sum()), int(mov[mask].sum())
+        rows.append({
+            "minute": int(minute),
+            "heart_sum": int(h[h > 0].sum()), "heart_n": int((h > 0).sum()),
+            "resp_sum": int(r[r > 0].sum()), "resp_n": int((r > 0).sum()),
+            "samples": samples, "oob": n_oob, "movement": n_mov, "measuring": samples - n_oob - n_mov,
+            "runs": minute_runs(status[mask], ts[mask]),
+        })
+    return rows
+
+
+def append_rollup(root, mcu_id, date, columns):
+    rows = minute_rollup(columns)
+    if not rows:
+        return
+    path = rollup_path(root, mcu_id, date)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        f.write("".join(json.dumps(row, separators=(',', ':')) + "\n" for row in rows))
+
+
+def merge_rows(rows):
+    """ sum rows of the same minute, sorted by minute """
+    merged = OrderedDict()
+    for row in sorted(rows, key=lambda r: r["minute"]):
+        if row["minute"] in merged:
+            target = merged[row["minute"]]
+            for key in SUM_FIELDS:
+                target[key] += row.get(key, 0)
+            if "runs" in target:
+                if "runs" in row:
+                    target["runs"] = target["runs"] + row["runs"]
+                else:
+                    del target["runs"]  # 舊格式的列沒有 runs，這分鐘就不完整
+        else:
+            merged[row["minute"]] = dict(row)
+    return list(merged.values())
+
+
+def load_rollup(root, mcu_id, date):
+    """ merged rollup rows of one device-day, or None if the rollup file does not exist """
+    path = rollup_path(root, mcu_id, date)
+    if not os.path.exists(path):
+        return None
+    rows = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue  # 寫到一半的最後一行
+    return merge_rows(rows)
+
+
+def rollup_from_records(sorted_data):
+    """ rollup rows from the JSON record layout (OrderedDict {time: record}) """
+    rows = []
+    for record in sorted_data.values():
+        rows += minute_rollup(from_json_record(record))
+    return merge_rows(rows)
+
+
+def minute_means(row):
+    heart = row["heart_sum"] / row["heart_n"] if row["heart_n"] else 0
+    resp = row["resp_sum"] / row["resp_n"] if row["resp_n"] else 0
+    return heart, resp
+
+
+def minute_str(minute_epoch):
+    return datetime.fromtimestamp(minute_epoch, taiwan_tz).strftime("%H:%M")
+
+
+def _write_rows(path, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        f.write("".join(json.dumps(row, separators=(',', ':')) + "\n" for row in rows))
+    os.replace(path + ".tmp", path)
+
+
+def rebuild_date(root, date):
+    """ rebuild every device rollup of one date, from the minute snapshots or the device day files """
+    rows = {}
+    files = list_snapshot_files(os.path.join(root, date))
+    if files:
+        for _, path in files:
+            try:
+                snapshot = read_snapshot(path)
+            except Exception as e:
+                print(f"⚠️ skip {path}: {e}")
+                continue
+            for mcu_id, record in snapshot.items():
+                rows.setdefault(mcu_id, []).extend(minute_rollup(from_json_record(record)))
+    else:
+        devices_root = os.path.join(root, DEVICES_DIR)
+        for name in (os.listdir(devices_root) if os.path.isdir(devices_root) else []):
+            mcu_id = unquote(name)
+            for _, columns in iter_device_minutes(root, mcu_id, date):
+                rows.setdefault(mcu_id, []).extend(minute_rollup(columns))
+    for mcu_id, device_rows in rows.items():
+        _write_rows(rollup_path(root, mcu_id, date), merge_rows(device_rows))
+    return len(rows)
+
+
+def rebuild_device(root, mcu_id, date):
+    """ rebuild one device rollup from its .day archive or .rec file, returns the number of rows """
+    rows = []
+    for _, columns in iter_device_minutes(root, mcu_id, date):
+        rows += minute_rollup(columns)
+    if rows:
+        _write_rows(rollup_path(root, mcu_id, date), merge_rows(rows))
+    return len(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild the per-minute vitals rollup from /app/snapshots")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--root", default="/app/snapshots")
+    parser.add_argument("--date", action="append", help="YYYY-MM-DD, repeatable (default: every date)")
+    parser.add_argument("--include-today", action="store_true",
+                        help="also rebuild today's rollup (stop the ingest service first)")
+    args = parser.parse_args(argv)
+
+    today = datetime.now(taiwan_tz).strftime("%Y-%m-%d")
+
+    dates = set(args.date or [])
+    if not dates:
+        dates = {d for d in os.listdir(args.root) if os.path.isdir(os.path.join(args.root, d))}
+        devices_root = os.path.join(args.root, DEVICES_DIR)
+        if os.path.isdir(devices_root):
+            for name in os.listdir(devices_root):
+                dates.update(f[:-4] for f in os.listdir(os.path.join(devices_root, name))
+                             if f.endswith((".rec", ".day")))
+    for date in sorted(dates):
+        try:
+            datetime.strptime(date, "%Y-%m-%d")
+        except ValueError:
+            continue
+        if date == today and not args.include_today:
+            print(f"⏭️ skip {date} (today, ingest is still appending)")
+            continue
+        count = rebuild_date(args.root, date)
+        print(f"✅ {date}: {count} device rollups")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+import os
+import json
+import zipfile
+import numpy as np
+from collections import OrderedDict
+from datetime import timezone, timedelta
+
+# 快照格式：json（舊格式，indent=2）或 npz（每台裝置一組二進位欄位）
+SNAPSHOT_FORMAT = os.environ.get("SNAPSHOT_FORMAT", "json")
+SNAPSHOT_COMPRESS = os.environ.get("SNAPSHOT_COMPRESS", "1") == "1"
+SNAPSHOT_EXTENSIONS = (".json", ".npz")
+
+taiwan_tz = timezone(timedelta(hours=8))
+
+COLUMN_DTYPES = {
+    "raw": np.uint16,
+    "heart": np.uint16,
+    "heart_rate": np.uint8,
+    "resp_rate": np.uint8,
+    "movement": np.uint8,
+    "outofbed": np.uint8,
+    "timestamp": np.int64,  # epoch seconds
+    "RSSI": np.int8,
+}
+
+
+def format_epochs(epochs):
+    """ epoch seconds -> 'YYYY-MM-DD HH:MM:SS' strings in Taiwan time """
+    offset = int(taiwan_tz.utcoffset(None).total_seconds())
+    local = (np.asarray(epochs, dtype=np.int64) + offset).astype('datetime64[s]')
+    return [t.replace('T', ' ') for t in np.datetime_as_string(local).tolist()]
+
+
+def to_json_record(columns):
+    """ one device's columns -> the dict layout used inside the JSON snapshots """
+    record = {}
+    for key, values in columns.items():
+        if key == 'timestamp':
+            record[key] = format_epochs(values)
+        else:
+            record[key] = np.asarray(values).tolist()
+    return record
+
+
+def parse_timestamps(timestamps):
+    """ 'YYYY-MM-DD HH:MM:SS' strings (Taiwan time) -> epoch seconds """
+    offset = int(taiwan_tz.utcoffset(None).total_seconds())
+    local = np.array([t.replace(' ', 'T') for t in timestamps], dtype='datetime64[s]')
+    return local.astype(np.int64) - offset
+
+
+def from_json_record(record):
+    """ JSON record layout -> {column: ndarray} """
+    columns = {}
+    for key, values in record.items():
+        if key == 'timestamp':
+            columns[key] = parse_timestamps(values)
+        else:
+            columns[key] = np.asarray(values, dtype=COLUMN_DTYPES.get(key))
+    return columns
+
+
+def write_snapshot(dated_dir, snapshot_time, snapshot, fmt=None, compress=None):
+    """
+    snapshot: {mcu_id: {column: ndarray}} with epoch-second timestamps.
+    Returns the written file path.
+    """
+    fmt = fmt or SNAPSHOT_FORMAT
+    compress = SNAPSHOT_COMPRESS if compress is None else compress
+    if fmt == "npz":
+        path = os.path.join(dated_dir, f'snapshot_{snapshot_time}.npz')
+        columns = {}
+        for mcu_id, data in snapshot.items():
+            for key, values in data.items():
+                columns[f"{mcu_id}/{key}"] = np.asarray(values, dtype=COLUMN_DTYPES.get(key))
+        # 先寫暫存檔再 rename，讀取端不會看到寫到一半的檔案
+        with open(path + ".tmp", "wb") as f:
+            if compress:
+                np.savez_compressed(f, **columns)
+            else:
+                np.savez(f, **columns)
+        os.replace(path + ".tmp", path)
+        return path
+
+    path = os.path.join(dated_dir, f'snapshot_{snapshot_time}.json')
+    json_snapshot = {mcu_id: to_json_record(data) for mcu_id, data in snapshot.items()}
+    with open(path + ".tmp", "w") as f:
+        json.dump(json_snapshot, f, indent=2)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def snapshot_time_of(file):
+    """ 'snapshot_2025-07-17_11-32-00.json' -> '11-32-00' (None if not a snapshot file) """
+    if not file.endswith(SNAPSHOT_EXTENSIONS):
+        return None
+    try:
+        return file.split('.')[0].split('_')[2]
+    except IndexError:
+        return None
+
+
+def time_key(t):
+    h, m, s = map(int, t.split('-'))
+    return h * 60 + m
+
+
+def list_snapshot_files(date_dir):
+    """ [(time, path)] of every minute snapshot in a date directory, in time order """
+    if not os.path.isdir(date_dir):
+        return []
+    files = []
+    for file in os.listdir(date_dir):
+        t = snapshot_time_of(file)
+        if t is None:
+            continue
+        try:
+            time_key(t)
+        except ValueError:
+            continue
+        files.append((t, os.path.join(date_dir, file)))
+    files.sort(key=lambda x: time_key(x[0]))
+    return files
+
+
+def read_snapshot(path):
+    """ whole snapshot file -> {mcu_id: record} (JSON layout) """
+    if path.endswith(".npz"):
+        with np.load(path) as npz:
+            columns = {}
+            for name in npz.files:
+                mcu_id, key = name.rsplit('/', 1)
+                columns.setdefault(mcu_id, {})[key] = npz[name]
+        return {mcu_id: to_json_record(data) for mcu_id, data in columns.items()}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def read_device(path, mcu_id):
+    """ one device's record from a snapshot file, or None if the device is not in it """
+    if path.endswith(".npz"):
+        with np.load(path) as npz:
+            prefix = f"{mcu_id}/"
+            names = [name for name in npz.files if name.startswith(prefix)]
+            if not names:
+                return None
+            return to_json_record({name[len(prefix):]: npz[name] for name in names})
+    with open(path, "r") as f:
+        snapshot = json.load(f)
+    return snapshot.get(mcu_id)
+
+
+def load_device_day(date_dir, mcu_id):
+    """ OrderedDict {time: record} of one device for one date directory """
+    return OrderedDict(iter_device_day(date_dir, mcu_id))
+
+
+def iter_device_day(date_dir, mcu_id):
+    """ yield (time, record) of one device one snapshot file at a time """
+    files = OrderedDict()
+    for t, path in list_snapshot_files(date_dir):
+        files.setdefault(t, []).append(path)
+    for t, paths in files.items():
+        record = None
+        for path in paths:  # 同一分鐘有多個檔案時以最後一個可讀的為準
+            try:
+                record = read_device(path, mcu_id) or record
+            except (ValueError, OSError, zipfile.BadZipFile) as e:  # JSONDecodeError / 壞掉的 npz
+                print(e)
+        if record is not None:
+            yield t, record
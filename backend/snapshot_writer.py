@@ -0,0 +1,157 @@
+import os
+import time
+import queue
+import asyncio
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+from snapshot_store import write_snapshot, taiwan_tz
+from device_store import append_minute, backfill_date
+from rollup import append_rollup, rebuild_device
+from catalog import add_minutes, minute_row, reindex
+from waveform_archive import CHANNELS, WAVEFORM_ARCHIVE, append_block
+from metrics import Counter, Histogram, device_label
+
+FLUSH_SECONDS = Histogram("snapshot_flush_seconds", "Writing one minute: snapshot file, device day files, rollups")
+WRITE_FAILURES = Counter("snapshot_device_failures_total",
+                         "Device-minutes a flush could not write completely, by the step that failed",
+                         ("mcu_id", "step"))
+QUEUE_WAIT_SECONDS = Histogram("snapshot_queue_wait_seconds", "Time submit() waited for a full writer queue")
+
+
+def split_waveforms(columns):
+    """ (record columns, waveform channels) of one device-minute """
+    if not WAVEFORM_ARCHIVE:
+        # 舊格式：raw 留在紀錄裡，heart 不保存
+        return {key: values for key, values in columns.items() if key != "heart"}, None
+    record = {key: values for key, values in columns.items() if key not in CHANNELS}
+    return record, {key: columns[key] for key in CHANNELS if key in columns}
+
+
+def flush_minute(snapshot_dir, today_str, snapshot_time, minute_epoch, snapshot):
+    """
+    write one minute: the minute snapshot file, then per device the waveform
+    archive, the day file and the vitals rollup, then the catalog rows of
+    the day file records that were written. A failing device does not stop
+    the others; returns {mcu_id: failed step}
+    """
+    dated_dir = os.path.join(snapshot_dir, today_str)
+    os.makedirs(dated_dir, exist_ok=True)
+    split = {mcu_id: split_waveforms(columns) for mcu_id, columns in snapshot.items()}
+    failures = {}  # mcu_id -> step that failed ("*" for the snapshot file)
+    # snapshot 檔先寫：其他步驟失敗時這一分鐘仍有完整的一份
+    try:
+        write_snapshot(dated_dir, snapshot_time, {mcu_id: record for mcu_id, (record, _) in split.items()})
+    except Exception as e:
+        failures["*"] = "snapshot"
+        WRITE_FAILURES.labels("*", "snapshot").inc()
+        print(f"❌ snapshot file {snapshot_time} failed: {e}")
+        traceback.print_exc()
+    rows = []
+    for mcu_id, (columns, waveforms) in split.items():
+        # 每台裝置各自處理，一台寫壞不影響其他床
+        step = "waveform"
+        try:
+            if waveforms:
+                append_block(snapshot_dir, mcu_id, today_str, minute_epoch, waveforms)
+            step = "record"
+            path, offset, length = append_minute(snapshot_dir, mcu_id, today_str, minute_epoch, columns)
+            rows.append(minute_row(snapshot_dir, mcu_id, today_str, minute_epoch, path, offset, length, columns))
+            step = "rollup"
+            append_rollup(snapshot_dir, mcu_id, today_str, columns)
+        except Exception as e:
+            failures[mcu_id] = step
+            WRITE_FAILURES.labels(device_label(mcu_id), step).inc()
+            print(f"❌ [{mcu_id}] {step} of {snapshot_time} failed: {e}")
+            traceback.print_exc()
+    add_minutes(snapshot_dir, rows)
+    return failures
+
+
+def backfill_recent(snapshot_dir, now=None):
+    """
+    before the first flush of a (re)started ingest: put the minutes that
+    only the snapshots of today and yesterday have (e.g. written by a
+    version without day files) into the day files, and re-index those
+    devices' catalog rows and rollups
+    """
+    now = now or datetime.now(taiwan_tz)
+    count = 0
+    for date in ((now - timedelta(days=1)).strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d")):
+        for mcu_id in backfill_date(snapshot_dir, date):
+            reindex(snapshot_dir, mcu_id, date)
+            rebuild_device(snapshot_dir, mcu_id, date)
+            count += 1
+    return count
+
+
+class SnapshotWriter:
+    """
+    Background thread that serializes and writes minute snapshots so the
+    ingest event loop only hands over an immutable copy of the data.
+    The queue is bounded: when it is full submit() waits (off the loop)
+    and the wait is counted in stats.
+    """
+
+    def __init__(self, max_queue=None):
+        max_queue = max_queue or int(os.environ.get("SNAPSHOT_QUEUE_SIZE", "4"))
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = None
+        self.stats = {
+            "submitted": 0, "written": 0, "failed": 0, "device_failures": 0,
+            "blocked": 0, "blocked_seconds": 0.0,
+            "queue_depth": 0, "max_queue_depth": 0,
+            "last_write_seconds": 0.0, "max_write_seconds": 0.0,
+        }
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+            self.thread.start()
+
+    async def submit(self, job, *args):
+        self.stats["submitted"] += 1
+        try:
+            self.queue.put_nowait((job, args))
+        except queue.Full:
+            self.stats["blocked"] += 1
+            print(f"⚠️ snapshot writer queue full ({self.queue.maxsize}), waiting")
+            start = time.perf_counter()
+            await asyncio.to_thread(self.queue.put, (job, args))
+            waited = time.perf_counter() - start
+            self.stats["blocked_seconds"] += waited
+            QUEUE_WAIT_SECONDS.observe(waited)
+        depth = self.queue.qsize()
+        self.stats["queue_depth"] = depth
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], depth)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            job, args = item
+            start = time.perf_counter()
+            try:
+                failures = job(*args)
+                self.stats["written"] += 1
+                if failures:
+                    self.stats["device_failures"] += len(failures)
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"❌ snapshot write failed: {e}")
+                traceback.print_exc()
+            elapsed = time.perf_counter() - start
+            FLUSH_SECONDS.observe(elapsed)
+            self.stats["last_write_seconds"] = elapsed
+            self.stats["max_write_seconds"] = max(self.stats["max_write_seconds"], elapsed)
+            self.stats["queue_depth"] = self.queue.qsize()
+
+    def stop(self, timeout=30):
+        """ drain pending snapshots and stop the thread (blocking) """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.thread = None
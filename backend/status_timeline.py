@@ -0,0 +1,98 @@
+"""
+Run-length encoded bed status. Status changes only a few dozen times a
+night, so it is kept, served and drawn as intervals instead of one value
+per frame (2 per second).
+
+    state:    -1 out of bed, 0 measuring, 1 movement
+    interval: {"state", "start", "end", "start_time", "end_time"}
+              start/end are sample indices (end exclusive), i.e. the x
+              axis of the status charts; the times are the first/last sample.
+
+The rollup stores each minute as runs [state, samples, first_ts, last_ts]
+(see rollup.minute_rollup), StatusTimeline folds them back together.
+"""
+import bisect
+import numpy as np
+from datetime import datetime
+
+from snapshot_store import taiwan_tz
+
+OUT_OF_BED, MEASURING, MOVEMENT = -1, 0, 1
+
+
+def status_codes(outofbed, movement):
+    """ per-frame status, out of bed wins over movement """
+    oob = np.asarray(outofbed) == 1
+    mov = np.asarray(movement) == 1
+    return np.where(oob, OUT_OF_BED, np.where(mov, MOVEMENT, MEASURING)).astype(np.int8)
+
+
+def run_lengths(status):
+    """ [(state, start, end), ...] of consecutive equal values, end exclusive """
+    status = np.asarray(status)
+    if len(status) == 0:
+        return []
+    edges = np.flatnonzero(status[1:] != status[:-1]) + 1
+    starts = [0] + edges.tolist()
+    ends = edges.tolist() + [len(status)]
+    return [(int(status[s]), s, e) for s, e in zip(starts, ends)]
+
+
+def minute_runs(status, timestamps):
+    """ rollup form: [[state, samples, first_ts, last_ts], ...] """
+    ts = np.asarray(timestamps, dtype=np.int64)
+    return [[state, end - start, int(ts[start]), int(ts[end - 1])] for state, start, end in run_lengths(status)]
+
+
+class StatusTimeline:
+    """ folds runs (in time order) into intervals, equal neighbours are merged """
+
+    def __init__(self):
+        self.runs = []  # [state, start, end, first_ts, last_ts]
+        self.total = 0
+
+    def add_run(self, state, samples, first_ts, last_ts):
+        if samples <= 0:
+            return
+        if self.runs and self.runs[-1][0] == state:
+            self.runs[-1][2] += samples
+            self.runs[-1][4] = last_ts
+        else:
+            self.runs.append([state, self.total, self.total + samples, first_ts, last_ts])
+        self.total += samples
+
+    def extend(self, status, timestamps):
+        for run in minute_runs(status, timestamps):
+            self.add_run(*run)
+
+    def spans(self):
+        """ [(state, start, end), ...] for drawing """
+        return [(state, start, end) for state, start, end, _, _ in self.runs]
+
+    def time_at(self, index):
+        """ epoch of sample `index`, linear inside its run """
+        i = bisect.bisect_right([run[1] for run in self.runs], index) - 1
+        state, start, end, first_ts, last_ts = self.runs[max(i, 0)]
+        if end - start <= 1:
+            return first_ts
+        return first_ts + (last_ts - first_ts) * (index - start) // (end - start - 1)
+
+    def intervals(self, fmt="%Y-%m-%d %H:%M:%S"):
+        return [{"state": state, "start": start, "end": end,
+                 "start_time": format_time(first_ts, fmt), "end_time": format_time(last_ts, fmt)}
+                for state, start, end, first_ts, last_ts in self.runs]
+
+
+def format_time(epoch, fmt="%Y-%m-%d %H:%M:%S"):
+    return datetime.fromtimestamp(epoch, taiwan_tz).strftime(fmt)
+
+
+def tick_indices(total, count=10):
+    """ the charts' x ticks: every total//count-th sample """
+    return list(range(0, total, max(1, total // count)))
+
+
+def labelled_intervals(status, labels):
+    """ intervals of a per-frame status list whose timestamps are already strings """
+    return [{"state": state, "start": start, "end": end, "start_time": labels[start], "end_time": labels[end - 1]}
+            for state, start, end in run_lengths(status)]
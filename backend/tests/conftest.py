@@ -0,0 +1,5 @@
+import os
+import sys
+
+# backend 的模組是平放的（import mcu_protocol），測試從 backend/ 匯入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,172 @@
+"""
+mcu_protocol against the old literal command arrays (TCP_server_text
+before the protocol module) and a data reply captured from
+mcu_simulator over TCP (tests/data/mcu_data_reply.hex).
+"""
+import os
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import mcu_protocol
+from mcu_protocol import (CMD_DATA, CommandBuffer, DataCommand, REPLY_FIELDS, check_command, autoscaling_command,
+                          parse_reply, read_frame, read_reply, reply_id)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def old_checksum(total_sum):
+    total_sum &= 0xFFFF
+    return (total_sum >> 8) & 0xFF, total_sum & 0xFF
+
+
+def old_data_array(now):
+    """ the data command as the old handle_client built it """
+    arr = bytearray(513)
+    arr[0:5] = bytes([0x13, 0x00, 0x28, 0x00, 0x15])
+    arr[17], arr[18] = 0x00, 0x01
+    arr[5:17] = now.strftime("%Y%m%d%H%M").encode("ascii")
+    arr[19], arr[20] = old_checksum(sum(arr[:19]))
+    return arr
+
+
+def captured_reply():
+    with open(os.path.join(DATA_DIR, "mcu_data_reply.hex")) as f:
+        return bytes.fromhex("".join(f.read().split()))
+
+
+def feed(chunks, eof=True):
+    """ a StreamReader that receives `chunks` as separate TCP segments """
+    reader = asyncio.StreamReader()
+    for chunk in chunks:
+        reader.feed_data(chunk)
+    if eof:
+        reader.feed_eof()
+    return reader
+
+
+# ---- commands ----
+
+def test_check_command_matches_old_array():
+    old = bytearray(513)
+    old[0:9] = bytes([0x13, 0x00, 0x01, 0x00, 0x09, 0x00, 0x01, 0x00, 0x1E])
+    assert check_command() == bytes(old)
+    assert mcu_protocol.CHECK_COMMAND == bytes(old)
+
+
+def test_autoscaling_command_matches_old_array():
+    old = bytearray(513)
+    old[0:11] = bytes([0x13, 0x00, 0x89, 0x00, 0x0D, 0x14, 0xEB, 1, 1, 0x00, 0x01])
+    old[11], old[12] = old_checksum(sum(old[:11]))
+    assert autoscaling_command() == bytes(old)
+
+
+def test_data_command_matches_old_array():
+    now = datetime(2025, 7, 17, 11, 32, 45)
+    assert bytes(DataCommand().set_time(now)) == bytes(old_data_array(now))
+
+
+def test_data_command_rewrites_time_and_checksum_when_the_minute_changes():
+    command = DataCommand()
+    times = [datetime(2025, 7, 17, 11, 32, 0), datetime(2025, 7, 17, 11, 32, 59),
+             datetime(2025, 7, 17, 11, 33, 0), datetime(2025, 12, 31, 23, 59, 0), datetime(2026, 1, 1, 0, 0, 0)]
+    for now in times:
+        frame = command.set_time(now)
+        assert bytes(frame) == bytes(old_data_array(now))
+        assert command.checksum == sum(frame[:19]) & 0xFFFF
+
+
+def test_data_command_same_minute_does_not_touch_the_buffer():
+    command = DataCommand()
+    command.set_time(datetime(2025, 7, 17, 11, 32, 1))
+    before = command.checksum
+    command.buffer[100] = 0xAA  # 不在 body 裡，只用來確認沒有重寫
+    command.set_time(datetime(2025, 7, 17, 11, 32, 58))
+    assert command.checksum == before
+    assert command.buffer[100] == 0xAA
+
+
+def test_incremental_checksum_matches_a_full_sum():
+    command = CommandBuffer(CMD_DATA, bytes(14))
+    for offset, data in [(0, b"\xff\xff"), (3, b"abc"), (0, b"\x00"), (10, b"\xff\xff\xff\xff")]:
+        command.set_body(offset, data)
+        assert command.checksum == sum(command.buffer[:command.checksum_offset]) & 0xFFFF
+
+
+def test_set_body_refuses_to_overwrite_the_checksum():
+    command = CommandBuffer(CMD_DATA, bytes(4))
+    with pytest.raises(ValueError):
+        command.set_body(3, b"xx")
+
+
+# ---- replies ----
+
+def test_reply_fields_of_captured_reply():
+    frame = captured_reply()
+    assert len(frame) == 513
+    reply = parse_reply(frame)
+    assert reply.status == 0x03
+    assert reply.adc_index == 0x0014
+    assert reply.heart_rate == 0x47
+    assert reply.resp_rate == 0x12
+    assert reply.outofbed == 0
+    assert reply.movement == 0
+    assert reply.autoscaling == 0
+    assert reply.rssi == -48  # 0xD0
+    assert reply_id(frame) == "BED-07"
+
+
+def test_reply_fields_offsets():
+    frame = bytearray(513)
+    for offset, value in [(5, 3), (6, 0x01), (7, 0x02), (12, 80), (13, 16), (14, 79), (15, 1), (24, 7), (27, 0xB5)]:
+        frame[offset] = value
+    assert REPLY_FIELDS.unpack_from(frame) == (3, 0x0102, 80, 16, 79, 1, 7, -75)
+
+
+def test_read_frame_split_across_reads():
+    frame = captured_reply()
+
+    async def run():
+        reader = feed([frame[:7], frame[7:300], frame[300:512], frame[512:]])
+        return await read_frame(reader)
+
+    assert asyncio.run(run()) == frame
+
+
+def test_read_frame_two_frames_in_one_read():
+    first = captured_reply()
+    second = bytes(reversed(first))
+
+    async def run():
+        reader = feed([first + second[:100], second[100:]])
+        return await read_frame(reader), await read_frame(reader)
+
+    assert asyncio.run(run()) == (first, second)
+
+
+def test_read_frame_disconnect_mid_frame():
+    async def run():
+        await read_frame(feed([captured_reply()[:200]]))
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(run())
+
+
+def test_read_reply_accepts_a_short_check_reply():
+    short = bytes([0x13, 0x00, 0x01, 0x00, 0x09, 0x03]) + bytes(7)
+
+    async def run():
+        return await read_reply(feed([short[:4], short[4:]], eof=False), 13, idle=0.05)
+
+    assert asyncio.run(run()) == short
+
+
+def test_read_reply_takes_the_whole_reply_up_to_max_size():
+    frame = captured_reply()
+
+    async def run():
+        reader = feed([frame[:20], frame[20:]], eof=False)
+        return await read_reply(reader, 13, max_size=len(frame), idle=0.05)
+
+    assert asyncio.run(run()) == frame
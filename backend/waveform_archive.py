@@ -0,0 +1,333 @@
+"""
+Waveform archive: the 100 Hz ADC channels (raw, heart) of every device,
+one block per minute, in
+
+    {snapshot_dir}/waveforms/{mcu_id}/{YYYY-MM-DD}.wfa    blocks
+    {snapshot_dir}/waveforms/{mcu_id}/{YYYY-MM-DD}.wfi    index
+
+Block: BLOCK_HEADER (magic, minute epoch, codec, channel count, payload
+length), one uint32 sample count per channel, then the compressed payload. Each
+channel is stored as int16 deltas (mod 2**16, so any uint16 input comes
+back exactly), the low and high bytes of the deltas in two separate
+planes; the high plane of a 12-bit ADC signal is almost all 0x00/0xFF
+and compresses to nearly nothing.
+
+A block is labelled like the device day records: with the epoch of the
+minute flush, its samples are the 60 s before that epoch.
+
+The index holds (minute epoch, offset, length) per block, so a time
+slice reads and decompresses only the minutes it covers. It is appended
+after its block; when it is missing or behind (crash between the two
+writes) it is rebuilt from the block headers.
+
+WAVEFORM_ARCHIVE 1 (default): raw/heart go here and not into the minute
+                 snapshots / device day files; 0: old layout, heart dropped
+WAVEFORM_CODEC   zlib (default, always available), lz4 or zstd when the
+                 lz4 / zstandard packages are installed
+WAVEFORM_LEVEL   compression level (default 1 for zlib, codec default otherwise)
+
+Reader API for analysis code:
+
+    read_waveform(root, mcu_id, start_epoch, end_epoch)  -> {"minutes", "counts", "raw", "heart"}
+    iter_blocks(root, mcu_id, date, start, end)          -> (minute_epoch, {channel: ndarray})
+    DayArchive(root, mcu_id, date).get(minute_epoch)      -> {channel: ndarray} or None
+"""
+import os
+import sys
+import zlib
+import struct
+import argparse
+import numpy as np
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+from snapshot_store import taiwan_tz
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+WAVEFORMS_DIR = "waveforms"
+CHANNELS = ("raw", "heart")
+BLOCK_MAGIC = b'WFB1'
+BLOCK_HEADER = struct.Struct('<4sqBBI')
+SAMPLE_COUNT = struct.Struct('<I')
+INDEX_DTYPE = np.dtype([("minute", "<i8"), ("offset", "<u8"), ("length", "<u4")])
+
+CODEC_NONE, CODEC_ZLIB, CODEC_LZ4, CODEC_ZSTD = 0, 1, 2, 3
+CODEC_NAMES = {"none": CODEC_NONE, "zlib": CODEC_ZLIB, "lz4": CODEC_LZ4, "zstd": CODEC_ZSTD}
+WAVEFORM_ARCHIVE = os.environ.get("WAVEFORM_ARCHIVE", "1") == "1"
+WAVEFORM_CODEC = os.environ.get("WAVEFORM_CODEC", "zlib")
+WAVEFORM_LEVEL = os.environ.get("WAVEFORM_LEVEL")
+
+_checked_paths = set()  # archives whose tail / index was verified by this process
+
+
+def archive_dir(root, mcu_id):
+    return os.path.join(root, WAVEFORMS_DIR, quote(mcu_id, safe=''))
+
+
+def archive_path(root, mcu_id, date):
+    return os.path.join(archive_dir(root, mcu_id), f"{date}.wfa")
+
+
+def index_path(root, mcu_id, date):
+    return os.path.join(archive_dir(root, mcu_id), f"{date}.wfi")
+
+
+# ---- codecs ----
+
+def _codec_id(name=None):
+    name = name or WAVEFORM_CODEC
+    codec = CODEC_NAMES.get(name)
+    if codec is None:
+        raise ValueError(f"unknown waveform codec {name}")
+    if codec == CODEC_LZ4 and lz4_frame is None or codec == CODEC_ZSTD and zstandard is None:
+        print(f"⚠️ waveform codec {name} not installed, using zlib")
+        return CODEC_ZLIB
+    return codec
+
+
+def _compress(codec, data, level=None):
+    level = WAVEFORM_LEVEL if level is None else level
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, int(level) if level is not None else 1)
+    if codec == CODEC_LZ4:
+        return lz4_frame.compress(data, compression_level=int(level) if level is not None else 0)
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=int(level) if level is not None else 3).compress(data)
+    return data
+
+
+def _decompress(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_LZ4:
+        if lz4_frame is None:
+            raise RuntimeError("waveform block is lz4 compressed but lz4 is not installed")
+        return lz4_frame.decompress(data)
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("waveform block is zstd compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+# ---- blocks ----
+
+def delta_planes(values):
+    """ uint16 samples -> int16 deltas (wrapping) split into a low byte plane and a high byte plane """
+    samples = np.asarray(values, dtype=np.uint16)
+    deltas = np.diff(samples, prepend=np.uint16(0)).astype('<u2')  # uint16 相減自動 mod 2**16
+    return deltas.view(np.uint8).reshape(-1, 2).T.tobytes()
+
+
+def undelta_planes(planes, count):
+    pairs = np.frombuffer(planes, dtype=np.uint8, count=2 * count).reshape(2, count).T
+    deltas = np.ascontiguousarray(pairs).view('<u2').ravel()
+    return np.cumsum(deltas, dtype=np.uint16)
+
+
+def encode_block(minute_epoch, channels, codec=None, level=None):
+    """ {channel: uint16 samples} -> block bytes; every channel of CHANNELS gets a count (0 when absent) """
+    codec = _codec_id() if codec is None else codec
+    counts = [len(channels[name]) if name in channels else 0 for name in CHANNELS]
+    planes = b''.join(delta_planes(channels[name]) for name in CHANNELS if name in channels)
+    payload = _compress(codec, planes, level)
+    header = BLOCK_HEADER.pack(BLOCK_MAGIC, int(minute_epoch), codec, len(CHANNELS), len(payload))
+    return header + b''.join(SAMPLE_COUNT.pack(n) for n in counts) + payload
+
+
+def decode_block(data):
+    """ -> (minute_epoch, {channel: uint16 ndarray}) """
+    magic, minute_epoch, codec, channel_count, length = BLOCK_HEADER.unpack_from(data)
+    if magic != BLOCK_MAGIC:
+        raise ValueError("bad waveform block")
+    offset = BLOCK_HEADER.size
+    counts = []
+    for _ in range(channel_count):
+        counts.append(SAMPLE_COUNT.unpack_from(data, offset)[0])
+        offset += SAMPLE_COUNT.size
+    planes = _decompress(codec, bytes(data[offset:offset + length]))
+    channels, position = {}, 0
+    for name, count in zip(CHANNELS, counts):
+        channels[name] = undelta_planes(planes[position:position + 2 * count], count)
+        position += 2 * count
+    return minute_epoch, channels
+
+
+# ---- writing ----
+
+def _scan_blocks(path):
+    """ index entries rebuilt from the block headers; stops at a torn tail """
+    entries = []
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        offset = 0
+        while offset + BLOCK_HEADER.size <= size:
+            f.seek(offset)
+            magic, minute_epoch, _, channel_count, length = BLOCK_HEADER.unpack(f.read(BLOCK_HEADER.size))
+            end = offset + BLOCK_HEADER.size + SAMPLE_COUNT.size * channel_count + length
+            if magic != BLOCK_MAGIC or end > size:
+                break
+            entries.append((minute_epoch, offset, end - offset))
+            offset = end
+    return np.array(entries, dtype=INDEX_DTYPE)
+
+
+def repair(root, mcu_id, date):
+    """ cut a half-written last block and make the index match the blocks """
+    path, idx_path = archive_path(root, mcu_id, date), index_path(root, mcu_id, date)
+    if not os.path.exists(path):
+        if os.path.exists(idx_path):
+            os.remove(idx_path)
+        return
+    entries = _scan_blocks(path)
+    end = int(entries["offset"][-1] + entries["length"][-1]) if len(entries) else 0
+    if end < os.path.getsize(path):
+        print(f"⚠️ truncating torn tail of {path} at {end}")
+        with open(path, "r+b") as f:
+            f.truncate(end)
+    index = read_index(root, mcu_id, date)
+    if len(index) != len(entries) or not np.array_equal(index, entries):
+        with open(idx_path + ".tmp", "wb") as f:
+            f.write(entries.tobytes())
+        os.replace(idx_path + ".tmp", idx_path)
+
+
+def append_block(root, mcu_id, date, minute_epoch, channels, codec=None):
+    """ append one minute of waveforms (uint16 samples per channel); returns the block length """
+    path = archive_path(root, mcu_id, date)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if path not in _checked_paths:
+        repair(root, mcu_id, date)
+        _checked_paths.add(path)
+    block = encode_block(minute_epoch, channels, codec)
+    with open(path, "ab") as f:
+        offset = f.tell()
+        f.write(block)
+    entry = np.array([(minute_epoch, offset, len(block))], dtype=INDEX_DTYPE)
+    with open(index_path(root, mcu_id, date), "ab") as f:
+        f.write(entry.tobytes())
+    return len(block)
+
+
+# ---- reading ----
+
+def read_index(root, mcu_id, date):
+    """ INDEX_DTYPE entries in append order (a torn last entry is ignored) """
+    try:
+        with open(index_path(root, mcu_id, date), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    usable = len(data) // INDEX_DTYPE.itemsize * INDEX_DTYPE.itemsize
+    return np.frombuffer(data[:usable], dtype=INDEX_DTYPE)
+
+
+def _read_block(f, offset, length):
+    f.seek(offset)
+    return decode_block(f.read(length))
+
+
+def archive_dates(root, mcu_id):
+    try:
+        names = os.listdir(archive_dir(root, mcu_id))
+    except FileNotFoundError:
+        return []
+    return sorted(name[:-4] for name in names if name.endswith(".wfa"))
+
+
+class DayArchive:
+    """ random access to one device-day by minute epoch; the index is loaded once """
+
+    def __init__(self, root, mcu_id, date):
+        self.path = archive_path(root, mcu_id, date)
+        index = read_index(root, mcu_id, date)
+        # 同一分鐘寫了兩次時以最後一次為準
+        self.blocks = {int(minute): (int(offset), int(length)) for minute, offset, length in index}
+
+    def minutes(self):
+        return sorted(self.blocks)
+
+    def get(self, minute_epoch):
+        block = self.blocks.get(int(minute_epoch))
+        if block is None:
+            return None
+        try:
+            with open(self.path, "rb") as f:
+                return _read_block(f, *block)[1]
+        except FileNotFoundError:
+            return None  # 讀的同時被 compactor 依保留期限刪掉
+
+
+def iter_blocks(root, mcu_id, date, start=None, end=None):
+    """ yield (minute_epoch, {channel: ndarray}) of one device-day in time order, blocks overlapping [start, end) """
+    index = read_index(root, mcu_id, date)
+    if not len(index):
+        return
+    latest = {}
+    for minute, offset, length in index:
+        latest[int(minute)] = (int(offset), int(length))
+    minutes = np.array(sorted(latest), dtype=np.int64)
+    # block M 的樣本在 [M - 60, M)
+    lo = 0 if start is None else np.searchsorted(minutes, start, side="right")
+    hi = len(minutes) if end is None else np.searchsorted(minutes, end + 60, side="left")
+    with open(archive_path(root, mcu_id, date), "rb") as f:
+        for minute in minutes[lo:hi]:
+            yield int(minute), _read_block(f, *latest[int(minute)])[1]
+
+
+def _dates_between(start_epoch, end_epoch):
+    day = datetime.fromtimestamp(start_epoch, taiwan_tz).date()
+    last = datetime.fromtimestamp(max(start_epoch, end_epoch - 1), taiwan_tz).date()
+    while day <= last:
+        yield day.strftime("%Y-%m-%d")
+        day += timedelta(days=1)
+
+
+def read_waveform(root, mcu_id, start_epoch, end_epoch, channels=CHANNELS):
+    """
+    Samples of the minutes overlapping [start_epoch, end_epoch), across
+    day boundaries: {"minutes": minute epochs, "counts": samples per
+    minute, channel: all samples concatenated (uint16)}
+    """
+    minutes, counts, parts = [], [], {name: [] for name in channels}
+    for date in _dates_between(start_epoch, end_epoch + 60):
+        for minute, block in iter_blocks(root, mcu_id, date, start_epoch, end_epoch):
+            minutes.append(minute)
+            counts.append(len(block[channels[0]]))
+            for name in channels:
+                parts[name].append(block[name])
+    result = {"minutes": np.array(minutes, dtype=np.int64), "counts": np.array(counts, dtype=np.int64)}
+    for name in channels:
+        result[name] = np.concatenate(parts[name]) if parts[name] else np.zeros(0, dtype=np.uint16)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect the waveform archive")
+    parser.add_argument("command", choices=["info", "repair"])
+    parser.add_argument("--root", default="/app/snapshots")
+    parser.add_argument("--mcu", required=True)
+    parser.add_argument("--date", action="append", help="YYYY-MM-DD, repeatable (default: every archived date)")
+    args = parser.parse_args(argv)
+
+    for date in args.date or archive_dates(args.root, args.mcu):
+        if args.command == "repair":
+            repair(args.root, args.mcu, date)
+        index = read_index(args.root, args.mcu, date)
+        samples = sum(len(block["raw"]) + len(block["heart"]) for _, block in iter_blocks(args.root, args.mcu, date))
+        size = os.path.getsize(archive_path(args.root, args.mcu, date)) if len(index) else 0
+        ratio = samples * 2 / size if size else 0
+        print(f"📼 {args.mcu} {date}: {len(index)} minutes, {samples} samples, {size} bytes ({ratio:.1f}x vs uint16)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,8 +23,28 @@ function App() {
   useEffect(() => {
     axios.get('http://localhost:8000/status').then(res => setMcuData(res.data));
 
-    socket.on('mcu_update', data => {
-      setMcuData({ ...data });
+    // mcu_update 只帶變動的欄位與序號；序號不連續時要求完整狀態
+    let lastSeq = null;
+    socket.on('mcu_update', msg => {
+      if (msg.full) {
+        lastSeq = msg.seq;
+        setMcuData({ ...msg.full });
+        return;
+      }
+      if (lastSeq !== null && msg.seq !== lastSeq + 1) {
+        lastSeq = null;
+        socket.emit('mcu_resync');
+        return;
+      }
+      lastSeq = msg.seq;
+      setMcuData(prev => {
+        const next = { ...prev };
+        Object.entries(msg.changes).forEach(([addr, fields]) => {
+          next[addr] = { ...next[addr], ...fields };
+        });
+        msg.removed.forEach(addr => delete next[addr]);
+        return next;
+      });
     });
 
     return () => socket.disconnect();
@@ -1,28 +1,47 @@
 import React, { useEffect, useState } from 'react';
 import axios from 'axios';
+import { io } from 'socket.io-client';
 import { useNavigate } from 'react-router-dom';
 
 function MCUDashboard() {
-  const [mcuList, setMcuList] = useState([]);
+  const [mcuBoard, setMcuBoard] = useState({});
   const navigate = useNavigate();
 
   useEffect(() => {
-    const fetchMCUs = () => {
-      axios.get('http://172.20.10.3:8000/status')
-        .then(res => {
-          const mcuObj = res.data;
-          const mcuArray = Object.values(mcuObj).filter(mcu => mcu.status === "connect");
-          setMcuList(mcuArray);
-        })
-        .catch(err => console.error("❌ 無法取得 MCU 清單", err));
-    };
+    axios.get('http://172.20.10.3:8000/status')
+      .then(res => setMcuBoard(res.data))
+      .catch(err => console.error("❌ 無法取得 MCU 清單", err));
 
-    fetchMCUs(); // initial fetch
-    const interval = setInterval(fetchMCUs, 3000); // 每 3 秒更新一次
+    // 不再每 3 秒輪詢 /status：連線時後端送完整狀態，之後每個 tick 只推變動欄位
+    const socket = io('http://172.20.10.3:8000');
+    let lastSeq = null;
+    socket.on('mcu_update', msg => {
+      if (msg.full) {
+        lastSeq = msg.seq;
+        setMcuBoard({ ...msg.full });
+        return;
+      }
+      if (lastSeq !== null && msg.seq !== lastSeq + 1) {
+        lastSeq = null;
+        socket.emit('mcu_resync');
+        return;
+      }
+      lastSeq = msg.seq;
+      setMcuBoard(prev => {
+        const next = { ...prev };
+        Object.entries(msg.changes).forEach(([addr, fields]) => {
+          next[addr] = { ...next[addr], ...fields };
+        });
+        msg.removed.forEach(addr => delete next[addr]);
+        return next;
+      });
+    });
 
-    return () => clearInterval(interval);
+    return () => socket.disconnect();
   }, []);
 
+  const mcuList = Object.values(mcuBoard).filter(mcu => mcu.status === "connect");
+
   return (
     <div style={{ padding: '2rem', display: 'flex', flexDirection: 'column', alignItems: 'center', justifyContent: 'center' }}>
       <h2>📡 Smart Mattress Live Monitoring</h2>
@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { useParams, useNavigate } from 'react-router-dom';
 import axios from 'axios';
 import { io } from 'socket.io-client';
@@ -12,6 +12,7 @@ function MCUDetailPage() {
   const [chartImages, setChartImages] = useState(null);
   const [showHistoryForm, setShowHistoryForm] = useState(false);
   const [historyParams, setHistoryParams] = useState({ start: '', end: '' });
+  const [realtimeVersion, setRealtimeVersion] = useState(0);
 
   function handleDownload() {
     const selectedDate = prompt("請輸入日期（格式：YYYY-MM-DD）");
@@ -64,9 +65,36 @@ function MCUDetailPage() {
     };
 
     fetchData(); // initial fetch
-    const interval = setInterval(fetchData, 3000); // 每秒更新一次
 
+    // 不再每 3 秒輪詢：訂閱這台 MCU 的 room，後端有變動才推送
     const socket = io('http://172.20.10.3:8000');
+    let lastSeq = null;
+    const subscribe = () => socket.emit('subscribe', { mcu_id: id });
+    socket.on('connect', subscribe); // 重新連線後也要重新訂閱
+
+    socket.on('mcu_state', (msg) => {
+      if (msg.mcu_id !== id) return;
+      if (msg.full !== undefined) {
+        lastSeq = msg.seq;
+        if (msg.full) setData({ ...msg.full });
+        return;
+      }
+      if (lastSeq !== null && msg.seq !== lastSeq + 1) {
+        // 序號不連續：重新訂閱拿完整狀態
+        lastSeq = null;
+        subscribe();
+        return;
+      }
+      lastSeq = msg.seq;
+      setData(prev => ({ ...prev, ...msg.changes }));
+    });
+
+    socket.on('mcu_realtime', (msg) => {
+      if (msg.mcu_id === id) {
+        setRealtimeVersion(v => v + 1);
+      }
+    });
+
     socket.on('mcu_disconnect', (payload) => {
       console.log("🛑 MCU disconnect event received:", payload);
       if (payload.id === id) {
@@ -75,18 +103,23 @@ function MCUDetailPage() {
     });
 
     return () => {
-      clearInterval(interval); // 清除定時器
+      socket.emit('unsubscribe', { mcu_id: id });
       socket.disconnect();
     };
   }, [id]);
 
   const mcu_id = data?.name ?? id;
 
-  // 加入即時合併圖表的 useEffect
+  // 即時圖表：收到 mcu_realtime 推送才重抓，最多每 3 秒一次
+  const lastChartFetch = useRef(0);
+  const chartTimer = useRef(null);
+
   useEffect(() => {
     if (!mcu_id) return;
 
     const fetchChart = () => {
+      lastChartFetch.current = Date.now();
+      chartTimer.current = null;
       axios.get(`http://172.20.10.3:8001/realtime/${mcu_id}`)
         .then(res => {
           if (res.data.heart_image && res.data.resp_image && res.data.status_image) {
@@ -105,10 +138,18 @@ function MCUDetailPage() {
         });
     };
 
-    fetchChart(); // 初始載入一次
-    const interval = setInterval(fetchChart, 3000); // 每 3 秒更新一次
+    if (chartTimer.current) return; // 已排定下一次
+    const wait = lastChartFetch.current + 3000 - Date.now();
+    if (wait <= 0) {
+      fetchChart();
+    } else {
+      chartTimer.current = setTimeout(fetchChart, wait);
+    }
+  }, [mcu_id, realtimeVersion]);
 
-    return () => clearInterval(interval); // 清除定時器
+  useEffect(() => () => {
+    if (chartTimer.current) clearTimeout(chartTimer.current);
+    chartTimer.current = null;
   }, [mcu_id]);
 
   if (data?.status === "disconnected") {